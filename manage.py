@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import click
+import datetime
+import multiprocessing
+from piss import PISS, retention, attachment_index, file_io, scrub
+from piss.storage import get_pack_storage
+from piss.services.uploads import expire_sessions
+from piss.services.syndication import jobs, backfill, sandbox
+
+
+# Grab the path for the instance folder
+instance_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'instance')
+
+
+@click.group()
+@click.pass_context
+def cli(ctx):
+    '''
+    Maintenance commands for a PISS server.
+    '''
+    ctx.obj = PISS(instance_path=instance_path)
+
+
+@cli.command('compact-versions')
+@click.pass_obj
+@click.option('--dry-run', default=False, is_flag=True, help='Only report what would be archived.')
+def compact_versions(app, dry_run):
+    '''
+    Archive old post versions according to `VERSION_RETENTION`.
+    '''
+    with app.test_request_context():
+        stats = retention.compact_versions(dry_run=dry_run)
+    click.echo('Posts with versions to archive: %d' % (stats['posts'],))
+    click.echo('Versions archived: %d (%d bytes compressed)'
+               % (stats['archived'], stats['archived_bytes']))
+    click.echo('Versions rewritten as keyframes: %d' % (stats['keyframes'],))
+
+
+@cli.command('collect-attachments')
+@click.pass_obj
+@click.option('--dry-run', default=False, is_flag=True, help='Only report orphaned files.')
+@click.option('--batch-size', default=100, help='Number of files to delete at a time.')
+@click.option('--grace-period', default=attachment_index.DEFAULT_GRACE_PERIOD,
+              help='Minimum age in seconds of a file to be deleted.')
+def collect_attachments(app, dry_run, batch_size, grace_period):
+    '''
+    Rebuild the attachment index and delete files that no post references.
+    '''
+    with app.test_request_context():
+        stats = attachment_index.collect_attachments(
+            dry_run=dry_run, batch_size=batch_size, grace_period=grace_period,
+            progress=lambda digest: click.echo('Orphaned: %s' % (digest,)))
+    click.echo('Referenced attachments: %d' % (stats['referenced'],))
+    click.echo('Orphaned attachments: %d' % (stats['orphaned'],))
+    if dry_run:
+        click.echo('Bytes that would be reclaimed: %d' % (stats['deleted_bytes'],))
+    else:
+        click.echo('Attachments deleted: %d (%d bytes)'
+                   % (stats['deleted'], stats['deleted_bytes']))
+        click.echo('Unused chunks and empty directories removed: %d'
+                   % (stats['cleaned_up'],))
+
+
+@cli.command('pack-attachments')
+@click.pass_obj
+def pack_attachments(app):
+    '''
+    Move small loose attachments into pack files.
+    '''
+    if get_pack_storage(app.attachment_storage) is None:
+        raise click.UsageError("Set ATTACHMENT_STORAGE = 'packs' in piss.cfg first.")
+    with app.test_request_context():
+        stats = file_io.pack_attachments()
+    click.echo('Attachments packed: %d (%d bytes)'
+               % (stats['packed'], stats['packed_bytes']))
+    for digest in stats['corrupt']:
+        click.echo('Left loose, contents don\'t match digest: %s' % (digest,))
+    click.echo('Empty directories removed: %d' % (stats['directories'],))
+
+
+@cli.command('scrub-attachments')
+@click.pass_obj
+@click.option('--workers', default=None, type=int, help='Number of worker processes. Defaults to the number of CPUs.')
+@click.option('--max-rate', default=None, type=float, help='Maximum read rate in MB/s.')
+@click.option('--full', default=False, is_flag=True, help='Also check files that haven\'t changed since they were last checked.')
+@click.option('--report', default=None, type=click.File('w'), help='Write the corrupt and missing files to this file as JSON.')
+def scrub_attachments(app, workers, max_rate, full, report):
+    '''
+    Check that stored attachments still match their digests.
+    '''
+    def progress(digest, ok):
+        if not ok:
+            click.echo('Corrupt: %s' % (digest,))
+    with app.test_request_context():
+        stats = scrub.scrub_attachments(
+            workers=workers, full=full, progress=progress,
+            max_rate=max_rate * 1024 * 1024 if max_rate else None)
+    for problem in stats['problems']:
+        if problem['problem'] == 'missing':
+            click.echo('Missing: %s' % (problem['digest'],))
+    click.echo('Attachments checked: %d (%d bytes)'
+               % (stats['checked'], stats['checked_bytes']))
+    click.echo('Unchanged since last checked: %d' % (stats['skipped'],))
+    click.echo('Corrupt or missing: %d' % (len(stats['problems']),))
+    if report:
+        json.dump(stats['problems'], report, indent=2)
+
+
+@cli.command('expire-uploads')
+@click.pass_obj
+@click.option('--ttl', default=None, type=int,
+              help='Seconds since an upload session was last written to. Defaults to `UPLOAD_SESSION_TTL`.')
+def expire_uploads(app, ttl):
+    '''
+    Remove expired upload sessions and their files.
+    '''
+    with app.test_request_context():
+        removed = expire_sessions(ttl=ttl)
+    click.echo('Upload sessions removed: %d' % (removed,))
+
+
+@cli.command('syndication-worker')
+@click.option('--processes', default=1, help='Number of worker processes.')
+@click.option('--poll-interval', default=1.0, help='Seconds to wait when there are no jobs.')
+def syndication_worker(processes, poll_interval):
+    '''
+    Run queued syndication jobs until interrupted.
+    '''
+    if processes == 1:
+        return run_syndication_worker(poll_interval)
+    # Every process needs an app (and a database connection) of its own
+    workers = [multiprocessing.Process(target=run_syndication_worker,
+                                       args=(poll_interval,))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+
+@cli.command('syndication-backfill')
+@click.pass_obj
+@click.argument('services', nargs=-1, required=True)
+@click.option('--name', default=None, help='Name of the backfill, to resume it. Defaults to the services joined with "+".')
+@click.option('--since', default=None, help='Only syndicate notes created on or after this date (YYYY-MM-DD).')
+@click.option('--batch-size', default=100, help='Number of notes to queue at a time.')
+@click.option('--window', default=50, help='Maximum number of backfill jobs queued at once.')
+@click.option('--dry-run', default=False, is_flag=True, help='Only count the notes that would be syndicated.')
+def syndication_backfill(app, services, name, since, batch_size, window, dry_run):
+    '''
+    Syndicate existing notes that haven't been syndicated yet. Requires a
+    running syndication worker.
+    '''
+    if since:
+        since = datetime.datetime.strptime(since, '%Y-%m-%d')
+    def progress(stats):
+        eta = '%dh%02dm' % divmod(int(stats['eta']) // 60, 60) \
+            if stats['eta'] is not None else 'unknown'
+        rate = '%.2f' % (stats['rate'],) if stats['rate'] else '-'
+        click.echo('Queued %d, done %d, failed %d, remaining %d: %s jobs/s, ETA %s'
+                   % (stats['queued'], stats['done'], stats['failed'],
+                      stats['remaining'], rate, eta))
+    with app.test_request_context():
+        try:
+            stats = backfill.run_backfill(
+                [service.lower() for service in services], name=name,
+                since=since, batch_size=batch_size, window=window,
+                dry_run=dry_run, progress=progress)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+    if dry_run:
+        click.echo('Jobs that would be queued: %d' % (stats['queued'],))
+    click.echo('Skipped (already syndicated or rejected): %d' % (stats['skipped'],))
+
+
+@cli.command('syndication-sandbox')
+@click.option('--host', default='127.0.0.1', help='Address to listen on.')
+@click.option('--port', default=5050, help='Port to listen on.')
+@click.option('--latency', default=0.1, help='Seconds each response takes.')
+@click.option('--jitter', default=0.0, help='Most seconds added to the latency at random.')
+@click.option('--error-rate', default=0.0, help='Fraction of requests that fail.')
+@click.option('--limit', default=None, type=int, help='Requests each service accepts per window.')
+@click.option('--window', default=15 * 60, help='Seconds in a rate limit window.')
+def syndication_sandbox(host, port, latency, jitter, error_rate, limit, window):
+    '''
+    Run fake Twitter and Facebook APIs for `SYNDICATION_SANDBOX_URL`.
+    '''
+    app = sandbox.create_sandbox(latency=latency, jitter=jitter,
+                                 error_rate=error_rate, limit=limit,
+                                 window=window)
+    app.run(host=host, port=port, threaded=True)
+
+
+def run_syndication_worker(poll_interval):
+    def progress(job, status):
+        click.echo('%s: %s' % (job['_id'], status))
+    try:
+        jobs.run_worker(PISS(instance_path=instance_path),
+                        poll_interval=poll_interval, progress=progress)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+'''
+Attachment index
+
+Attachments are stored by digest, so any number of posts may share a file.
+The `attachments` collection maps each digest to its metadata and to the posts
+that reference it:
+
+    {
+        "_id": "<digest>",
+        "content_type": "image/jpeg",
+        "size": 48213,
+        "posts": ["2JHuHA", "2JHuHB"],
+        "current": ["2JHuHB"],
+        "public": ["2JHuHB"],
+        "updated": <datetime>
+    }
+
+`posts` lists every post that references the file in any of its versions,
+`current` the posts whose latest version lists it, and `public` those of the
+`current` posts that are public.
+
+The index is kept up to date by the event hooks as posts are created, edited
+and deleted. The attachments routes use it (through `lookup_attachment`) to
+find a file by digest without searching the posts collection, and a file is
+only safe to delete once no post references it, which is what the
+mark-and-sweep collector in this module checks before reclaiming anything
+(see `manage.py collect-attachments`).
+'''
+
+import time
+import datetime
+from flask import current_app
+from eve.utils import config
+from eve.versioning import versioned_id_field
+from .data import ARCHIVE_SUFFIX, VersionCursor, read_archived_version
+from .file_io import get_storage, delete_attachment
+from .derivatives import delete_derivatives, remove_empty_derivative_dirs
+from .singleflight import single_flight
+
+INDEX_COLLECTION = 'attachments'
+
+# Files younger than this are never collected, so that an upload that was
+# deduplicated against an orphaned file isn't lost before its post is saved
+DEFAULT_GRACE_PERIOD = 60 * 60
+
+
+def get_attachment_index():
+    return current_app.data.driver.db[INDEX_COLLECTION]
+
+
+def get_attachment_digests(document):
+    '''
+    Return the set of attachment digests listed in a post.
+    '''
+    return set(a['digest'] for a in document.get('attachments', None) or []
+               if 'digest' in a)
+
+
+def lookup_attachment(digest):
+    '''
+    Return the metadata of the attachment with the given digest, as a dict with
+    `digest`, `content_type`, `size`, `post` (the ID of a post that lists it,
+    preferably a public one) and `public` keys. Returns `None` if no post
+    currently lists the attachment, or if the index doesn't know about it yet.
+
+    Lookups are cached in `app.attachment_cache`.
+
+    :param digest: the attachment digest.
+    '''
+    cache = current_app.attachment_cache
+    # Requests for the same attachment that miss at the same time wait for
+    # the first one's lookup
+    attachment = single_flight('attachment:' + digest,
+                               lambda: load_attachment(digest),
+                               lookup=lambda: cache.get(digest, None),
+                               shared=cache.shared)
+    return attachment or None
+
+
+def load_attachment(digest):
+    '''
+    Look up the metadata of an attachment in the attachment index and cache
+    it. Returns `False` if there is none. See `lookup_attachment`.
+    '''
+    cache = current_app.attachment_cache
+    entry = get_attachment_index().find_one(
+        {'_id': digest, 'current': {'$ne': []}})
+    if entry and 'content_type' in entry:
+        public = entry.get('public', None) or []
+        attachment = {
+            'digest': digest,
+            'content_type': entry['content_type'],
+            'size': entry.get('size', None),
+            'post': public[0] if public else entry['current'][0],
+            'public': bool(public)
+        }
+        cache.set(digest, attachment)
+    else:
+        attachment = False
+        cache.set(digest, False,
+                  ttl=current_app.config.get('ATTACHMENT_CACHE_NEGATIVE_TTL', 30))
+    return attachment
+
+
+def forget_attachments(digests):
+    '''
+    Drop the cached metadata of the given digests.
+    '''
+    for digest in digests:
+        current_app.attachment_cache.delete(digest)
+
+
+def index_post_attachments(post, previous=None):
+    '''
+    Record the attachments listed by the latest version of a post, after it has
+    been created, edited or replaced.
+
+    :param post: the post, with at least its ID, `attachments` and
+                 `permissions`.
+    :param previous: optional previous version of the post. Files it listed
+                     that `post` doesn't are no longer current for the post,
+                     but the post keeps its reference to them since they're
+                     still in its history.
+    '''
+    index = get_attachment_index()
+    post_id = post[config.ID_FIELD]
+    public = bool(is_public(post))
+    now = datetime.datetime.utcnow()
+    attachments = dict((a['digest'], a) for a in
+                       post.get('attachments', None) or [] if 'digest' in a)
+
+    stale = get_attachment_digests(previous or {}) - set(attachments)
+    if stale:
+        index.update({'_id': {'$in': list(stale)}},
+                     {'$pull': {'current': post_id, 'public': post_id},
+                      '$set': {'updated': now}},
+                     multi=True)
+
+    for digest, attachment in attachments.items():
+        update = {
+            '$addToSet': {'posts': post_id, 'current': post_id},
+            '$set': {'updated': now}
+        }
+        for field in ('content_type', 'size'):
+            if field in attachment:
+                update['$set'][field] = attachment[field]
+        if public:
+            update['$addToSet']['public'] = post_id
+        else:
+            update['$pull'] = {'public': post_id}
+        index.update({'_id': digest}, update, upsert=True)
+
+    forget_attachments(stale)
+    forget_attachments(attachments)
+
+
+def remove_attachment_refs(post_id):
+    '''
+    Drop every reference held by a post, e.g. once it has been deleted along
+    with all of its versions.
+
+    :param post_id: the ID of the post.
+    '''
+    index = get_attachment_index()
+    index.ensure_index('posts')
+    digests = [entry['_id'] for entry in index.find({'posts': post_id}, {'_id': 1})]
+    if not digests:
+        return
+    index.update({'_id': {'$in': digests}},
+                 {'$pull': {'posts': post_id, 'current': post_id,
+                            'public': post_id},
+                  '$set': {'updated': datetime.datetime.utcnow()}},
+                 multi=True)
+    forget_attachments(digests)
+
+
+def is_public(post):
+    permissions = post.get('permissions', None) or {}
+    return permissions.get('public', False)
+
+
+def rebuild_attachment_index(resource='posts', progress=None):
+    '''
+    Mark phase. Rebuild the index from scratch by walking every post and every
+    version of every post, including archived versions.
+
+    Entries that the event hooks touch while the index is being rebuilt are
+    merged with what was found rather than overwritten, so references created
+    in the meantime aren't lost.
+
+    :param resource: the versioned resource to scan.
+    :param progress: optional function called with the ID of each post.
+    :returns: the number of digests that are referenced.
+    '''
+    db = current_app.data.driver.db
+    index = get_attachment_index()
+    index.ensure_index('posts')
+    started = datetime.datetime.utcnow()
+    source = config.SOURCES[resource]['source']
+    versions_source = source + config.VERSIONS
+    id_field = versioned_id_field()
+
+    marked = {}
+
+    def mark(post_id, document, latest=False):
+        for attachment in document.get('attachments', None) or []:
+            if 'digest' not in attachment:
+                continue
+            entry = marked.setdefault(attachment['digest'], {
+                'posts': set(), 'current': set(), 'public': set()})
+            entry['posts'].add(post_id)
+            if latest:
+                entry['current'].add(post_id)
+                if is_public(document):
+                    entry['public'].add(post_id)
+            for field in ('content_type', 'size'):
+                if field in attachment and (latest or field not in entry):
+                    entry[field] = attachment[field]
+
+    for post in db[source].find({}, {'attachments': 1, 'permissions': 1}):
+        if progress:
+            progress(post[config.ID_FIELD])
+        mark(post[config.ID_FIELD], post, latest=True)
+
+    # Versions are read in order so that each delta is applied to the version
+    # before it instead of being rebuilt from its keyframe
+    shadow = db[versions_source]
+    cursor = shadow.find().sort([(id_field, 1), (config.VERSION, 1)])
+    for version in VersionCursor(cursor, shadow):
+        mark(version[id_field], version)
+
+    archive = db[versions_source + ARCHIVE_SUFFIX]
+    for archived in archive.find({}, {id_field: 1, config.VERSION: 1}):
+        version = read_archived_version(archive, {
+            id_field: archived[id_field],
+            config.VERSION: archived[config.VERSION]
+        })
+        if version:
+            mark(version[id_field], version)
+
+    digests = set(marked)
+    digests.update(entry['_id'] for entry in index.find({}, {'_id': 1}))
+    empty = {'posts': (), 'current': (), 'public': ()}
+    for digest in digests:
+        entry = marked.get(digest, empty)
+        refs = dict((field, sorted(entry[field]))
+                    for field in ('posts', 'current', 'public'))
+        metadata = dict((field, entry[field])
+                        for field in ('content_type', 'size') if field in entry)
+        updates = dict(refs, updated=started)
+        updates.update(metadata)
+        result = index.update(
+            {'_id': digest, 'updated': {'$lt': started}}, {'$set': updates})
+        if not result or not result.get('updatedExisting', False):
+            # New to the index, or changed by a hook since we started. The
+            # hook knows better which posts currently list the file, but
+            # references from older versions are always safe to add.
+            update = {
+                '$addToSet': {'posts': {'$each': refs['posts']}},
+                '$setOnInsert': dict(metadata, current=refs['current'],
+                                     public=refs['public'], updated=started)
+            }
+            index.update({'_id': digest}, update, upsert=True)
+    forget_attachments(digests)
+    return len(marked)
+
+
+def find_orphaned_attachments(grace_period=DEFAULT_GRACE_PERIOD):
+    '''
+    Yield a `(digest, size)` tuple for every stored file that no post
+    references and that is older than the grace period.
+
+    :param grace_period: minimum age of a file, in seconds.
+    '''
+    index = get_attachment_index()
+    storage = get_storage()
+    cutoff = time.time() - grace_period
+    for digest in storage.iter_digests():
+        stat = storage.stat(digest)
+        if stat is None or stat[1] > cutoff:
+            continue
+        if index.find_one({'_id': digest, 'posts': {'$ne': []}},
+                          {'_id': 1}):
+            continue
+        yield digest, stat[0]
+
+
+def collect_attachments(dry_run=False, batch_size=100,
+                        grace_period=DEFAULT_GRACE_PERIOD, progress=None):
+    '''
+    Rebuild the attachment index, then delete the files that no post
+    references (and their image derivatives) in batches of `batch_size`, and
+    let the storage backend tidy up (e.g. remove the fan-out directories that
+    are left empty, or chunks that are no longer used).
+
+    Each batch is checked against the index and the storage again just before
+    it's deleted, in case a post started referencing one of the files in the
+    meantime, or the file was uploaded again (which marks it as recently
+    used).
+
+    :param dry_run: only report what would be deleted.
+    :param batch_size: the number of files to delete at a time.
+    :param grace_period: minimum age of a file to be deleted, in seconds.
+    :param progress: optional function called with each orphaned digest.
+    :returns: a dict of statistics.
+    '''
+    stats = {'referenced': rebuild_attachment_index(), 'orphaned': 0,
+             'deleted': 0, 'deleted_bytes': 0, 'cleaned_up': 0}
+
+    batch = []
+    for orphan in find_orphaned_attachments(grace_period):
+        if progress:
+            progress(orphan[0])
+        stats['orphaned'] += 1
+        if dry_run:
+            stats['deleted_bytes'] += orphan[1]
+            continue
+        batch.append(orphan)
+        if len(batch) >= batch_size:
+            _delete_batch(batch, stats, grace_period)
+            batch = []
+    if batch:
+        _delete_batch(batch, stats, grace_period)
+
+    if not dry_run:
+        stats['cleaned_up'] = get_storage().cleanup() + \
+            remove_empty_derivative_dirs()
+    return stats
+
+
+def _delete_batch(batch, stats, grace_period):
+    index = get_attachment_index()
+    storage = get_storage()
+    digests = [digest for digest, _ in batch]
+    referenced = set(entry['_id'] for entry in index.find(
+        {'_id': {'$in': digests}, 'posts': {'$ne': []}}, {'_id': 1}))
+    cutoff = time.time() - grace_period
+    deleted = []
+    for digest, size in batch:
+        if digest in referenced:
+            continue
+        stat = storage.stat(digest)
+        if stat is None or stat[1] > cutoff:
+            # Uploaded again since it was found
+            continue
+        if not delete_attachment(digest):
+            continue
+        delete_derivatives(digest)
+        deleted.append(digest)
+        stats['deleted'] += 1
+        stats['deleted_bytes'] += size
+    index.remove({'_id': {'$in': deleted}, 'posts': []})
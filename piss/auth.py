@@ -2,7 +2,7 @@
 
 from functools import wraps
 from eve.auth import HMACAuth
-from flask import current_app, request, g
+from flask import current_app, request, g, url_for
 import hawk
 from hawk.util import HawkException
 from .utils import get_post_by_id, is_collection_path
@@ -30,10 +30,35 @@ def get_credentials_from_post_id(cid):
     a format suitable for Hawk authentication. If the ID is given as `root`, the
     server will check against the credentials given in `ROOT_CREDENTIALS` in 
     `piss.cfg`.
+
+    Lookups are cached in `app.credentials_cache`. Unknown IDs are cached as
+    well, in `app.unknown_credentials_cache` and for a shorter time, so that
+    requests signed with made-up IDs don't each cost a trip to the database.
     '''
     if cid == 'root':
         return current_app.config.get('ROOT_CREDENTIALS')
-    
+
+    cache = current_app.credentials_cache
+    credentials = cache.get(cid, None)
+    if credentials is not None:
+        return credentials
+    unknown = current_app.unknown_credentials_cache
+    if unknown.get(cid, None) is not None:
+        return False
+
+    credentials = load_credentials(cid)
+    if credentials:
+        cache.set(cid, credentials)
+    else:
+        unknown.set(cid, True)
+    return credentials
+
+
+def load_credentials(cid):
+    '''
+    Build Hawk credentials from the credentials post with the given ID.
+    Returns `False` if the post doesn't exist or isn't a credentials post.
+    '''
     cred_post = get_post_by_id(cid)
     if not cred_post:
         return False
@@ -41,11 +66,29 @@ def get_credentials_from_post_id(cid):
         return False
     if cred_post['content'].get('hawk_algorithm', None) is None or cred_post['content'].get('hawk_key', None) is None:
         return False
-    return {
+    credentials = {
         'id': str(cid),
         'algorithm': str(cred_post['content']['hawk_algorithm']),
         'key': str(cred_post['content']['hawk_key'])
     }
+    # Keep track of the app these credentials belong to
+    app_type = str(url_for('server_info.types_item', name='app', _external=True))
+    for link in cred_post.get('links', []):
+        if link.get('type', None) == app_type and 'post' in link:
+            credentials['app'] = str(link['post'])
+            break
+    return credentials
+
+
+def forget_credentials(cid):
+    '''
+    Drop any cached credentials for the given ID. Called by the event hooks
+    whenever a post is written so that stale keys are never accepted. Other
+    workers only drop theirs if the cache is shared, and otherwise within
+    `CREDENTIALS_CACHE_TTL` seconds.
+    '''
+    current_app.credentials_cache.delete(str(cid))
+    current_app.unknown_credentials_cache.delete(str(cid))
 
 class HawkAuth(HMACAuth):
     def check_auth(self, http_auth, host, port, path, query_string, allowed_roles, method):
@@ -58,7 +101,12 @@ class HawkAuth(HMACAuth):
                 'authorization': http_auth
             }
         }
-        server = hawk.Server(req, get_credentials_from_post_id)
+        def credentials_fn(cid):
+            # Remember who signed the request for the event hooks
+            credentials = get_credentials_from_post_id(cid)
+            g.hawk_credentials = credentials
+            return credentials
+        server = hawk.Server(req, credentials_fn)
         options = {}
         
         try:
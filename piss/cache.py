@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from .shared_cache import SharedCache, open_shared_memory
+
+
+def create_cache(app_config, name, maxsize=1024, ttl=300):
+    '''
+    Return a cache for the app, in the backend set with `CACHE_BACKEND`:
+    `'memory'` (the default) for an `LRUCache` in every worker process, or
+    `'shared'` for a `SharedCache` that every worker on the host uses (see
+    `piss.shared_cache`).
+
+    :param name: the name of the cache, unique to it.
+    :param maxsize: the number of entries an `LRUCache` holds. A
+                    `SharedCache` is bounded by the size of the shared memory
+                    instead.
+    :param ttl: seconds before entries expire.
+    '''
+    backend = app_config.get('CACHE_BACKEND', 'memory')
+    if backend == 'memory':
+        return LRUCache(maxsize=maxsize, ttl=ttl)
+    if backend == 'shared':
+        return SharedCache(open_shared_memory(app_config), prefix=name + ':',
+                           ttl=ttl)
+    raise ValueError('Unknown CACHE_BACKEND: %s' % (backend,))
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread-safe, in-process cache. Entries are evicted in least
+    recently used order once `maxsize` is reached, and expire after `ttl`
+    seconds. A per-entry TTL may be given to `set` in order to keep some
+    entries (like negative results) for a shorter time.
+
+    Hits and misses are counted so that callers can judge whether the cache
+    is doing its job.
+
+    Every process has a cache of its own, so it isn't `shared`.
+    '''
+    shared = False
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get_entry(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        '''
+        Return the value cached under `key`, or `default` if the key is
+        missing or has expired.
+
+        :param key: the key to look up.
+        :param default: value to return on a cache miss.
+        '''
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # Move the key to the end so it's evicted last
+            del self._data[key]
+            self._data[key] = entry
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        '''
+        Cache `value` under `key`, evicting the least recently used entry if
+        the cache is full.
+
+        :param key: the key to store the value under.
+        :param value: the value to cache.
+        :param ttl: optional number of seconds before the entry expires.
+                    Defaults to the TTL of the cache.
+        '''
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+            self._data[key] = (time.time() + ttl, value)
+
+    def add(self, key, value, ttl=None):
+        '''
+        Cache `value` under `key` unless there already is an entry for it.
+        Returns whether the value was stored.
+        '''
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            if self._get_entry(key) is not None:
+                return False
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+            self._data[key] = (time.time() + ttl, value)
+            return True
+
+    def delete(self, key):
+        '''
+        Drop `key` from the cache if it exists.
+        '''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        '''
+        Drop every entry from the cache and reset the counters.
+        '''
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''
+        Return a dict with the size of the cache and its hit/miss counters.
+        '''
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def _get_entry(self, key):
+        # Must be called with the lock held. Expired entries are dropped
+        # lazily when they are looked up.
+        entry = self._data.get(key, None)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self._data[key]
+            return None
+        return entry
+
+
+class RedisCache(object):
+    '''
+    A cache kept in a Redis (or Redis-compatible) server, with the same
+    interface as `LRUCache`, so that every worker process and host sees the
+    same entries. Values are pickled, so only point it at a trusted server.
+    Eviction is up to the server's `maxmemory-policy`.
+
+    :param url: the URL of the server, e.g. `redis://localhost:6379/0`.
+    :param prefix: prefixed to every key, so that several caches can share a
+                   database.
+    :param ttl: seconds before entries expire.
+    '''
+    shared = True
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='piss:', ttl=300):
+        if redis is None:
+            raise RuntimeError('The redis package is required for Redis caches.')
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return bool(self.client.exists(self.prefix + key))
+
+    def get(self, key, default=None):
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.client.setex(self.prefix + key, max(int(ttl), 1),
+                          pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def add(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        return bool(self.client.set(self.prefix + key,
+                                    pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                    ex=max(int(ttl), 1), nx=True))
+
+    def get_counter(self, key):
+        '''
+        Return the integer counter stored under `key`, or `None` if there is
+        none. Counters are kept apart from the other entries and never
+        expire.
+        '''
+        value = self.client.get(self.prefix + 'counter:' + key)
+        return int(value) if value is not None else None
+
+    def add_counter(self, key, value):
+        '''
+        Start a counter at `value`, unless it already exists.
+        '''
+        self.client.set(self.prefix + 'counter:' + key, int(value), nx=True)
+
+    def incr(self, key):
+        '''
+        Add one to a counter, starting it at one if it doesn't exist, and
+        return the new value.
+        '''
+        return self.client.incr(self.prefix + 'counter:' + key)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'size': self.client.dbsize(),
+            'hits': self.hits,
+            'misses': self.misses
+        }
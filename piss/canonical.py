@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+'''
+Canonical hashing
+
+Feeds Python objects into a hash incrementally, in a canonical form: dict keys
+are sorted, every value is tagged with its type, and strings and containers
+are prefixed with their length so that different values can never produce the
+same stream of bytes. Identical content always produces the same digest, no
+matter how the dicts were ordered or which process computed it, and no string
+copy of the whole object is ever built.
+'''
+
+import datetime
+import struct
+from bson import ObjectId
+
+
+def update_hash(hasher, value):
+    '''
+    Feed a value into a hash object (as returned by `hashlib`).
+
+    :param hasher: the hash object to update.
+    :param value: the value to feed into it. May be any combination of dicts,
+                  lists, strings, numbers, booleans, `None`, datetimes and
+                  ObjectIds.
+    '''
+    if isinstance(value, dict):
+        hasher.update(b'd' + _length(value))
+        for key in sorted(value):
+            _update_text(hasher, key)
+            update_hash(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b'l' + _length(value))
+        for item in value:
+            update_hash(hasher, item)
+    elif isinstance(value, basestring):
+        hasher.update(b's')
+        _update_text(hasher, value)
+    elif value is None:
+        hasher.update(b'n')
+    elif value is True:
+        hasher.update(b'T')
+    elif value is False:
+        hasher.update(b'F')
+    elif isinstance(value, (int, long)):
+        _update_tagged(hasher, b'i', str(value))
+    elif isinstance(value, float):
+        _update_tagged(hasher, b'f', repr(value))
+    elif isinstance(value, datetime.datetime):
+        _update_tagged(hasher, b't', value.isoformat())
+    elif isinstance(value, ObjectId):
+        _update_tagged(hasher, b'o', str(value))
+    else:
+        _update_tagged(hasher, b'r', repr(value))
+
+
+def update_hash_merged(hasher, original, updates, skip=None):
+    '''
+    Feed the result of merging `updates` into `original` into a hash object
+    without building the merged dict. Nested dicts are merged the same way Eve
+    merges them on `PATCH`.
+
+    :param hasher: the hash object to update.
+    :param original: the original dict.
+    :param updates: the dict of updated values.
+    :param skip: optional function that returns `True` for top-level keys that
+                 should be left out.
+    '''
+    keys = set(original)
+    keys.update(updates)
+    if skip is not None:
+        keys = [key for key in keys if not skip(key)]
+    hasher.update(b'd' + _length(keys))
+    for key in sorted(keys):
+        _update_text(hasher, key)
+        if key not in updates:
+            update_hash(hasher, original[key])
+        elif isinstance(updates[key], dict) \
+                and isinstance(original.get(key, None), dict):
+            update_hash_merged(hasher, original[key], updates[key])
+        else:
+            update_hash(hasher, updates[key])
+
+
+def _update_text(hasher, text):
+    # `str` and `unicode` are hashed the same way so that a value hashes the
+    # same whether it came from the database or from a request
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    elif not isinstance(text, str):
+        text = str(text)
+    hasher.update(_length(text) + text)
+
+
+def _update_tagged(hasher, tag, text):
+    hasher.update(tag + _length(text) + text)
+
+
+def _length(value):
+    return struct.pack('>I', len(value))
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+'''
+Data layer
+
+Extends Eve's MongoDB data layer so that the shadow collections used for
+document versioning store deltas instead of full copies.
+
+Every `VERSION_KEYFRAME_INTERVAL` versions (10 by default), a full copy of the
+document is stored as a keyframe. Every other version is stored as a delta
+(see `piss.delta`) against the version before it. Reads from the shadow
+collection rebuild each version from the nearest keyframe, so they never have
+to apply more than `VERSION_KEYFRAME_INTERVAL - 1` deltas. Shadow documents
+written before deltas were introduced are full copies, so they are read as
+keyframes.
+
+Versions that have been moved to the archive by `piss.retention` are read from
+the archive collection when they aren't found in the shadow collection.
+'''
+
+import zlib
+import bson
+from flask import current_app, abort
+from eve.io.mongo import Mongo
+from eve.utils import config
+from eve.versioning import versioned_id_field
+from .delta import make_delta, apply_delta
+
+DELTA_FIELD = '_delta'
+ARCHIVE_SUFFIX = '_archive'
+ARCHIVE_DATA_FIELD = '_data'
+
+
+class PissMongo(Mongo):
+    def insert(self, resource, doc_or_docs):
+        if is_versions_resource(resource):
+            if isinstance(doc_or_docs, list):
+                doc_or_docs = [self._compress_version(resource, d)
+                               for d in doc_or_docs]
+            else:
+                doc_or_docs = self._compress_version(resource, doc_or_docs)
+        return super(PissMongo, self).insert(resource, doc_or_docs)
+
+    def find(self, resource, req, sub_resource_lookup):
+        cursor = super(PissMongo, self).find(resource, req, sub_resource_lookup)
+        if is_versions_resource(resource):
+            return VersionCursor(cursor, self._versions_collection(resource))
+        return cursor
+
+    def find_one(self, resource, req, **lookup):
+        document = super(PissMongo, self).find_one(resource, req, **lookup)
+        if is_versions_resource(resource):
+            if document:
+                document = materialize_version(
+                    self._versions_collection(resource), document)
+            else:
+                # The version may have been moved to the archive
+                document = read_archived_version(
+                    self._archive_collection(resource), lookup)
+        return document
+
+    def remove(self, resource, lookup):
+        super(PissMongo, self).remove(resource, lookup)
+        if is_versions_resource(resource):
+            self._archive_collection(resource).remove(lookup)
+
+    def _datasource_ex(self, resource, *args, **kwargs):
+        # Make sure deltas aren't left out by the projection of the shadow
+        # collection, which only lists the fields in the schema
+        datasource, filter_, projection, sort = \
+            super(PissMongo, self)._datasource_ex(resource, *args, **kwargs)
+        if is_versions_resource(resource) and projection \
+                and 1 in projection.values():
+            projection = dict(projection)
+            projection[DELTA_FIELD] = 1
+        return datasource, filter_, projection, sort
+
+    def ensure_indexes(self):
+        '''
+        Index the shadow and archive collections of every versioned resource,
+        so that looking up a version (and the deltas before it) doesn't scan
+        the collection.
+        '''
+        for resource, settings in config.DOMAIN.items():
+            if settings.get('versioning', False):
+                ensure_version_indexes(
+                    self.driver.db, config.SOURCES[resource]['source'] +
+                    config.VERSIONS)
+
+    def _versions_collection(self, resource):
+        return self.driver.db[config.SOURCES[resource]['source']]
+
+    def _archive_collection(self, resource):
+        return self.driver.db[config.SOURCES[resource]['source'] + ARCHIVE_SUFFIX]
+
+    def _compress_version(self, resource, document):
+        '''
+        Turn a shadow document into a delta against the previous version,
+        unless it's due to be stored as a keyframe.
+        '''
+        version = document[config.VERSION]
+        interval = current_app.config.get('VERSION_KEYFRAME_INTERVAL', 10)
+        if interval <= 1 or (version - 1) % interval == 0:
+            return document
+        collection = self._versions_collection(resource)
+        previous = collection.find_one({
+            versioned_id_field(): document[versioned_id_field()],
+            config.VERSION: version - 1
+        })
+        if not previous:
+            # Nothing to diff against, so store a keyframe
+            return document
+        previous = materialize_version(collection, previous)
+        return {
+            versioned_id_field(): document[versioned_id_field()],
+            config.VERSION: version,
+            DELTA_FIELD: make_delta(strip_version_fields(previous),
+                                    strip_version_fields(document))
+        }
+
+
+class VersionCursor(object):
+    '''
+    Wraps a cursor on a shadow collection and rebuilds each version as it's
+    read. When versions are read in order, each one is built from the one
+    before it rather than from the keyframe.
+    '''
+    def __init__(self, cursor, collection):
+        self._cursor = cursor
+        self._collection = collection
+
+    def __iter__(self):
+        last = None
+        for document in self._cursor:
+            if DELTA_FIELD in document and last is not None \
+                    and last[config.VERSION] == document[config.VERSION] - 1:
+                document = apply_version_delta(last, document)
+            else:
+                document = materialize_version(self._collection, document)
+            last = document
+            # Eve modifies the documents it reads from the shadow collection,
+            # so hand out a copy and keep ours intact
+            yield dict(document)
+
+    def __getitem__(self, index):
+        return materialize_version(self._collection, self._cursor[index])
+
+    def count(self, *args, **kwargs):
+        return self._cursor.count(*args, **kwargs)
+
+
+def materialize_version(collection, document):
+    '''
+    Rebuild a full version from a shadow document by applying the deltas
+    since the nearest keyframe.
+
+    :param collection: the shadow collection.
+    :param document: the shadow document for the version.
+    '''
+    if DELTA_FIELD not in document:
+        return document
+    chain = [document]
+    previous = collection.find({
+        versioned_id_field(): document[versioned_id_field()],
+        config.VERSION: {'$lt': document[config.VERSION]}
+    }).sort(config.VERSION, -1)
+    for shadow in previous:
+        chain.append(shadow)
+        if DELTA_FIELD not in shadow:
+            break
+    else:
+        abort(500, description='No keyframe found for version %d of %s'
+              % (document[config.VERSION], document[versioned_id_field()]))
+    version = chain.pop()
+    while chain:
+        version = apply_version_delta(version, chain.pop())
+    return version
+
+
+def apply_version_delta(previous, document):
+    '''
+    Apply the delta in a shadow document to the version before it.
+    '''
+    version = apply_delta(previous, document[DELTA_FIELD])
+    for field in (config.ID_FIELD, config.VERSION):
+        if field in document:
+            version[field] = document[field]
+    return version
+
+
+def strip_version_fields(document):
+    '''
+    Return a copy of a shadow document without the fields that identify it,
+    which are never part of a delta.
+    '''
+    return dict((k, v) for k, v in document.items() if k not in
+                (config.ID_FIELD, config.VERSION, versioned_id_field(),
+                 DELTA_FIELD))
+
+
+def ensure_version_indexes(db, versions_source):
+    '''
+    Index a shadow collection and its archive by versioned ID and version.
+
+    :param db: the database.
+    :param versions_source: the name of the shadow collection.
+    '''
+    index = [(versioned_id_field(), 1), (config.VERSION, 1)]
+    db[versions_source].ensure_index(index)
+    db[versions_source + ARCHIVE_SUFFIX].ensure_index(index, unique=True)
+
+
+def is_versions_resource(resource):
+    return resource.endswith(config.VERSIONS) \
+        and resource[:-len(config.VERSIONS)] in config.DOMAIN
+
+
+def read_archived_version(archive, lookup):
+    '''
+    Find an archived version and return it as a shadow document, or `None` if
+    it isn't in the archive.
+
+    :param archive: the archive collection.
+    :param lookup: dict with the versioned ID and version number to find.
+    '''
+    archived = archive.find_one(lookup)
+    if not archived:
+        return None
+    # Flask-PyMongo connects with `tz_aware=True`, so do the same here
+    document = bson.BSON(zlib.decompress(archived[ARCHIVE_DATA_FIELD])) \
+        .decode(tz_aware=True)
+    document[versioned_id_field()] = archived[versioned_id_field()]
+    document[config.VERSION] = archived[config.VERSION]
+    return document
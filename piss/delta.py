@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+'''
+Deltas
+
+Computes and applies the difference between two documents as a list of
+[JSON Patch](https://tools.ietf.org/html/rfc6902) operations. Nested dicts
+are diffed key by key and lists are replaced as a whole.
+
+Long strings that only changed in one place (the usual case when editing an
+article) use an extra `splice` operation instead of `replace`, so the delta
+only holds the text that changed:
+
+    {"op": "splice", "path": "/content/text", "offset": 120, "remove": 4,
+     "value": "new text"}
+'''
+
+import copy
+
+# Strings shorter than this are always replaced as a whole
+MIN_SPLICE_LENGTH = 64
+
+
+def make_delta(src, dst):
+    '''
+    Return a list of operations that turns `src` into `dst`.
+
+    :param src: the old version of the document.
+    :param dst: the new version of the document.
+    '''
+    ops = []
+    _diff_dict(src, dst, '', ops)
+    return ops
+
+
+def apply_delta(document, ops):
+    '''
+    Apply a list of operations created by `make_delta` and return the
+    resulting document. The given document is not modified.
+
+    :param document: the document to apply the operations to.
+    :param ops: the list of operations.
+    '''
+    document = copy.deepcopy(document)
+    for op in ops:
+        parent, key = _resolve(document, op['path'])
+        if op['op'] == 'remove':
+            del parent[key]
+        elif op['op'] in ('add', 'replace'):
+            parent[key] = copy.deepcopy(op['value'])
+        elif op['op'] == 'splice':
+            text = parent[key]
+            offset = op['offset']
+            parent[key] = text[:offset] + op['value'] + \
+                text[offset + op['remove']:]
+        else:
+            raise ValueError('Unknown delta operation: %s' % (op['op'],))
+    return document
+
+
+def _diff_dict(src, dst, path, ops):
+    for key in sorted(src):
+        if key not in dst:
+            ops.append({'op': 'remove', 'path': _pointer(path, key)})
+    for key in sorted(dst):
+        key_path = _pointer(path, key)
+        if key not in src:
+            ops.append({'op': 'add', 'path': key_path, 'value': dst[key]})
+            continue
+        old, new = src[key], dst[key]
+        if isinstance(old, dict) and isinstance(new, dict):
+            _diff_dict(old, new, key_path, ops)
+        elif _equal(old, new):
+            continue
+        elif isinstance(old, basestring) and isinstance(new, basestring):
+            ops.append(_diff_string(old, new, key_path))
+        else:
+            ops.append({'op': 'replace', 'path': key_path, 'value': new})
+
+
+def _equal(old, new):
+    if type(old) != type(new) and not (isinstance(old, basestring) and
+                                       isinstance(new, basestring)):
+        return False
+    try:
+        return old == new
+    except TypeError:
+        # e.g. comparing timezone aware and naive datetimes
+        return False
+
+
+def _diff_string(old, new, path):
+    if len(new) < MIN_SPLICE_LENGTH:
+        return {'op': 'replace', 'path': path, 'value': new}
+    # Find the common prefix and suffix of both strings
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old[-end - 1] == new[-end - 1]:
+        end += 1
+    value = new[start:len(new) - end]
+    if len(value) * 2 > len(new):
+        # Most of the string changed anyway
+        return {'op': 'replace', 'path': path, 'value': new}
+    return {'op': 'splice', 'path': path, 'offset': start,
+            'remove': len(old) - end - start, 'value': value}
+
+
+def _pointer(path, key):
+    return '%s/%s' % (path, key.replace('~', '~0').replace('/', '~1'))
+
+
+def _resolve(document, path):
+    keys = [k.replace('~1', '/').replace('~0', '~')
+            for k in path.split('/')[1:]]
+    parent = document
+    for key in keys[:-1]:
+        parent = parent[key]
+    return parent, keys[-1]
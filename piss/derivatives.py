@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+'''
+Image derivatives
+
+Image attachments can be requested at a smaller size and in another format
+by adding `w` (maximum width), `h` (maximum height) and `fmt` (`jpeg`, `png`
+or `webp`) to their URL, e.g. `/attachments/<digest>?w=200`. Images are
+scaled down to fit, keeping their aspect ratio, and never scaled up.
+
+Only the sizes in `DERIVATIVE_SIZES` (64, 128, 256, 512, 1024 and 2048 pixels
+by default) and in `DERIVATIVE_PRESETS` are generated, so that a single
+image can't be turned into any number of derivatives. Requests for another
+size are redirected to the next size up, or the biggest one.
+
+Derivatives are generated by a pool of `DERIVATIVE_WORKERS` processes (2 by
+default), so that decoding and resizing large images doesn't hold up the
+worker serving the request for any longer than it has to, and at most that
+many images are being resized at once. They're written to the instance's
+`derivatives` folder, in a directory named after the digest of the original,
+and are reused by every later request:
+
+    derivatives/b/f/8/bf8854.../200x0.jpeg
+
+Requests for a derivative that's already being generated wait for the same
+job instead of starting another one. Requests that wait for longer than
+`DERIVATIVE_TIMEOUT` seconds (30 by default) get a `503`.
+
+Uploads can ask for the derivatives listed in `DERIVATIVE_PRESETS` to be
+generated straight away, e.g.:
+
+    DERIVATIVE_PRESETS = [{'w': 200, 'h': 200}, {'w': 800, 'fmt': 'webp'}]
+
+Derivatives are deleted along with their original by the attachment
+collector. Generating them requires Pillow.
+'''
+
+import os
+import errno
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from flask import abort, current_app, redirect, request
+from werkzeug.urls import url_encode
+from .file_io import open_attachment, get_temp_path, ONE_MB
+from .storage import get_tree_path, remove_empty_dirs
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Content types that can be resized, and the formats derivatives can be in
+IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+FORMATS = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp'
+}
+JPEG_QUALITY = 85
+
+# The sizes derivatives can have, besides the ones in `DERIVATIVE_PRESETS`
+DERIVATIVE_SIZES = (64, 128, 256, 512, 1024, 2048)
+
+_pool = None
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class DerivativeSpec(object):
+    '''
+    The size and format of a derivative.
+
+    :param width: the maximum width in pixels, or `None`.
+    :param height: the maximum height in pixels, or `None`.
+    :param fmt: one of the keys of `FORMATS`.
+    '''
+    def __init__(self, width, height, fmt):
+        self.width = width
+        self.height = height
+        self.fmt = fmt
+
+    @property
+    def name(self):
+        return '%dx%d.%s' % (self.width or 0, self.height or 0, self.fmt)
+
+    @property
+    def content_type(self):
+        return FORMATS[self.fmt]
+
+
+def get_derivative_spec(args, content_type):
+    '''
+    Return the `DerivativeSpec` asked for in the query string of a request, or
+    `None` if the original was asked for. Aborts with a `400` if the
+    parameters are invalid or the attachment isn't an image, or with a
+    redirect to the next size in `get_derivative_sizes` if the size asked
+    for isn't one of them.
+
+    :param args: the request's query string arguments.
+    :param content_type: the content type of the original.
+    '''
+    if not any(key in args for key in ('w', 'h', 'fmt')):
+        return None
+    if content_type not in IMAGE_TYPES:
+        abort(400, 'Only images have derivatives.')
+    allowed = get_derivative_sizes()
+    sizes = []
+    redirect_args = None
+    for key in ('w', 'h'):
+        value = args.get(key, None)
+        if value is None:
+            sizes.append(None)
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            abort(400, 'Invalid `%s`.' % (key,))
+        if value <= 0:
+            abort(400, '`%s` must be a positive number.' % (key,))
+        if value not in allowed:
+            if redirect_args is None:
+                redirect_args = args.copy()
+            redirect_args[key] = str(next((size for size in allowed if size > value),
+                                          allowed[-1]))
+        sizes.append(value)
+    if redirect_args is not None:
+        abort(redirect('%s?%s' % (request.base_url, url_encode(redirect_args))))
+    fmt = args.get('fmt', None) or default_format(content_type)
+    fmt = fmt.lower().replace('jpg', 'jpeg')
+    if fmt not in FORMATS:
+        abort(400, 'Unsupported format.')
+    return DerivativeSpec(sizes[0], sizes[1], fmt)
+
+
+def get_derivative_sizes():
+    '''
+    Return the sizes derivatives can have, smallest first: the ones in
+    `DERIVATIVE_SIZES` and the ones used by `DERIVATIVE_PRESETS`.
+    '''
+    sizes = set(current_app.config.get('DERIVATIVE_SIZES', DERIVATIVE_SIZES))
+    for preset in current_app.config.get('DERIVATIVE_PRESETS', None) or []:
+        sizes.update(preset[key] for key in ('w', 'h') if preset.get(key, None))
+    return sorted(sizes)
+
+
+def default_format(content_type):
+    for fmt, format_type in FORMATS.items():
+        if format_type == content_type:
+            return fmt
+    return 'png'
+
+
+def get_derivatives_path():
+    return os.path.join(current_app.instance_path, 'derivatives')
+
+
+def get_derivative_dir(digest):
+    return os.path.join(get_tree_path(get_derivatives_path(), digest), digest)
+
+
+def get_derivative(digest, spec, wait=True):
+    '''
+    Return the path of a derivative, generating it first if needed. Aborts
+    with a `404` if the original isn't stored, a `415` if it can't be decoded,
+    or a `503` if generating it takes too long.
+
+    :param digest: the digest of the original.
+    :param spec: a `DerivativeSpec`.
+    :param wait: whether to wait for the derivative to be generated. If not,
+                 `None` is returned straight away.
+    '''
+    path = os.path.join(get_derivative_dir(digest), spec.name)
+    if os.path.exists(path):
+        return path
+    if Image is None:
+        abort(501, 'Pillow is required for image derivatives.')
+
+    with _jobs_lock:
+        # Forget finished jobs, including those nobody waited for
+        for key in [key for key, job in _jobs.items() if job.ready()]:
+            del _jobs[key]
+        job = _jobs.get(path, None)
+        if job is None:
+            if os.path.exists(path):
+                return path
+            source, temporary = get_source(digest)
+            job = get_pool().apply_async(
+                render_derivative,
+                (source, path, spec.width, spec.height, spec.fmt, temporary))
+            _jobs[path] = job
+    if not wait:
+        return None
+
+    try:
+        job.get(current_app.config.get('DERIVATIVE_TIMEOUT', 30))
+    except multiprocessing.TimeoutError:
+        abort(503)
+    except IOError:
+        # Pillow couldn't identify the image
+        abort(415)
+    return path
+
+
+def get_source(digest):
+    '''
+    Return the path of the original file for the worker processes to read,
+    and whether it's a temporary copy that they should delete. Files stored in
+    packs or chunks are copied to the instance's `tmp` folder first.
+    '''
+    blob = open_attachment(digest)
+    if blob is None:
+        abort(404)
+    if blob.path:
+        return blob.path, False
+    temp_path = get_temp_path()
+    if not os.path.isdir(temp_path):
+        os.makedirs(temp_path)
+    with tempfile.NamedTemporaryFile(dir=temp_path, prefix='derivative-',
+                                     delete=False) as f:
+        for data in blob.iter_range(0, blob.size, ONE_MB):
+            f.write(data)
+    return f.name, True
+
+
+def get_pool():
+    '''
+    Return this process's pool of derivative workers, starting it on first
+    use so that every web server worker gets its own.
+    '''
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(
+            current_app.config.get('DERIVATIVE_WORKERS', 2),
+            maxtasksperchild=100)
+    return _pool
+
+
+def pregenerate_derivatives(attachment):
+    '''
+    Start generating the derivatives in `DERIVATIVE_PRESETS` for an uploaded
+    attachment, without waiting for them.
+
+    :param attachment: an attachments object.
+    '''
+    if attachment['content_type'] not in IMAGE_TYPES or Image is None:
+        return
+    for preset in current_app.config.get('DERIVATIVE_PRESETS', []):
+        spec = get_derivative_spec(preset, attachment['content_type'])
+        if spec is not None:
+            get_derivative(attachment['digest'], spec, wait=False)
+
+
+def delete_derivatives(digest):
+    '''
+    Delete every derivative of an attachment.
+    '''
+    shutil.rmtree(get_derivative_dir(digest), ignore_errors=True)
+
+
+def remove_empty_derivative_dirs():
+    return remove_empty_dirs(get_derivatives_path())
+
+
+def render_derivative(source, path, width, height, fmt, temporary=False):
+    '''
+    Resize an image and save it to `path`. Runs in the worker processes.
+
+    :param source: the path of the original.
+    :param path: the path of the derivative.
+    :param width: the maximum width in pixels, or `None`.
+    :param height: the maximum height in pixels, or `None`.
+    :param fmt: one of the keys of `FORMATS`.
+    :param temporary: whether to delete `source` afterwards.
+    '''
+    try:
+        image = Image.open(source)
+        size = (width or image.size[0], height or image.size[1])
+        if image.format == 'JPEG':
+            # Let the decoder skip detail that's about to be thrown away
+            image.draft('RGB', size)
+        image.thumbnail(size, Image.ANTIALIAS)
+        if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.tmp-',
+                                         delete=False) as f:
+            try:
+                image.save(f, fmt.upper(), quality=JPEG_QUALITY)
+            except Exception:
+                os.unlink(f.name)
+                raise
+        os.rename(f.name, path)
+    finally:
+        if temporary:
+            os.unlink(source)
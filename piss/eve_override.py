@@ -5,6 +5,7 @@ from flask import request, render_template, abort, url_for, make_response
 from eve.methods import get, getitem
 from eve.render import raise_event
 from .decorators import html_renderer_for
+from .response_cache import cached_view
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 ROOT_DIR = os.path.dirname(CURRENT_DIR)
@@ -46,9 +47,9 @@ def eve_override(app):
         if func_name == 'home':
             app.view_functions[key] = home_wrapper
         elif func_name == 'resource':
-            app.view_functions[key] = resource_wrapper
+            app.view_functions[key] = cached_view(resource_wrapper)
         elif func_name == 'item_lookup' or func_name == 'item_additional_lookup':
-            app.view_functions[key] = item_lookup_wrapper
+            app.view_functions[key] = cached_view(item_lookup_wrapper)
 
     # Override Eve's error handler functions
     for code in app.error_handler_spec[None]:
@@ -5,51 +5,65 @@ import hashlib
 import json
 from eve.methods.post import post_internal
 from eve.render import send_response
+from eve.utils import config
 from flask import current_app, request, abort, url_for, Response, g
 from hawk.hcrypto import random_string
 from hawk.client import get_bewit as hawk_get_bewit
-from .utils import NewBase60, is_collection_request
+from .utils import is_collection_request
 from .file_io import save_attachment
+from .auth import forget_credentials
+from .canonical import update_hash_merged
+from .post_ids import allocate_post_ids, get_request_resolution, \
+    forget_resolution
+from .attachment_index import index_post_attachments, remove_attachment_refs
+from .derivatives import pregenerate_derivatives
+from .response_cache import invalidate_responses
 
 # Bewits are good for 1 hour
 BEWIT_TTL = 60 * 60
 
 def before_insert_posts(documents):
+    '''
+    Add version information and IDs to new posts. `documents` may hold any
+    number of posts when a list is `POST`ed, so anything that doesn't depend
+    on a particular document is worked out once, and the credentials posts
+    needed by app posts are created with a single insert.
+    '''
     meta_post = current_app.config.get('META_POST')
     posts_endpoint = meta_post['server']['urls']['posts_feed']
     app_type = str(url_for('server_info.types_item', name='app', _external=True))
     credentials_type = str(url_for('server_info.types_item', name='credentials', _external=True))
-    
+
+    time_seconds = int(time.time())
+    app_posts = []
+    credentials_posts = []
+
+    # Allocate all of the IDs for the batch at once. Since credentials posts
+    # are created automatically by the server, their IDs are in microseconds.
+    credentials_documents = [d for d in documents if d['type'] == credentials_type]
+    other_documents = [d for d in documents if d['type'] != credentials_type]
+    for batch, resolution in ((credentials_documents, 'microsecond'),
+                              (other_documents, get_request_resolution())):
+        if batch:
+            for document, post_id in zip(batch, allocate_post_ids(resolution, len(batch))):
+                document['_id'] = post_id
+
     for document in documents:
         # Create version information, but save app version data if present
-        current_time = time.time()
-        time_seconds = int(current_time)
-        time_millisec = int(current_time * 1000)
-        time_microsec = int(current_time * 1000000)
         app_version = get_app_version(document)
         digest = create_version_digest(document)
-        document['version'] = create_version_document(digest, time_millisec, app_version)
-        
-        # Create an ID for the document
-        if document['type'] == credentials_type:
-            # Since credentials posts are created automatically by the server,
-            # we need to specify their IDs in microseconds
-            document['_id'] = str(NewBase60(time_microsec))
-        else:
-            document['_id'] = str(NewBase60(time_seconds))
+        document['version'] = create_version_document(digest, time_seconds, app_version)
         
         # Additional processing for certain post types
         if document['type'] == app_type:
             # For app posts, we must create an additional credentials post
             # and make sure they link to each other
-            hawk_key = str(random_string(64))
-            hawk_algorithm = 'sha256'
             credentials_post = {
                 'entity': str(meta_post['entity']),
                 'type': credentials_type,
                 'content': {
-                    'hawk_key': hawk_key,
-                    'hawk_algorithm': hawk_algorithm
+                    'hawk_key': str(random_string(64)),
+                    'hawk_algorithm': 'sha256'
                 },
                 'links': [
                     {
@@ -59,42 +73,118 @@ def before_insert_posts(documents):
                     }
                 ]
             }
-            response, _, _, status = post_internal('posts', credentials_post)
-            if not 'links' in document:
-                document['links'] = []
-            cred_id = str(response['_id'])
-            cred_url = str(posts_endpoint + "/" + cred_id)
-            document['links'].append({
-                    'post': cred_id,
-                    'url': cred_url,
-                    'type': credentials_type
-                })
-            # Create a signal to change the POST response envelope
-            g.app_POST = True
-            credentials = {
-                'id': cred_id,
-                'key': hawk_key,
-                'algorithm': hawk_algorithm
-            }
-            g.cred_bewit_url = cred_url + '?bewit=' + hawk_get_bewit(cred_url, {'credentials': credentials, 'ttl_sec': BEWIT_TTL})
+            app_posts.append(document)
+            credentials_posts.append(credentials_post)
+
+    if not credentials_posts:
+        return
+
+    response, _, _, status = post_internal('posts', credentials_posts)
+    if status != 201:
+        abort(500, description='Could not create credentials for app posts.')
+    if len(credentials_posts) == 1:
+        responses = [response]
+    else:
+        responses = response['_items']
+
+    # Create a signal to change the POST response envelope
+    g.app_POST = True
+    g.cred_bewit_urls = []
+    for document, credentials_post, response in zip(app_posts, credentials_posts, responses):
+        if not 'links' in document:
+            document['links'] = []
+        cred_id = str(response['_id'])
+        cred_url = str(posts_endpoint + "/" + cred_id)
+        document['links'].append({
+                'post': cred_id,
+                'url': cred_url,
+                'type': credentials_type
+            })
+        credentials = {
+            'id': cred_id,
+            'key': credentials_post['content']['hawk_key'],
+            'algorithm': credentials_post['content']['hawk_algorithm']
+        }
+        bewit = hawk_get_bewit(cred_url, {'credentials': credentials, 'ttl_sec': BEWIT_TTL})
+        g.cred_bewit_urls.append((str(posts_endpoint + "/" + document['_id']),
+                                  cred_url + '?bewit=' + bewit))
 
 def before_update_posts(updates, original):
-    # Create an updated version of the original *without* the `version` field,
-    # but save app version data if present
+    # Drop cached credentials and resolutions in case this is a credentials
+    # or app post
+    forget_credentials(original['_id'])
+    forget_resolution(original['_id'])
+
+    # Create version information for the updated post *without* the `version`
+    # field, but save app version data if present. The digest is computed
+    # straight from the original and the updates, without merging them.
     current_time = int(time.time())
     app_version = get_app_version(updates)
-    updated = original.copy()
-    updated.update(updates)
-    try:
-        del(updated['version'])
-    except KeyError as e:
-        # Weird that it didn't have it, but just as well
-        pass
-    
-    # Create version information and append it to the updates
-    digest = create_version_digest(updated)
+    hasher = hashlib.sha512()
+    update_hash_merged(hasher, original, updates, skip=is_unversioned_field)
+    digest = format_version_digest(hasher)
+
+    # If the content hasn't changed, there's no reason to write a new version.
+    # Stop here and respond as if the post had been updated.
+    if digest == original.get('version', {}).get('id', None):
+        response = {
+            config.ID_FIELD: original[config.ID_FIELD],
+            config.LAST_UPDATED: original[config.LAST_UPDATED],
+            config.STATUS: config.STATUS_OK
+        }
+        etag = original.get(config.ETAG, None)
+        if etag:
+            response[config.ETAG] = etag
+        if config.VERSION in original:
+            response[config.VERSION] = original[config.VERSION]
+        abort(send_response('posts', (response, original[config.LAST_UPDATED], etag, 200)))
+
+    # Append the version information to the updates
     updates['version'] = create_version_document(digest, current_time, app_version)
 
+def after_inserted_posts(documents):
+    '''
+    Drop cached credentials for new posts (an ID may have been cached as
+    unknown before a credentials post was created with it) and index their
+    attachments.
+    '''
+    for document in documents:
+        forget_credentials(document['_id'])
+        index_post_attachments(document)
+    invalidate_responses('posts')
+
+def after_updated_posts(updates, original):
+    invalidate_responses('posts', original['_id'])
+    # The attachment index also tracks whether posts are public
+    if 'attachments' in updates or 'permissions' in updates:
+        post = dict(original)
+        post.update(updates)
+        if isinstance(original.get('permissions', None), dict) \
+                and isinstance(updates.get('permissions', None), dict):
+            # Eve merges nested dicts on `PATCH`
+            post['permissions'] = dict(original['permissions'])
+            post['permissions'].update(updates['permissions'])
+        index_post_attachments(post, original)
+
+def before_replace_posts(document, original):
+    forget_credentials(original['_id'])
+    forget_resolution(original['_id'])
+
+def after_replaced_posts(document, original):
+    invalidate_responses('posts', original['_id'])
+    post = dict(document)
+    post['_id'] = original['_id']
+    index_post_attachments(post, original)
+
+def before_delete_item_posts(original):
+    forget_credentials(original['_id'])
+    forget_resolution(original['_id'])
+
+def after_deleted_item_posts(original):
+    invalidate_responses('posts', original['_id'])
+    # Every version of the post is gone, so its attachments may be collected
+    remove_attachment_refs(original['_id'])
+
 def after_fetched_item_posts(response):
     '''
     Inspect an item after it has been fetched and reject the request if a 
@@ -132,6 +222,10 @@ def before_POST_posts(request):
         for key in request.files:
             file = request.files[key]
             attachments.append(save_attachment(file))
+            # `?derivatives=true` asks for the resized images in
+            # `DERIVATIVE_PRESETS` to be generated straight away
+            if request.args.get('derivatives', None) == 'true':
+                pregenerate_derivatives(attachments[-1])
         
         if attachments:
             payload['attachments'] = attachments
@@ -148,15 +242,16 @@ def after_POST_posts(request, payload):
     database. Primarily used to change the response envelope depending on the
     post type.
     '''
-    meta_post = current_app.config.get('META_POST')
-    
-    # TODO: Code below needs to account for when the payload is a list
+    # When a list of posts is sent, there is one credentials link per app post.
+    # The `anchor` parameter tells the client which app post it belongs to.
     if payload.status_code == 201 and getattr(g, 'app_POST', False):
-        link_header = ''
         credentials_type = str(url_for('server_info.types_item', name='credentials', _external=True))
+        links = []
         if 'Link' in payload.headers:
-            link_header = '%s,' % (payload.headers['Link'],)
-        payload.headers['Link'] = link_header + '<%s>; rel="%s"' % (getattr(g, 'cred_bewit_url'), credentials_type)
+            links.append(payload.headers['Link'])
+        for app_url, bewit_url in getattr(g, 'cred_bewit_urls', []):
+            links.append('<%s>; rel="%s"; anchor="%s"' % (bewit_url, credentials_type, app_url))
+        payload.headers['Link'] = ','.join(links)
 
 def before_GET_posts(request, lookup):
     '''
@@ -188,10 +283,21 @@ def is_public_post(post):
     return 'permissions' in post and post['permissions'].get('public', False)
 
 def create_version_digest(document):
+    '''
+    Hash the contents of a post. Fields that are set by Eve or the server
+    (`_id`, `_created`, `version`, etc.) are left out, so identical content
+    always gets the same version ID.
+    '''
     hasher = hashlib.sha512()
-    hasher.update(str(document))
+    update_hash_merged(hasher, document, {}, skip=is_unversioned_field)
+    return format_version_digest(hasher)
+
+def format_version_digest(hasher):
     # Hex-encoded first 256 bits of the SHA-512
-    return hex(int(hasher.hexdigest(), 16) >> 256)
+    return hasher.hexdigest()[:64]
+
+def is_unversioned_field(key):
+    return key == 'version' or key.startswith('_')
 
 def create_version_document(digest, current_time, app_version):
     version_document = {}
@@ -1,78 +1,210 @@
 # -*- coding: utf-8 -*-
 
 import os
+import errno
 import shutil
 import hashlib
-from flask import current_app
+import tempfile
+from flask import current_app, Request
 from werkzeug import secure_filename
+from .storage import get_pack_storage
 
 ONE_MB = 1024 * 1024
 
+class UploadRequest(Request):
+    '''
+    Request class that streams file uploads straight into temporary files in
+    the instance's `tmp` folder, hashing them as they're written, instead of
+    letting Werkzeug buffer them in memory or in an anonymous temporary file.
+    '''
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return HashingFile(get_temp_path())
+
+class HashingFile(object):
+    '''
+    A uniquely named temporary file that keeps a running SHA-512 and size of
+    everything written to it. Werkzeug only ever writes uploads sequentially,
+    so the digest is ready as soon as the upload has been parsed.
+
+    If the file hasn't been moved with `commit` by the time it's closed (which
+    Flask does at the end of every request), it's deleted.
+    '''
+    def __init__(self, dir):
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        self.file = tempfile.NamedTemporaryFile(dir=dir, prefix='upload-',
+                                                delete=False)
+        self.hasher = hashlib.sha512()
+        self.size = 0
+        self.committed = False
+
+    @classmethod
+    def from_path(cls, path):
+        '''
+        Wrap a file that was written some other way (e.g. by an upload
+        session), hashing its contents in one pass. The file is then consumed
+        by `commit` or `close` like any other upload.
+
+        :param path: the path of the file, which should be in the instance's
+                     `tmp` folder.
+        '''
+        stream = cls.__new__(cls)
+        stream.file = open(path, 'rb')
+        stream.hasher = hashlib.sha512()
+        stream.size = 0
+        stream.committed = False
+        while True:
+            data = stream.file.read(ONE_MB)
+            if not data:
+                break
+            stream.hasher.update(data)
+            stream.size += len(data)
+        return stream
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    @property
+    def digest(self):
+        return format_file_digest(self.hasher)
+
+    def commit(self, path):
+        '''
+        Move the file to its final location, unless a file is already there.
+        Either way, the temporary file is gone afterwards.
+
+        :param path: the final path of the file.
+        '''
+        self.file.close()
+        if os.path.exists(path):
+            try:
+                # Mark the file as recently used so that the attachment
+                # collector leaves it alone until its new post is saved
+                os.utime(path, None)
+                os.unlink(self.file.name)
+                self.committed = True
+                return
+            except OSError:
+                # Collected in the meantime, so store this copy instead
+                pass
+        try:
+            os.rename(self.file.name, path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # First file in this directory, or the collector removed the
+            # empty directory in the meantime
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.rename(self.file.name, path)
+        self.committed = True
+
+    def close(self):
+        self.file.close()
+        if not self.committed:
+            try:
+                os.unlink(self.file.name)
+            except OSError:
+                pass
+            self.committed = True
+
 def save_attachment(file):
     '''
     Saves a file upload to the server and returns an attachments object.
+
+    Uploads parsed by `UploadRequest` have already been written to a temporary
+    file and hashed, so all that's left is to hand the file to the storage
+    backend. Any other upload is copied into a temporary file first. If a file
+    with the same digest already exists, the upload is discarded.
     '''
-    attachments_path = get_attachments_path()
-    tmp_path = get_temp_path()
-    
+    stream = file.stream
+    if not isinstance(stream, HashingFile):
+        stream = HashingFile(get_temp_path())
+        file.save(stream, buffer_size=ONE_MB)
+    stream.flush()
+
     filename = secure_filename(file.filename)
-    tmp_file = os.path.join(tmp_path, filename)
-    file.save(tmp_file)
-    
-    size = os.stat(tmp_file).st_size
-    digest = get_file_digest(tmp_file)
+    digest = stream.digest
     content_type = file.mimetype if file.mimetype else file.content_type.split(';')[0]
-    
-    tree_path = os.path.join(get_tree_path(attachments_path, digest), digest)
-    shutil.move(tmp_file, tree_path)
+    get_storage().store(stream)
     
     return {
         'content_type': content_type,
         'name': filename,
         'digest': digest,
-        'size': size
+        'size': stream.size
     }
     
-def get_attachment_dir(digest):
+def open_attachment(digest):
     '''
-    Retrieves a directory based on the attachment's digest.
+    Return a `piss.storage.Blob` for the attachment with the given digest, or
+    `None` if it isn't stored.
     '''
-    attachments_path = get_attachments_path()
-    return get_tree_path(attachments_path, digest)
+    return get_storage().open(digest)
 
-def get_attachment_file(digest):
+def delete_attachment(digest):
     '''
-    Retrieves a file based on the attachment's digest.
+    Delete an attachment from storage. Attachments may be shared by several
+    posts, so only the attachment collector should call this; see
+    `piss.attachment_index`.
     '''
-    return os.path.join(get_attachment_dir(digest), digest)
-    
+    return get_storage().delete(digest)
 
-def delete_attachment(attachment_obj):
+def pack_attachments(progress=None):
     '''
-    Delete a file object from the server based on attachment information.
+    Move the loose attachments that are small enough for packs into packs.
+    Each file is checked against its digest on the way. Requires
+    `ATTACHMENT_STORAGE = 'packs'`, with or without chunking.
+
+    :param progress: optional function called with each digest that's moved.
+    :returns: a dict of statistics.
     '''
-    attachments_path = get_attachments_path()
-    digest = attachment_obj['digest']
-    os.unlink(os.path.join(get_tree_path(attachments_path, digest), digest))
+    storage = get_pack_storage(get_storage())
+    stats = {'packed': 0, 'packed_bytes': 0, 'corrupt': [], 'directories': 0}
+    for digest in list(storage.loose.iter_digests()):
+        blob = storage.loose.open(digest)
+        if blob is None or blob.size > storage.max_blob_size:
+            continue
+        stream = HashingFile(get_temp_path())
+        try:
+            with blob.open() as f:
+                shutil.copyfileobj(f, stream, ONE_MB)
+            stream.flush()
+            if stream.digest != digest:
+                stats['corrupt'].append(digest)
+                continue
+            storage.store_packed(stream)
+        finally:
+            stream.close()
+        # The pack is read first, so the loose file can go now
+        storage.loose.delete(digest)
+        if progress:
+            progress(digest)
+        stats['packed'] += 1
+        stats['packed_bytes'] += blob.size
+    stats['directories'] = storage.loose.cleanup()
+    return stats
 
-def get_attachments_path():
+def get_storage():
     '''
-    Get the path where attachments are saved based on the current app context.
+    Get the attachment storage backend of the current app.
     '''
-    return os.path.join(current_app.instance_path, 'attachments')
+    return current_app.attachment_storage
 
-def get_tree_path(base_dir, word, subdirs=3):
+def get_attachments_path():
     '''
-    Get the full path of a directory where the names of the subdirectories are
-    determined based on the characters of a given word.
+    Get the path where attachments are saved based on the current app context.
     '''
-    tree_path = ''
-    for i in range(subdirs):
-        tree_path += word[i] + '/'
-    tree_path = os.path.join(base_dir, tree_path[:-1])
-    if not os.path.isdir(tree_path):
-        os.makedirs(tree_path)
-    return tree_path
+    return os.path.join(current_app.instance_path, 'attachments')
 
 def get_temp_path():
     '''
@@ -81,13 +213,18 @@ def get_temp_path():
     return os.path.join(current_app.instance_path, 'tmp')
 
 def get_file_digest(file_path):
-    with file(file_path, 'r') as f:
+    with file(file_path, 'rb') as f:
         hasher = hashlib.sha512()
         while True:
             r = f.read(ONE_MB)
             if not len(r):
                 break
             hasher.update(r)
+    return format_file_digest(hasher)
+
+def format_file_digest(hasher):
+    '''
+    Format a SHA-512 hash object as an attachment digest.
+    '''
     # Hex-encoded first 256 bits of the SHA-512
     return format((long(hasher.hexdigest(), 16) >> 256), 'x')
-    
\ No newline at end of file
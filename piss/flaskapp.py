@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
 from eve import Eve
 from cerberus import Validator
 from flask.config import Config
 from .utils import NewBase60Encoder, NewBase60Validator
 from .auth import HawkAuth
+from .data import PissMongo
+from .cache import create_cache
+from .type_registry import TypeRegistry
+from .response_cache import create_response_cache
+from .singleflight import create_single_flight
+from .file_io import UploadRequest
+from .storage import create_storage
 from .event_hooks import before_insert_posts, before_update_posts, \
     after_fetched_item_posts, before_GET_posts, before_POST_posts, \
-    after_POST_posts
-from .services import attachments, server_info, syndication
+    after_POST_posts, after_inserted_posts, before_replace_posts, \
+    before_delete_item_posts, after_updated_posts, after_replaced_posts, \
+    after_deleted_item_posts
+from .services import attachments, server_info, syndication, uploads
 from .eve_override import eve_override
 from .jinja_override import jinja_override
 
@@ -33,9 +41,13 @@ def PISS(instance_path):
               json_encoder=NewBase60Encoder, 
               validator=NewBase60Validator,
               auth=HawkAuth,
+              data=PissMongo,
               instance_path=instance_path,
               static_folder=None)
 
+    # Stream file uploads to disk, hashing them on the way
+    app.request_class = UploadRequest
+
     # Update the app's config object with our settings
     app.config.update(**dict(app_config))
 
@@ -46,6 +58,57 @@ def PISS(instance_path):
     app.on_pre_GET_posts += before_GET_posts
     app.on_pre_POST_posts += before_POST_posts
     app.on_post_POST_posts += after_POST_posts
+    app.on_inserted_posts += after_inserted_posts
+    app.on_replace_posts += before_replace_posts
+    app.on_delete_item_posts += before_delete_item_posts
+    app.on_updated_posts += after_updated_posts
+    app.on_replaced_posts += after_replaced_posts
+    app.on_deleted_item_posts += after_deleted_item_posts
+
+    # The caches below are kept in every worker process, unless
+    # `CACHE_BACKEND` is `'shared'`, in which case the workers on the host
+    # share them through this file
+    app.config.setdefault('SHARED_CACHE_PATH',
+                          os.path.join(instance_path, 'tmp', 'shared.cache'))
+
+    # Cache Hawk credentials so that signed requests don't each need a
+    # database lookup. Unless the cache is shared, revoking credentials only
+    # evicts them from the worker that handled the request, and the other
+    # workers keep accepting them until their entry expires, so the TTL is
+    # kept down to a few seconds. Unknown IDs get a cache of their own, so
+    # that requests signed with made-up IDs can't push out valid credentials.
+    shared_caches = app.config.get('CACHE_BACKEND', 'memory') != 'memory'
+    app.credentials_cache = create_cache(
+        app.config, 'credentials',
+        maxsize=app.config.get('CREDENTIALS_CACHE_SIZE', 1024),
+        ttl=app.config.get('CREDENTIALS_CACHE_TTL',
+                           300 if shared_caches else 5))
+    app.unknown_credentials_cache = create_cache(
+        app.config, 'unknown-credentials',
+        maxsize=app.config.get('CREDENTIALS_CACHE_NEGATIVE_SIZE', 1024),
+        ttl=app.config.get('CREDENTIALS_CACHE_NEGATIVE_TTL', 30))
+    app.resolution_cache = create_cache(
+        app.config, 'resolutions',
+        maxsize=app.config.get('CREDENTIALS_CACHE_SIZE', 1024),
+        ttl=app.config.get('CREDENTIALS_CACHE_TTL', 300))
+
+    # Set up the storage backend for attachments
+    app.attachment_storage = create_storage(app.config, app.instance_path)
+
+    # Cache attachment metadata from the attachment index. Unless the cache is
+    # shared, other workers only see a change in a post's permissions once
+    # their entry expires, so keep the TTL short.
+    app.attachment_cache = create_cache(
+        app.config, 'attachments',
+        maxsize=app.config.get('ATTACHMENT_CACHE_SIZE', 4096),
+        ttl=app.config.get('ATTACHMENT_CACHE_TTL', 60))
+
+    # Cache responses to feeds and items until the posts they show change
+    app.response_cache = create_response_cache(app.config)
+
+    # Let identical requests that miss those caches at the same time wait
+    # for one of them to do the work
+    app.single_flight = create_single_flight(app.config)
 
     # Make sure necessary settings exist
     missing_settings = []
@@ -55,23 +118,27 @@ def PISS(instance_path):
     if missing_settings:
         raise SystemExit('Missing configuration settings! (%s)' % (','.join(missing_settings),))
 
-    # Check that a `meta.json` file exists in `types` and that you can read from it
-    meta_schema = ''
-    meta_schema_file = os.path.join(os.path.dirname(instance_path), 'types/meta.json')
-    try:
-        with open(meta_schema_file, 'r') as f:
-            meta_schema = f.read()
-    except IOError as e:
-        raise SystemExit('Could not find `meta` post schema file at %s!' % (meta_schema_file,))
+    # Load the post type schemas, and check that the `meta` post schema is
+    # among them
+    types_dir = os.path.join(os.path.dirname(instance_path), 'types')
+    app.type_registry = TypeRegistry(
+        types_dir, poll_interval=app.config.get('TYPES_POLL_INTERVAL', 2))
+    meta_schema = app.type_registry.get('meta')
+    if meta_schema is None:
+        raise SystemExit('Could not find `meta` post schema file at %s!' % (os.path.join(types_dir, 'meta.json'),))
     if not meta_schema:
-        raise SystemExit('No data in `meta` post schema at %s!' % (meta_schema_file,))
+        raise SystemExit('No data in `meta` post schema at %s!' % (os.path.join(types_dir, 'meta.json'),))
 
     # Validate the data in `META_POST` against the `meta` post schema
-    v = Validator(json.loads(meta_schema))
+    v = Validator(meta_schema)
     if not v.validate(app.config['META_POST']):
         raise SystemExit('Invalid `META_POST` configuration! \
             Validator returned the following errors: \n%s' % (str(v.errors),))
 
+    # Versions are looked up by post ID and version number
+    with app.app_context():
+        app.data.ensure_indexes()
+
     # Make sure necessary directories exist
     if not os.path.isdir(os.path.join(instance_path, 'attachments')):
         os.makedirs(os.path.join(instance_path, 'attachments'))
@@ -82,6 +149,7 @@ def PISS(instance_path):
     app.register_blueprint(attachments)
     app.register_blueprint(server_info)
     app.register_blueprint(syndication)
+    app.register_blueprint(uploads)
 
     # Override some of Eve's default methods in order to handle HTML requests
     eve_override(app)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+'''
+Post IDs
+
+Post IDs are timestamps expressed in NewBase60. The resolution of the
+timestamp is declared by the posting app in the `resolution` field of its app
+post (see `docs/Post-IDs.md`), so the number of digits in an ID depends on the
+app that created it.
+
+Every tick has a counter document holding a sequence number, which is
+incremented atomically in MongoDB, so IDs are unique across threads, workers
+and hosts that share the database. The first ID of a tick is the bare tick;
+the ones after it get the sequence number as a two-digit NewBase60 suffix
+(e.g. `4bJj3-01`), which keeps IDs in the order they were handed out when
+sorted as strings. Only when all `SEQUENCE_SIZE` IDs of a tick are taken does
+the allocator borrow the next tick. Counters are dropped by MongoDB once they
+are `COUNTER_TTL` seconds old.
+'''
+
+import time
+from datetime import datetime
+from flask import current_app, g
+from pymongo.errors import DuplicateKeyError
+from .utils import get_post_by_id, NewBase60
+
+# Number of ticks per second for each resolution
+RESOLUTIONS = {
+    'minute': 1.0 / 60,
+    'second': 1,
+    '60hz': 60,
+    '3600hz': 3600,
+    # Only used internally for posts created by the server itself
+    'microsecond': 1000000
+}
+
+DEFAULT_RESOLUTION = 'second'
+COUNTERS_COLLECTION = 'post_ids'
+# IDs per tick, i.e. the number of two-digit NewBase60 suffixes
+SEQUENCE_DIGITS = 2
+SEQUENCE_SIZE = 60 ** SEQUENCE_DIGITS
+SEQUENCE_SEPARATOR = '-'
+COUNTER_TTL = 24 * 60 * 60
+
+
+def next_ids(counters, resolution, count=1, now=None):
+    '''
+    Allocate `count` consecutive IDs at the given resolution and return them
+    as NewBase60 strings.
+
+    :param counters: the MongoDB collection that holds the counters.
+    :param resolution: one of the keys in `RESOLUTIONS`.
+    :param count: the number of IDs to allocate.
+    :param now: optional UNIX timestamp to use instead of the current time.
+    '''
+    if now is None:
+        now = time.time()
+    tick = int(now * RESOLUTIONS[resolution])
+    counters.ensure_index('created', expireAfterSeconds=COUNTER_TTL)
+    ids = []
+    while len(ids) < count:
+        wanted = count - len(ids)
+        try:
+            counter = counters.find_and_modify(
+                {'_id': '%s:%d' % (resolution, tick)},
+                {'$inc': {'seq': wanted},
+                 '$setOnInsert': {'created': datetime.utcnow()}},
+                upsert=True, new=True)
+        except DuplicateKeyError:
+            # Another worker created the counter at the same time, so try again
+            continue
+        last = int(counter['seq'])
+        for seq in range(last - wanted, min(last, SEQUENCE_SIZE)):
+            ids.append(format_id(tick, seq))
+        # Whatever is still missing comes from the next tick, as this one's
+        # sequence is used up
+        tick += 1
+    return ids
+
+
+def format_id(tick, seq=0):
+    '''
+    Return the ID for the given tick and sequence number within the tick.
+    '''
+    post_id = str(NewBase60(tick))
+    if seq:
+        post_id += SEQUENCE_SEPARATOR + \
+            str(NewBase60(seq)).rjust(SEQUENCE_DIGITS, '0')
+    return post_id
+
+
+def allocate_post_ids(resolution, count=1):
+    '''
+    Allocate IDs at the given resolution using the database of the current
+    app.
+    '''
+    counters = current_app.data.driver.db[COUNTERS_COLLECTION]
+    return next_ids(counters, resolution, count)
+
+
+def get_request_resolution():
+    '''
+    Return the ID resolution of the app that signed the current request. Falls
+    back to `POST_ID_RESOLUTION` in `piss.cfg` when the app didn't declare one
+    or the request wasn't signed by an app (e.g. the root credentials).
+    '''
+    default = current_app.config.get('POST_ID_RESOLUTION', DEFAULT_RESOLUTION)
+    credentials = getattr(g, 'hawk_credentials', None)
+    if not credentials or not credentials.get('app', None):
+        return default
+    resolution = get_app_resolution(credentials['app'])
+    return resolution or default
+
+
+def get_app_resolution(app_id):
+    '''
+    Return the resolution declared in the app post with the given ID, or
+    `None` if it doesn't declare a valid one. Results are cached in
+    `app.resolution_cache`.
+
+    :param app_id: the ID of the app post.
+    '''
+    cache = current_app.resolution_cache
+    resolution = cache.get(app_id, None)
+    if resolution is not None:
+        return resolution or None
+
+    resolution = False
+    app_post = get_post_by_id(app_id)
+    if app_post:
+        declared = app_post.get('content', {}).get('resolution', None)
+        if declared in RESOLUTIONS and declared != 'microsecond':
+            resolution = declared
+    cache.set(app_id, resolution)
+    return resolution or None
+
+
+def forget_resolution(app_id):
+    '''
+    Drop the cached resolution for the given app post ID.
+    '''
+    current_app.resolution_cache.delete(str(app_id))
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+'''
+Response cache
+
+Responses to `GET` requests for posts, both feeds (`/posts`) and items
+(`/posts/<id>`), in every format, are cached and reused until a post they
+depend on is written. Entries are keyed by the path, the query string (in a
+normalized order, without `bewit`), the negotiated format (JSON, XML or
+HTML) and whether the request was signed, since signed requests can see
+private posts. Only `200` responses are cached.
+
+Entries are never deleted when a post changes. Instead, every key includes
+a generation number, which the event hooks bump on every write: feeds depend
+on the `posts` generation, bumped whenever any post is inserted, updated,
+replaced or deleted, and items on the generation of their own post. After a
+write, the old entries are simply never asked for again and get evicted.
+
+The backend is set with `RESPONSE_CACHE`:
+
+* `'memory'` (the default): an `LRUCache` in every worker process, holding
+  `RESPONSE_CACHE_SIZE` responses (1024 by default). The generations are
+  kept in the `cache_generations` collection so that every worker sees
+  every write, at the cost of looking one up for each request.
+* `'shared'`: a `SharedCache` in the shared memory that every worker on
+  the host uses (see `piss.shared_cache`), which holds the generations as
+  well. This is the default when `CACHE_BACKEND` is `'shared'`.
+* `'redis'`: a `RedisCache` at `RESPONSE_CACHE_REDIS_URL`, shared by every
+  worker, which holds the generations as well.
+* `None`: no caching.
+
+Entries expire after `RESPONSE_CACHE_TTL` seconds (5 minutes by default)
+either way. Identical requests that miss at the same time are coalesced by
+`piss.singleflight`, so that only one of them builds the response.
+'''
+
+import time
+import hashlib
+import functools
+from flask import current_app, request
+from eve.utils import config
+from .cache import LRUCache, RedisCache
+from .shared_cache import SharedCache, open_shared_memory
+from .singleflight import single_flight
+from .utils import request_is_json, request_is_xml, _resource
+
+GENERATIONS_COLLECTION = 'cache_generations'
+
+# Resources whose responses are cached
+CACHED_RESOURCES = ('posts',)
+
+# Headers that belong to a single response
+UNCACHED_HEADERS = ('Set-Cookie', 'Date', 'Content-Length')
+
+
+def create_response_cache(app_config):
+    '''
+    Return the response cache set up in the app's config, or `None` if
+    caching is turned off.
+    '''
+    backend = app_config.get('RESPONSE_CACHE',
+                             app_config.get('CACHE_BACKEND', 'memory'))
+    ttl = app_config.get('RESPONSE_CACHE_TTL', 300)
+    if not backend:
+        return None
+    if backend == 'memory':
+        return ResponseCache(
+            LRUCache(maxsize=app_config.get('RESPONSE_CACHE_SIZE', 1024), ttl=ttl),
+            MongoGenerations())
+    if backend == 'shared':
+        cache = SharedCache(open_shared_memory(app_config),
+                            prefix='responses:', ttl=ttl)
+        return ResponseCache(cache, CacheGenerations(cache))
+    if backend == 'redis':
+        cache = RedisCache(
+            url=app_config.get('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0'),
+            prefix='piss:responses:', ttl=ttl)
+        return ResponseCache(cache, CacheGenerations(cache))
+    raise ValueError('Unknown RESPONSE_CACHE backend: %s' % (backend,))
+
+
+class ResponseCache(object):
+    '''
+    Cached responses, stored in `cache` under keys that include the
+    generations in `generations`.
+    '''
+    def __init__(self, cache, generations):
+        self.cache = cache
+        self.generations = generations
+
+    def get(self, key):
+        '''
+        Return the cached response for a key, or `None`.
+        '''
+        entry = self.cache.get(key, None)
+        if entry is None:
+            return None
+        status, headers, body = entry
+        return current_app.response_class(body, status=status, headers=headers)
+
+    def set(self, key, response):
+        headers = [(name, value) for name, value in response.headers
+                   if name not in UNCACHED_HEADERS]
+        self.cache.set(key, (response.status_code, headers,
+                             response.get_data()))
+
+    def request_key(self, auth_class, lookup):
+        '''
+        Return the cache key for the current request.
+
+        :param auth_class: `'public'` or `'authenticated'`.
+        :param lookup: the view's keyword arguments, e.g. the post ID.
+        '''
+        resource = _resource()
+        names = [resource]
+        if lookup.get(config.ID_FIELD, None) is not None:
+            # Items only change when they're written to
+            names = ['%s/%s' % (resource, lookup[config.ID_FIELD])]
+        if request_is_json():
+            fmt = 'json'
+        elif request_is_xml():
+            fmt = 'xml'
+        else:
+            fmt = 'html'
+        query = sorted((key, value) for key, value
+                       in request.args.items(multi=True) if key != 'bewit')
+        key = repr((request.host, request.path, query, fmt, auth_class,
+                    self.generations.get(names)))
+        return 'response:' + hashlib.sha1(key).hexdigest()
+
+    def invalidate(self, resource, item_id=None):
+        '''
+        Make the cached responses that depend on a resource, and on one of
+        its items if `item_id` is given, out of date.
+        '''
+        names = [resource]
+        if item_id is not None:
+            names.append('%s/%s' % (resource, item_id))
+        self.generations.bump(names)
+
+
+class MongoGenerations(object):
+    '''
+    Generation numbers kept in the `cache_generations` collection.
+    '''
+    def get(self, names):
+        collection = current_app.data.driver.db[GENERATIONS_COLLECTION]
+        if len(names) == 1:
+            documents = [collection.find_one({'_id': names[0]})]
+        else:
+            documents = collection.find({'_id': {'$in': names}})
+        generations = dict((d['_id'], d['generation'])
+                           for d in documents if d is not None)
+        return [generations.get(name, 0) for name in names]
+
+    def bump(self, names):
+        collection = current_app.data.driver.db[GENERATIONS_COLLECTION]
+        for name in names:
+            collection.update({'_id': name}, {'$inc': {'generation': 1}},
+                              upsert=True)
+
+
+class CacheGenerations(object):
+    '''
+    Generation numbers kept as counters in a shared cache. A counter that's
+    missing (never set, or evicted) starts again from the current time
+    rather than from zero, so that it can't come back to a generation that
+    old entries were stored under.
+    '''
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, names):
+        generations = []
+        for name in names:
+            generation = self.cache.get_counter('generation:' + name)
+            if generation is None:
+                self.cache.add_counter('generation:' + name,
+                                       int(time.time() * 1000000))
+                generation = self.cache.get_counter('generation:' + name)
+            generations.append(generation)
+        return generations
+
+    def bump(self, names):
+        for name in names:
+            if self.cache.get_counter('generation:' + name) is None:
+                self.cache.add_counter('generation:' + name,
+                                       int(time.time() * 1000000))
+            self.cache.incr('generation:' + name)
+
+
+def get_auth_class():
+    '''
+    Return `'authenticated'` for requests signed with valid credentials,
+    `'public'` for unsigned requests, or `None` if the signature doesn't
+    check out (so that the view can refuse the request).
+    '''
+    if not request.headers.get('Authorization', '') \
+            and not request.args.get('bewit', ''):
+        return 'public'
+    if current_app.auth.authorized([], _resource(), request.method):
+        return 'authenticated'
+    return None
+
+
+def cached_view(view):
+    '''
+    Decorator for the feed and item views that answers `GET` requests from
+    the response cache when it can, and caches the responses it can't.
+    '''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        response_cache = current_app.response_cache
+        if response_cache is None or request.method != 'GET' \
+                or _resource() not in CACHED_RESOURCES:
+            return view(*args, **kwargs)
+        auth_class = get_auth_class()
+        if auth_class is None:
+            return view(*args, **kwargs)
+
+        key = response_cache.request_key(auth_class, kwargs)
+
+        def render():
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                response_cache.set(key, response)
+            return response
+        # Identical requests that miss at the same time wait for the first
+        # one's response instead of each querying and rendering it
+        response = single_flight(key, render, lookup=lambda: response_cache.get(key),
+                                 shared=response_cache.cache.shared)
+        return response.make_conditional(request)
+    return wrapper
+
+
+def invalidate_responses(resource, item_id=None):
+    '''
+    Called by the event hooks after a write. See `ResponseCache.invalidate`.
+    '''
+    response_cache = getattr(current_app, 'response_cache', None)
+    if response_cache is not None:
+        response_cache.invalidate(resource, item_id)
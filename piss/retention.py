@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+'''
+Version retention
+
+Old versions of a post are moved out of the shadow collection (e.g.
+`posts_versions`) into a compressed archive collection (e.g.
+`posts_versions_archive`) according to a retention policy, so the hot
+collection and its indexes stay small no matter how long the history gets.
+Archived versions can still be requested with `?version=<n>`; see
+`piss.data.PissMongo.find_one`.
+
+Policies are set per post type in `piss.cfg`, using either the short name of
+the type or its full URL. Posts whose type isn't listed use the `default`
+policy, and if there is no `default` policy nothing is archived:
+
+    VERSION_RETENTION = {
+        'default': {'keep_last': 20, 'keep_monthly': True},
+        'note': {'keep_last': 5}
+    }
+
+`keep_last` is the number of most recent versions to keep and `keep_monthly`
+keeps the last version of every calendar month as well. The latest version is
+always kept.
+'''
+
+import zlib
+import bson
+from flask import current_app
+from eve.utils import config
+from eve.versioning import versioned_id_field
+from .data import DELTA_FIELD, ARCHIVE_SUFFIX, ARCHIVE_DATA_FIELD, \
+    VersionCursor, ensure_version_indexes, strip_version_fields
+
+
+def get_retention_policy(post_type):
+    '''
+    Return the retention policy for the given post type URL, or `None` if
+    versions of posts of that type should never be archived.
+
+    :param post_type: the type URL of the post.
+    '''
+    policies = current_app.config.get('VERSION_RETENTION', None) or {}
+    short_type = post_type.strip('/').split('/')[-1]
+    for key in (post_type, short_type, 'default'):
+        if key in policies:
+            return policies[key]
+    return None
+
+
+def select_archived_versions(versions, policy):
+    '''
+    Return the set of version numbers that the policy doesn't keep.
+
+    :param versions: list of `(version, last_updated)` tuples in ascending
+                     version order.
+    :param policy: a retention policy dict.
+    '''
+    if not versions:
+        return set()
+    keep_last = max(policy.get('keep_last', 1), 1)
+    keep = set(version for version, _ in versions[-keep_last:])
+    if policy.get('keep_monthly', False):
+        months = {}
+        for version, updated in versions:
+            if updated is not None:
+                months[(updated.year, updated.month)] = version
+        keep.update(months.values())
+    return set(version for version, _ in versions) - keep
+
+
+def compact_versions(resource='posts', dry_run=False, progress=None):
+    '''
+    Move the versions that the retention policies don't keep into the archive
+    collection. Versions left behind whose previous version was archived are
+    rewritten as keyframes so that they can still be rebuilt.
+
+    Safe to interrupt and run again: versions are copied to the archive before
+    they're removed from the shadow collection.
+
+    :param resource: the versioned resource to compact.
+    :param dry_run: only count what would be archived.
+    :param progress: optional function called with the ID of each post.
+    :returns: a dict of statistics.
+    '''
+    db = current_app.data.driver.db
+    source = config.SOURCES[resource]['source']
+    versions_source = source + config.VERSIONS
+    shadow = db[versions_source]
+    archive = db[versions_source + ARCHIVE_SUFFIX]
+    id_field = versioned_id_field()
+    if not dry_run:
+        ensure_version_indexes(db, versions_source)
+
+    stats = {'posts': 0, 'archived': 0, 'keyframes': 0, 'archived_bytes': 0}
+    posts = db[source].find({}, {'type': 1, config.VERSION: 1})
+    for post in posts:
+        policy = get_retention_policy(post.get('type', ''))
+        if not policy or post.get(config.VERSION, 1) <= policy.get('keep_last', 1):
+            continue
+        if progress:
+            progress(post[config.ID_FIELD])
+        stats['posts'] += 1
+
+        cursor = shadow.find({id_field: post[config.ID_FIELD]}) \
+            .sort(config.VERSION, 1)
+        documents = list(VersionCursor(cursor, shadow))
+        archived = select_archived_versions(
+            [(d[config.VERSION], d.get(config.LAST_UPDATED, None))
+             for d in documents], policy)
+        if not archived:
+            continue
+
+        to_archive = []
+        keyframes = []
+        for document in documents:
+            if document[config.VERSION] in archived:
+                data = zlib.compress(bson.BSON.encode(
+                    strip_version_fields(document)))
+                to_archive.append({
+                    id_field: document[id_field],
+                    config.VERSION: document[config.VERSION],
+                    ARCHIVE_DATA_FIELD: bson.Binary(data)
+                })
+                stats['archived_bytes'] += len(data)
+            elif document[config.VERSION] - 1 in archived:
+                keyframes.append(document)
+        stats['archived'] += len(to_archive)
+        stats['keyframes'] += len(keyframes)
+        if dry_run:
+            continue
+
+        for archived_document in to_archive:
+            archive.update({id_field: archived_document[id_field],
+                            config.VERSION: archived_document[config.VERSION]},
+                           archived_document, upsert=True)
+        for keyframe in keyframes:
+            # `VersionCursor` already rebuilt these, so they're full copies
+            keyframe.pop(DELTA_FIELD, None)
+            shadow.save(keyframe)
+        shadow.remove({id_field: post[config.ID_FIELD],
+                       config.VERSION: {'$in': list(archived)}})
+    return stats
+
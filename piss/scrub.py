@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+'''
+Attachment scrubber
+
+Checks that every stored attachment still hashes to its digest, and that
+every attachment the index knows about (see `piss.attachment_index`) is still
+stored. Run it with `python manage.py scrub-attachments`.
+
+Files are hashed by a pool of worker processes that read them straight from
+disk, so a large store is checked about as fast as the disks allow. Reads can
+be throttled to a number of bytes per second to leave some I/O for the web
+server.
+
+The outcome for every file is saved in the `attachment_scrub` collection as
+soon as it's known:
+
+    {
+        "_id": "<digest>",
+        "size": 48213,
+        "mtime": 1427846400.0,
+        "ok": true,
+        "checked": <datetime>
+    }
+
+Files whose size and modification time haven't changed since they were last
+checked are skipped, so an interrupted scrub resumes where it stopped and a
+later scrub only reads the files that were stored since (or pass `full=True`
+to check everything again).
+'''
+
+import time
+import hashlib
+import collections
+import datetime
+import multiprocessing
+from flask import current_app
+from .file_io import get_storage, format_file_digest, ONE_MB
+from .attachment_index import get_attachment_index
+
+SCRUB_COLLECTION = 'attachment_scrub'
+
+
+def get_scrub_results():
+    return current_app.data.driver.db[SCRUB_COLLECTION]
+
+
+def scrub_attachments(workers=None, max_rate=None, full=False, progress=None):
+    '''
+    Verify the digests of the stored attachments and look for the ones that
+    are missing.
+
+    :param workers: the number of worker processes (the number of CPUs by
+                    default).
+    :param max_rate: the maximum number of bytes read per second, or `None`.
+    :param full: check every file, even if it hasn't changed since it was
+                 last checked.
+    :param progress: optional function called with each digest and whether
+                     it's intact.
+    :returns: a dict of statistics and a `problems` list of dicts with
+              `digest`, `problem` (`'corrupt'` or `'missing'`) and `posts`
+              (the IDs of the posts that reference the file).
+    '''
+    results = get_scrub_results()
+    storage = get_storage()
+    stats = {'checked': 0, 'checked_bytes': 0, 'skipped': 0, 'problems': []}
+
+    def record(result):
+        digest, size, mtime, actual = result
+        ok = actual == digest
+        results.update({'_id': digest},
+                       {'_id': digest, 'size': size, 'mtime': mtime,
+                        'ok': ok, 'checked': datetime.datetime.utcnow()},
+                       upsert=True)
+        stats['checked'] += 1
+        stats['checked_bytes'] += size
+        if not ok:
+            stats['problems'].append(get_problem(digest, 'corrupt'))
+        if progress:
+            progress(digest, ok)
+
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Keep a couple of jobs queued per worker, and no more, so that
+        # results are saved as they come in and throttling takes effect
+        pending = collections.deque()
+        for job in iter_jobs(storage, results, full, max_rate, stats):
+            pending.append(pool.apply_async(verify_extents, (job,)))
+            if len(pending) >= workers * 2:
+                record(pending.popleft().get())
+        while pending:
+            record(pending.popleft().get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    for entry in get_attachment_index().find({'posts': {'$ne': []}},
+                                             {'_id': 1}):
+        if storage.stat(entry['_id']) is None:
+            stats['problems'].append(get_problem(entry['_id'], 'missing'))
+            results.remove({'_id': entry['_id']})
+    return stats
+
+
+def iter_jobs(storage, results, full, max_rate, stats):
+    '''
+    Yield a `(digest, size, mtime, extents)` tuple for every file that needs
+    checking, no faster than `max_rate` bytes per second.
+    '''
+    started = time.time()
+    scheduled = 0
+    for digest in storage.iter_digests():
+        stat = storage.stat(digest)
+        if stat is None:
+            # Deleted in the meantime
+            continue
+        size, mtime = stat
+        if not full and results.find_one(
+                {'_id': digest, 'size': size, 'mtime': mtime, 'ok': True},
+                {'_id': 1}):
+            stats['skipped'] += 1
+            continue
+        blob = storage.open(digest)
+        if blob is None:
+            continue
+        if max_rate:
+            delay = started + float(scheduled) / max_rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        scheduled += size
+        yield digest, size, mtime, blob.extents()
+
+
+def verify_extents(job):
+    '''
+    Hash a file and return `(digest, size, mtime, actual_digest)`, where
+    `actual_digest` is `None` if the file couldn't be read. Runs in the worker
+    processes.
+    '''
+    digest, size, mtime, extents = job
+    hasher = hashlib.sha512()
+    try:
+        for path, offset, length in extents:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while length > 0:
+                    data = f.read(min(ONE_MB, length))
+                    if not data:
+                        # Truncated
+                        return digest, size, mtime, None
+                    hasher.update(data)
+                    length -= len(data)
+    except IOError:
+        return digest, size, mtime, None
+    return digest, size, mtime, format_file_digest(hasher)
+
+
+def get_problem(digest, problem):
+    entry = get_attachment_index().find_one({'_id': digest}, {'posts': 1})
+    return {
+        'digest': digest,
+        'problem': problem,
+        'posts': (entry or {}).get('posts', [])
+    }
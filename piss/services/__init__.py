@@ -3,3 +3,4 @@
 from attachments import attachments
 from server_info import server_info
 from syndication import syndication
+from uploads import uploads
@@ -5,55 +5,108 @@ Attachments routes
 
 Routes use Eve's `getitem` to fetch attachment data, so authorization is
 handled automatically.
+
+Files are addressed by digest, so the digest is used as a strong ETag and
+single byte ranges are supported. Responses can optionally be handed off to
+the web server in front of PISS by setting `ATTACHMENTS_SENDFILE` in
+`piss.cfg` to one of:
+
+* `'x-sendfile'`: sends an `X-Sendfile` header with the path of the file
+  (Apache's `mod_xsendfile`, lighttpd).
+* `'x-accel-redirect'`: sends an `X-Accel-Redirect` header with the path of
+  the file below `ATTACHMENTS_ACCEL_PREFIX` (nginx). The prefix must be an
+  `internal` location that serves the instance's `attachments` folder, e.g.:
+
+      location /_attachments/ {
+          internal;
+          alias /path/to/instance/attachments/;
+      }
+
+The web server then takes care of streaming the file and of `Range`
+requests, so the worker is free as soon as the headers have been sent. Files
+stored in packs (see `piss.storage`) are always sent by PISS.
 '''
 
-from flask import abort, Blueprint, request, send_from_directory
+import os
+from flask import abort, Blueprint, request, current_app, Response
 from eve.methods import getitem
-from piss.file_io import get_attachment_dir
+from eve.utils import parse_request
+from eve.versioning import get_old_document
+from piss.file_io import open_attachment, get_attachments_path
+from piss.event_hooks import is_public_post, after_fetched_item_posts
+from piss.attachment_index import lookup_attachment
+from piss.derivatives import get_derivative_spec, get_derivative
+from piss.storage.loose import LooseBlob
 
 attachments = Blueprint('attachments', __name__)
 
+ONE_YEAR = 60 * 60 * 24 * 365
+BUFFER_SIZE = 64 * 1024
+
 
 @attachments.route('/attachments/<digest>')
 def attachment(digest):
     '''
     Given an attachment digest, find a post that lists the digest in its
-    `attachments` array and return the relevant file.
+    `attachments` array and return the relevant file. The file behind a digest
+    never changes, so it's cached for as long as possible.
+
+    The post is found through the attachment index. Attachments of public
+    posts are sent straight away; otherwise the post is fetched with `getitem`
+    so that the request is authorized.
 
     :param digest: the attachment digest.
     '''
-    lookup = {
-        'attachments': {
-            '$elemMatch': {
-                'digest': digest
+    indexed = lookup_attachment(digest)
+    if indexed and indexed['public']:
+        return send_attachment(indexed, True, immutable=True)
+    if indexed:
+        lookup = {'_id': indexed['post']}
+    else:
+        # Not in the index yet (`manage.py collect-attachments` rebuilds it),
+        # so search the posts
+        lookup = {
+            'attachments': {
+                '$elemMatch': {
+                    'digest': digest
+                }
             }
         }
-    }
-    attachment = get_attachment('digest', digest, lookup)
-    return send_from_directory(get_attachment_dir(digest), digest,
-                               mimetype=attachment['content_type'])
+    post, attachment = get_attachment('digest', digest, lookup)
+    if post is None:
+        return not_modified(digest)
+    return send_attachment(attachment, is_public_post(post), immutable=True)
 
 
 @attachments.route('/posts/<pid>/<name>')
 def post_attachment(pid, name):
     '''
     Given a post ID and file name, retrieve the post, find the matching
-    attachment, and return the relevant file.
+    attachment, and return the relevant file. Editing the post can point the
+    name to a different file, so only requests for a particular version are
+    cached for good.
 
     :param pid: the post ID.
     :param name: the attachment name.
     '''
-    attachment = get_attachment('name', name, {'_id': pid})
-    digest = attachment['digest']
-    return send_from_directory(get_attachment_dir(digest), digest,
-                               mimetype=attachment['content_type'])
+    immutable = 'version' in request.args
+    post, attachment = get_attachment('name', name, {'_id': pid})
+    if post is None:
+        return not_modified(None)
+    return send_attachment(attachment, is_public_post(post),
+                           immutable=immutable)
 
 
 def get_attachment(key, value, lookup):
     '''
-    Performs a lookup for a particular post and returns an attachment document
-    if one of its keys matches the given value. Also makes sure to reject
-    `version` requests that would be impossible to fulfill.
+    Performs a lookup for a particular post and returns the post and an
+    attachment document if one of its keys matches the given value. Also makes
+    sure to reject `version` requests that would be impossible to fulfill.
+
+    If the request is conditional and Eve finds that the post hasn't changed,
+    `(None, None)` is returned, and so the attachment hasn't changed either.
+    Eve answers such requests before the `on_fetched_item` hooks run, so the
+    post is checked here before saying so.
 
     :param key: the dict key to match.
     :param value: the dict value at the given key to match.
@@ -62,13 +115,162 @@ def get_attachment(key, value, lookup):
     if 'version' in request.args \
             and request.args['version'] in ('all', 'diffs'):
         abort(400)
-    post, _, _, _ = getitem('posts', lookup)
+    post, _, _, status = getitem('posts', lookup)
+    if status == 304:
+        post = get_unmodified_post(lookup)
     if not post:
         abort(404)
-    for attachment in post['attachments']:
+    for attachment in post.get('attachments', []):
         if attachment[key] == value:
             break
     else:
         # We never found a matching digest -- abort
         abort(404)
-    return attachment
+    if status == 304:
+        return None, None
+    return post, attachment
+
+
+def get_unmodified_post(lookup):
+    '''
+    Fetch the post (at the requested version) that Eve found to be unmodified
+    and run it past the same permission check as `getitem` responses, so that
+    a `304` doesn't reveal anything a `200` wouldn't.
+
+    :param lookup: dict used to filter results in a database lookup.
+    '''
+    req = parse_request('posts')
+    post = current_app.data.find_one('posts', req, **lookup)
+    if not post:
+        return None
+    version = request.args.get('version', None)
+    post = get_old_document('posts', req, {'_id': post['_id']}, post, version)
+    after_fetched_item_posts(post)
+    return post
+
+
+def send_attachment(attachment, public, immutable=False):
+    '''
+    Create a response for an attachment, honoring `If-None-Match`, `Range`
+    and `If-Range` headers, or hand the file off to the web server if
+    `ATTACHMENTS_SENDFILE` is set. If the query string asks for a resized
+    image, the derivative is sent instead.
+
+    :param attachment: the attachment document.
+    :param public: whether the post that lists the attachment is public.
+    :param immutable: whether the URL always points to the same file.
+    '''
+    digest = attachment['digest']
+    content_type = attachment['content_type']
+    spec = get_derivative_spec(request.args, content_type)
+    if spec is not None:
+        # Derivatives are named after their original and their spec
+        digest = '%s-%s' % (digest, spec.name)
+        content_type = spec.content_type
+    if digest in request.if_none_match:
+        return not_modified(digest, public=public, immutable=immutable)
+
+    if spec is None:
+        blob = open_attachment(digest)
+    else:
+        path = get_derivative(attachment['digest'], spec)
+        blob = LooseBlob(digest, os.path.getsize(path), path)
+    if blob is None:
+        abort(404)
+    headers = {'ETag': '"%s"' % (digest,),
+               'Cache-Control': cache_control(public, immutable),
+               'Accept-Ranges': 'bytes'}
+
+    # Only files stored on their own can be handed off to the web server
+    sendfile = current_app.config.get('ATTACHMENTS_SENDFILE', None)
+    if sendfile == 'x-sendfile' and blob.path:
+        headers['X-Sendfile'] = blob.path
+        return Response(None, 200, headers, mimetype=content_type)
+    elif sendfile == 'x-accel-redirect' and blob.path and spec is None:
+        prefix = current_app.config.get('ATTACHMENTS_ACCEL_PREFIX', '/_attachments/')
+        headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + \
+            os.path.relpath(blob.path, get_attachments_path())
+        return Response(None, 200, headers, mimetype=content_type)
+
+    size = blob.size
+    start, stop = 0, size
+    status = 200
+
+    byte_range = get_byte_range(size, digest)
+    if byte_range == ():
+        headers['Content-Range'] = 'bytes */%d' % (size,)
+        return Response(None, 416, headers)
+    elif byte_range:
+        start, stop = byte_range
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        status = 206
+
+    headers['Content-Length'] = str(stop - start)
+    if request.method == 'HEAD':
+        body = None
+    elif status == 200 and blob.path \
+            and 'wsgi.file_wrapper' in request.environ:
+        # Let the WSGI server send the whole file as efficiently as it can
+        body = request.environ['wsgi.file_wrapper'](blob.open(), BUFFER_SIZE)
+    else:
+        body = blob.iter_range(start, stop, BUFFER_SIZE)
+    response = Response(body, status, headers,
+                        mimetype=content_type,
+                        direct_passthrough=True)
+    return response
+
+
+def get_byte_range(size, digest):
+    '''
+    Return the `(start, stop)` byte range that was requested, `None` to send
+    the whole file, or an empty tuple if the range can't be satisfied.
+
+    Only a single range is supported. Requests for several ranges get the
+    whole file, as allowed by RFC 7233.
+
+    :param size: the size of the file.
+    :param digest: the attachment digest, used to check `If-Range`.
+    '''
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes' \
+            or len(byte_range.ranges) != 1:
+        return None
+    if_range = request.if_range
+    if if_range.date is not None or \
+            (if_range.etag is not None and if_range.etag != digest):
+        # The client's copy is of a different file, or it can't tell (no
+        # Last-Modified header is sent), so send all of this one
+        return None
+    start, stop = byte_range.ranges[0]
+    if start < 0:
+        # Suffix range, e.g. the last 500 bytes
+        start = max(size + start, 0)
+        stop = size
+    elif stop is None or stop > size:
+        stop = size
+    if start >= stop:
+        return ()
+    return start, stop
+
+
+def not_modified(digest, public=False, immutable=False):
+    '''
+    Create a `304 Not Modified` response. Unless we know that the post is
+    public, the response may only be cached privately.
+    '''
+    headers = {'Cache-Control': cache_control(public, immutable)}
+    if digest:
+        headers['ETag'] = '"%s"' % (digest,)
+    return Response(None, 304, headers)
+
+
+def cache_control(public, immutable):
+    '''
+    Private posts can be cached by the client, but the cached copy has to be
+    revalidated so that changes to the post's permissions are respected.
+    '''
+    if not public:
+        return 'private, no-cache'
+    if immutable:
+        return 'public, max-age=%d, immutable' % (ONE_YEAR,)
+    return 'public, no-cache'
@@ -1,8 +1,7 @@
 # -*- coding: utf-8 -*-
 
-import os
-import json
-from flask import Blueprint, current_app
+from flask import abort, Blueprint, current_app, request
+from piss.utils import request_is_json, request_is_xml
 from .utils import render_response
 
 server_info = Blueprint('server_info', __name__)
@@ -10,11 +9,11 @@ server_info = Blueprint('server_info', __name__)
 @server_info.route('/meta')
 def meta():
     '''
-    Return the `meta` post for the server. Checks the `Accept` header to 
+    Return the `meta` post for the server. Checks the `Accept` header to
     return a response of the appropriate type.
     '''
-    return render_response(current_app.config['META_POST'], 'item.html',
-                           title='Meta')
+    return render_cached('meta', current_app.config['META_POST'], 'item.html',
+                         title='Meta')
 
 
 @server_info.route('/types')
@@ -22,17 +21,9 @@ def types_resource():
     '''
     Return a list of post types available on the server.
     '''
-    types_dir = os.path.join(os.path.dirname(current_app.instance_path),
-                                             'types')
-    files = []
-    for (_, _, filenames) in os.walk(types_dir):
-        files.extend(filenames)
-        break
-    items = []
-    for file in files:
-        items.append({'_id': file.split('.')[0]})
-    return render_response(items, 'items.html', feed_url='%s/types'
-                           % (current_app.config['META_POST']['entity'],))
+    items = [{'_id': name} for name in current_app.type_registry.names()]
+    return render_cached('types', items, 'items.html', feed_url='%s/types'
+                         % (current_app.config['META_POST']['entity'],))
 
 
 @server_info.route('/types/<name>')
@@ -42,14 +33,34 @@ def types_item(name):
 
     :param name: the name of the post type to be displayed.
     '''
-    types_dir = os.path.join(os.path.dirname(current_app.instance_path), 'types')
-    type_file = name + '.json'
-    type_schema = ''
-    try:
-        with open(os.path.join(types_dir, type_file), 'r') as f:
-            type_schema = f.read()
-    except Exception as e:
+    type_schema = current_app.type_registry.get(name)
+    if type_schema is None:
         abort(404)
-    type_schema = json.loads(type_schema)
-    return render_response(type_schema, 'item.html',
-                           title="Type: %s" % (name.capitalize(),))
\ No newline at end of file
+    return render_cached('types/' + name, type_schema, 'item.html',
+                         title="Type: %s" % (name.capitalize(),))
+
+
+def render_cached(key, obj, template_name, **kwargs):
+    '''
+    Like `render_response`, but JSON and XML bodies are only serialized once
+    until the post types change (see `piss.type_registry`), and are sent with
+    a strong ETag so that clients polling for changes get a `304`.
+
+    :param key: identifies the resource, e.g. its path.
+    :param obj: the object to be converted.
+    :param template_name: the name of the HTML template to use.
+    :param **kwargs: additional arguments for the template rendering.
+    '''
+    if request_is_json():
+        fmt = 'json'
+    elif request_is_xml():
+        fmt = 'xml'
+    else:
+        return render_response(obj, template_name, **kwargs)
+    body, etag = current_app.type_registry.serialized(
+        key, fmt,
+        lambda: render_response(obj, template_name, **kwargs).get_data())
+    response = current_app.response_class(
+        body, mimetype='application/%s' % (fmt,))
+    response.set_etag(etag)
+    return response.make_conditional(request)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+'''
+Syndication Backfill
+
+Syndicates existing notes, oldest first, with
+`python manage.py syndication-backfill twitter facebook`. Only public notes
+with text are considered, and notes that are already syndicated to a service
+(or that its handler rejects for any other reason) are skipped for that
+service.
+
+Notes are queued as syndication jobs (see `piss.services.syndication.jobs`),
+so they're published by the syndication workers within the services' rate
+limits. Backfill jobs only run when no other job is due, and only `window`
+of them are queued at a time, so syndication requests made in the meantime
+don't have to wait for the backfill.
+
+Each backfill has a name, and its progress is kept in the
+`syndication_backfill` collection:
+
+    {
+        "_id": "twitter+facebook",
+        "services": ["twitter", "facebook"],
+        "cursor": [<datetime>, "2JHuHA"],   (the last note queued)
+        "queued": 120,
+        "skipped": 3,
+        "started": 1427846400.0,
+        "finished": null
+    }
+
+Running a backfill again resumes after the last note it queued.
+'''
+
+import os
+import time
+from flask import current_app
+from werkzeug.exceptions import HTTPException
+from eve.utils import config
+from .handlers import HANDLERS
+from .jobs import enqueue_job, get_jobs
+
+BACKFILL_COLLECTION = 'syndication_backfill'
+
+
+def get_backfills():
+    return current_app.data.driver.db[BACKFILL_COLLECTION]
+
+
+def candidates_query(services, cursor=None, since=None):
+    '''
+    Return the query for the notes that may still have to be syndicated to
+    at least one of the services, after the cursor.
+
+    :param services: the services to syndicate to.
+    :param cursor: the `(created, post_id)` of the last note queued.
+    :param since: only consider notes created at or after this `datetime`.
+    '''
+    server_entity = current_app.config.get('META_POST')['entity']
+    query = {
+        'type': os.path.join(server_entity, 'types', 'note'),
+        'content.text': {'$exists': True},
+        'permissions.public': True,
+        '$or': [{'links': {'$not': {'$elemMatch': {
+            'entity': HANDLERS[service].entity, 'type': 'syndication'}}}}
+            for service in services]
+    }
+    if since is not None:
+        query[config.DATE_CREATED] = {'$gte': since}
+    if cursor is not None:
+        # Notes created in the same second as the cursor are ordered by ID
+        query['$and'] = [{'$or': [
+            {config.DATE_CREATED: {'$gt': cursor[0]}},
+            {config.DATE_CREATED: cursor[0], config.ID_FIELD: {'$gt': cursor[1]}}
+        ]}]
+    return query
+
+
+def run_backfill(services, name=None, since=None, batch_size=100, window=50,
+                 poll_interval=5.0, dry_run=False, progress=None):
+    '''
+    Queue the notes that haven't been syndicated to the services yet, a few
+    at a time, and wait for the syndication workers to publish them.
+
+    :param services: the services to syndicate to.
+    :param name: the name of the backfill, to resume it later. Defaults to
+                 the services joined with `+`.
+    :param since: only syndicate notes created at or after this `datetime`.
+    :param batch_size: the largest number of notes to queue at a time.
+    :param window: the largest number of backfill jobs to have queued at
+                   once.
+    :param poll_interval: seconds to wait between checks on the jobs.
+    :param dry_run: only count the notes that would be queued.
+    :param progress: optional function called with a dict of statistics
+                     after each check.
+    :returns: the final statistics.
+    '''
+    for service in services:
+        if service not in HANDLERS:
+            raise ValueError('Unknown syndication service: %s' % (service,))
+    name = name or '+'.join(services)
+    backfills = get_backfills()
+    jobs = get_jobs()
+    posts = current_app.data.driver.db['posts']
+    server_entity = current_app.config.get('META_POST')['entity']
+
+    state = backfills.find_one({'_id': name}) or {
+        '_id': name,
+        'services': services,
+        'cursor': None,
+        'queued': 0,
+        'skipped': 0,
+        'started': time.time(),
+        'finished': None
+    }
+    started = time.time()
+    finished_at_start = None
+    exhausted = False
+
+    while True:
+        outstanding = 0 if dry_run else jobs.find(
+            {'backfill': name, 'status': {'$in': ['queued', 'running']}}).count()
+        if not exhausted and outstanding < window:
+            cursor = state['cursor']
+            batch = list(posts.find(
+                candidates_query(services, cursor, since),
+                sort=[(config.DATE_CREATED, 1), (config.ID_FIELD, 1)],
+                limit=batch_size if dry_run
+                else max(min(batch_size, window - outstanding), 1)))
+            exhausted = not batch
+            for post in batch:
+                for service in services:
+                    handler = HANDLERS[service]
+                    data = {
+                        'entity': handler.entity,
+                        'type': post['type'],
+                        'content': {'text': post['content']['text']},
+                        'links': [{'post': post[config.ID_FIELD]}]
+                    }
+                    try:
+                        handler.check(data, post, server_entity)
+                    except HTTPException:
+                        state['skipped'] += 1
+                        continue
+                    if not dry_run:
+                        enqueue_job(post[config.ID_FIELD], service, data,
+                                    backfill=name)
+                    state['queued'] += 1
+                state['cursor'] = [post[config.DATE_CREATED],
+                                   post[config.ID_FIELD]]
+            if exhausted and not dry_run:
+                state['finished'] = time.time()
+            if not dry_run:
+                backfills.save(state)
+            if dry_run:
+                if exhausted:
+                    return get_stats(state, 0, 0, 0, started, None)
+                continue
+
+        done = jobs.find({'backfill': name, 'status': 'done'}).count()
+        failed = jobs.find({'backfill': name, 'status': 'failed'}).count()
+        if finished_at_start is None:
+            finished_at_start = done + failed
+        remaining = outstanding
+        if not exhausted:
+            remaining += posts.find(candidates_query(
+                services, state['cursor'], since)).count() * len(services)
+        stats = get_stats(state, done, failed, remaining, started,
+                          done + failed - finished_at_start)
+        if progress:
+            progress(stats)
+        if exhausted and outstanding == 0:
+            return stats
+        time.sleep(poll_interval)
+
+
+def get_stats(state, done, failed, remaining, started, finished):
+    '''
+    Work out the throughput of the backfill since it was (re)started and the
+    time it will take to finish at that rate.
+    '''
+    elapsed = time.time() - started
+    rate = float(finished) / elapsed if finished and elapsed > 0 else None
+    return {
+        'name': state['_id'],
+        'queued': state['queued'],
+        'skipped': state['skipped'],
+        'done': done,
+        'failed': failed,
+        'remaining': remaining,
+        'rate': rate,
+        'eta': remaining / rate if rate else None
+    }
@@ -24,42 +24,57 @@ import os
 import time
 import urllib
 import cgi
+import threading
 import requests
 import facebook
 from flask import abort, current_app
-from piss.utils import get_post_by_id
 from .utils import is_duplicate_syndication, validate_service
 
 FACEBOOK_ENTITY = 'https://www.facebook.com'
+GRAPH_URL = 'https://graph.facebook.com/'
 SCOPE = 'publish_actions,rsvp_event,user_actions.news,user_actions.video,user_events,user_friends,user_likes,user_location,user_photos,user_status,user_tagged_places,user_videos,user_groups,read_friendlists,read_mailbox,read_stream,manage_notifications'
 
+# Graph API error codes for the app, user and page rate limits
+RATE_LIMIT_ERRORS = (4, 17, 32, 341, 613)
 
-def facebook_handler(data, server_entity):
+_graphs = {}
+_lock = threading.Lock()
+
+
+def facebook_handler(data, post, server_entity):
     '''
-    Syndicates request data to Facebook.
+    Checks that request data and the post it refers to can be syndicated to
+    Facebook, aborting if they can't. The post is sent to Facebook later on by
+    `publish_to_facebook`, from the syndication queue.
 
     :param data: request data with syndication information.
+    :param post: the post to syndicate.
     :param server_entity: the entity we are syndicating for.
     '''
+    if not current_app.config.get('FACEBOOK', None):
+        abort(400, 'Facebook not configured on the server.')
     post_type = os.path.join(server_entity, 'types', 'note')
     errors = validate_service(data, FACEBOOK_ENTITY, post_type)
     if errors:
         abort(422, ' '.join(errors))
     if 'content' not in data or 'text' not in data['content']:
         abort(422, 'Post content not found!')
-    # Get the post we want to syndicate
-    post_id = data['links'][0]['post']
-    post = get_post_by_id(post_id)
-    if not post:
-        abort(404)
-    # Grab the existing links from the post, if any
-    links = []
-    if 'links' in post:
-        links = post['links']
-    if is_duplicate_syndication(links, FACEBOOK_ENTITY):
-        abort(400, 'Post ID %s already syndicated to Facebook.' % (post_id,))
+    if is_duplicate_syndication(post.get('links', []), FACEBOOK_ENTITY):
+        abort(400, 'Post ID %s already syndicated to Facebook.' % (post['_id'],))
+
+
+def publish_to_facebook(post, data, server_entity):
+    '''
+    Posts a status to Facebook, with the post's first image attached, and
+    returns its permalink. Facebook's errors are raised as
+    `facebook.GraphAPIError`.
+
+    :param post: the post being syndicated.
+    :param data: request data with syndication information.
+    :param server_entity: the entity we are syndicating for.
+    '''
     # Grab information for attachments, if any. Make sure they're only the kind
-    # that Twitter accepts and use only the first 4.
+    # that Facebook accepts and use only the first one.
     attachments = []
     if 'attachments' in post:
         attachments = post['attachments']
@@ -71,14 +86,19 @@ def facebook_handler(data, server_entity):
         attachments = [os.path.join(server_entity, 'posts', post['_id'],
                                     x['name']) for x in attachments]
     # Create the Facebook status and grab the permalink
-    try:
-        url = create_status_post(data['content']['text'], attachments)
-    except facebook.GraphAPIError as e:
-        abort(400, str(e))
-    # Append the syndication link and `PATCH` the original post
-    links.append({'entity': FACEBOOK_ENTITY, 'type': 'syndication',
-                 'url': url})
-    return (post_id, links)
+    return create_status_post(data['content']['text'], attachments)
+
+
+def facebook_rate_limit_delay(error):
+    '''
+    Return `0` if an error says that Facebook's rate limit was reached, since
+    Facebook doesn't say for how long, or `None` for any other error.
+    '''
+    if not isinstance(error, facebook.GraphAPIError):
+        return None
+    result = error.result if isinstance(error.result, dict) else {}
+    code = (result.get('error', None) or {}).get('code', None)
+    return 0 if code in RATE_LIMIT_ERRORS else None
 
 
 def create_status_post(message, attachments=None):
@@ -89,10 +109,7 @@ def create_status_post(message, attachments=None):
     :param attachments: optional list of URLs to media attachments.
     :returns: permalink to the status post.
     '''
-    # Get the Facebook configuration
-    fb_conf = current_app.config.get('FACEBOOK', None)
-    if not fb_conf:
-        abort(400, 'Facebook not configured on the server.')
+    graph = get_graph()
     data = {'message': message}
     edge = 'feed'
     r_key = 'id'
@@ -100,13 +117,78 @@ def create_status_post(message, attachments=None):
         edge = 'photos'
         data['url'] = attachments[0]
         r_key = 'post_id'
-    graph = facebook.GraphAPI(fb_conf['access_token'])
     response = graph.put_object("me", edge, **data)
     user_id, post_id = response[r_key].split('_')
     url = 'https://www.facebook.com/%s/posts/%s' % (user_id, post_id)
     return url
 
 
+def get_graph():
+    '''
+    Return this process's Graph API client for the configured access token.
+    Clients are kept for as long as the process lives, so that their
+    connections to Facebook are reused. If `SYNDICATION_SANDBOX_URL` is set,
+    the client talks to the sandbox instead (see
+    `piss.services.syndication.sandbox`).
+    '''
+    fb_conf = current_app.config.get('FACEBOOK', None)
+    if not fb_conf:
+        abort(400, 'Facebook not configured on the server.')
+    sandbox_url = current_app.config.get('SYNDICATION_SANDBOX_URL', None)
+    graph_url = sandbox_url.rstrip('/') + '/facebook/' if sandbox_url \
+        else GRAPH_URL
+    # Connections can't be shared with forked processes
+    key = (os.getpid(), fb_conf['access_token'], graph_url)
+    with _lock:
+        graph = _graphs.get(key, None)
+        if graph is None:
+            graph = _graphs[key] = SessionGraphAPI(
+                fb_conf['access_token'],
+                timeout=current_app.config.get('FACEBOOK_TIMEOUT', 30),
+                url=graph_url)
+    return graph
+
+
+class SessionGraphAPI(facebook.GraphAPI):
+    '''
+    `facebook.GraphAPI` opens a new connection with `urllib2` for every
+    request. This one sends requests through a `requests` session instead,
+    which keeps the connection to Facebook open between requests.
+    '''
+    def __init__(self, access_token=None, timeout=None, url=GRAPH_URL):
+        super(SessionGraphAPI, self).__init__(access_token, timeout)
+        self.session = requests.Session()
+        self.url = url
+
+    def request(self, path, args=None, post_args=None):
+        args = dict(args or {})
+        if post_args is not None:
+            post_args = dict(post_args)
+        if self.access_token:
+            if post_args is not None:
+                post_args['access_token'] = self.access_token
+            else:
+                args['access_token'] = self.access_token
+        response = self.session.request(
+            'GET' if post_args is None else 'POST',
+            self.url + path, params=args,
+            data=post_args, timeout=self.timeout)
+        content_type = response.headers.get('content-type', '')
+        if content_type.startswith('image/'):
+            return {
+                'data': response.content,
+                'mime-type': content_type,
+                'url': response.url
+            }
+        try:
+            result = response.json()
+        except ValueError:
+            raise facebook.GraphAPIError(response.text)
+        if isinstance(result, dict) and result.get('error', None):
+            raise facebook.GraphAPIError(result)
+        return result
+
+
 def oauth_authorize(client_id, redirect_uri):
     '''
     Return the URL of a page that will let the user authorize permissions for
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+'''
+Syndication Handlers
+
+The services posts can be syndicated to. Each one has:
+
+* `entity`: the entity of the service, used in syndication links.
+* `check`: a function called with the request data, the post and the server
+  entity while handling a syndication request, which aborts if the post
+  can't be syndicated.
+* `publish`: a function called with the post, the request data and the
+  server entity by the syndication worker, which posts to the service and
+  returns the permalink of the new status.
+* `rate_limit_delay`: a function called with an error raised by `publish`,
+  which returns `None` unless the error says that the service's rate limit
+  was reached. See `piss.services.syndication.limits`.
+'''
+
+from collections import namedtuple
+from .twitter import twitter_handler, publish_to_twitter, \
+    twitter_rate_limit_delay, TWITTER_ENTITY
+from .fb import facebook_handler, publish_to_facebook, \
+    facebook_rate_limit_delay, FACEBOOK_ENTITY
+
+SyndicationHandler = namedtuple('SyndicationHandler',
+                                ('entity', 'check', 'publish',
+                                 'rate_limit_delay'))
+
+HANDLERS = {
+    'twitter': SyndicationHandler(TWITTER_ENTITY, twitter_handler,
+                                  publish_to_twitter,
+                                  twitter_rate_limit_delay),
+    'facebook': SyndicationHandler(FACEBOOK_ENTITY, facebook_handler,
+                                   publish_to_facebook,
+                                   facebook_rate_limit_delay)
+}
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+'''
+Syndication Jobs
+
+Syndication requests are checked right away, but the posts are sent to the
+services by a separate worker (`python manage.py syndication-worker`), so
+that a slow service never holds up a web server worker and a crash never
+loses a request.
+
+Jobs are kept in the `syndication_jobs` collection, one per post and
+service, so syndicating the same post twice only ever creates one job:
+
+    {
+        "_id": "2JHuHA-twitter",
+        "post": "2JHuHA",
+        "service": "twitter",
+        "data": {...},              (the syndication request)
+        "status": "queued",         (or "running", "done" or "failed")
+        "attempts": 0,
+        "next_run": 1427846400.0,
+        "lease": null,
+        "url": null,                (the permalink, once published)
+        "error": null,
+        "backfill": null,           (see `piss.services.syndication.backfill`)
+        "created": 1427846400.0,
+        "updated": 1427846400.0
+    }
+
+A worker claims a job by setting its status to `running` with a lease of
+`SYNDICATION_LEASE` seconds (5 minutes by default), along with any other
+jobs for the same post that are due. The post is then published to all of
+their services at the same time, and the new syndication links are added to
+it with a single patch. Jobs whose lease runs out (because their worker died)
+are claimed again. When a service fails, the job is retried after
+`SYNDICATION_RETRY_DELAY` seconds (30 by default), doubling every time, up to
+`SYNDICATION_MAX_ATTEMPTS` attempts (5 by default).
+Problems that retrying won't fix, like a post that has since been deleted,
+fail the job straight away.
+
+Services are only called as often as their rate limits allow (see
+`piss.services.syndication.limits`). Jobs that would go over a limit, or that
+run into it, wait in the queue without it counting as an attempt.
+
+The permalink is saved as soon as the service returns it, so a job that's
+retried after that point only patches the post and never publishes twice.
+The links are added to the latest version of the post, checked with its
+ETag, so that edits made while the services were being called aren't lost.
+'''
+
+import time
+import random
+from multiprocessing.pool import ThreadPool
+from flask import current_app
+from werkzeug.exceptions import HTTPException
+from pymongo.errors import DuplicateKeyError
+from eve.methods.patch import patch_internal
+from eve.utils import config, document_etag
+from piss.utils import get_post_by_id
+from .handlers import HANDLERS
+from .limits import take_token, block_service
+from .utils import is_duplicate_syndication
+
+JOB_COLLECTION = 'syndication_jobs'
+
+# Longest wait between two attempts, in seconds
+MAX_RETRY_DELAY = 60 * 60
+
+# Times the links are patched into a post that keeps changing under them
+PATCH_ATTEMPTS = 5
+
+
+def get_jobs():
+    return current_app.data.driver.db[JOB_COLLECTION]
+
+
+def get_job_id(post_id, service):
+    return '%s-%s' % (post_id, service)
+
+
+def enqueue_job(post_id, service, data, backfill=None):
+    '''
+    Queue a post to be syndicated to a service and return the job. If there
+    already is a job for the post and service, it's returned instead, after
+    being queued again if it had failed.
+
+    :param post_id: the ID of the post to syndicate.
+    :param service: the service to syndicate to.
+    :param data: the syndication request data.
+    :param backfill: the name of the backfill queuing the job, if any. Jobs
+                     from backfills only run when no other job is due.
+    '''
+    jobs = get_jobs()
+    now = time.time()
+    job = {
+        '_id': get_job_id(post_id, service),
+        'post': post_id,
+        'service': service,
+        'data': data,
+        'status': 'queued',
+        'attempts': 0,
+        'next_run': now,
+        'lease': None,
+        'url': None,
+        'error': None,
+        'backfill': backfill,
+        'created': now,
+        'updated': now
+    }
+    try:
+        jobs.insert(job)
+        return job
+    except DuplicateKeyError:
+        pass
+    requeued = jobs.find_and_modify(
+        {'_id': job['_id'], 'status': 'failed'},
+        {'$set': {'status': 'queued', 'data': data, 'attempts': 0,
+                  'next_run': now, 'error': None, 'updated': now}},
+        new=True)
+    return requeued or jobs.find_one({'_id': job['_id']})
+
+
+def get_job(job_id):
+    return get_jobs().find_one({'_id': job_id})
+
+
+def claim_jobs():
+    '''
+    Claim the next job that's due, or one whose worker has died, along with
+    the other jobs for the same post that are due, and return them. Returns
+    an empty list if there is nothing to do.
+    '''
+    now = time.time()
+    lease = current_app.config.get('SYNDICATION_LEASE', 5 * 60)
+    due = {'$or': [{'status': 'queued', 'next_run': {'$lte': now}},
+                   {'status': 'running', 'lease': {'$lt': now}}]}
+    claim = {'$set': {'status': 'running', 'lease': now + lease,
+                      'updated': now},
+             '$inc': {'attempts': 1}}
+    jobs = get_jobs()
+    claimed = []
+    # Jobs without a backfill sort first
+    job = jobs.find_and_modify(due, claim,
+                               sort=[('backfill', 1), ('next_run', 1)],
+                               new=True)
+    while job is not None:
+        claimed.append(job)
+        job = jobs.find_and_modify(dict(due, post=job['post']), claim,
+                                   new=True)
+    return claimed
+
+
+def run_jobs(claimed):
+    '''
+    Publish a post to the services of the claimed jobs at the same time, then
+    add all of the new syndication links to the post with a single patch.
+    Failures are retried later unless they're permanent. Returns the status
+    of each job, in order.
+
+    :param claimed: jobs for the same post, as returned by `claim_jobs`.
+    '''
+    post_id = claimed[0]['post']
+    post = get_post_by_id(post_id)
+    if not post:
+        return [finish_job(job, 'failed', error='Post not found.')
+                for job in claimed]
+
+    # The services are called from threads, which need an app context
+    app = current_app._get_current_object()
+    server_entity = current_app.config.get('META_POST')['entity']
+
+    def publish(job):
+        if job.get('url', None):
+            # Published by an earlier attempt
+            return job['url'], None
+        try:
+            with app.app_context():
+                return HANDLERS[job['service']].publish(
+                    post, job['data'], server_entity), None
+        except Exception as e:
+            return None, e
+
+    # Jobs that would go over their service's rate limit wait for a token
+    statuses = [None] * len(claimed)
+    ready = []
+    for index, job in enumerate(claimed):
+        wait = 0 if job.get('url', None) else take_token(job['service'])
+        if wait:
+            statuses[index] = defer_job(job, wait)
+        else:
+            ready.append(index)
+
+    if len(ready) < 2:
+        results = [publish(claimed[index]) for index in ready]
+    else:
+        pool = ThreadPool(len(ready))
+        try:
+            results = pool.map(publish, [claimed[index] for index in ready])
+        finally:
+            pool.close()
+
+    jobs = get_jobs()
+    links = post.get('links', None) or []
+    new_links = []
+    published = []
+    for index, (url, error) in zip(ready, results):
+        job = claimed[index]
+        if error is not None:
+            delay = HANDLERS[job['service']].rate_limit_delay(error)
+            if delay is not None:
+                statuses[index] = defer_job(
+                    job, block_service(job['service'], delay))
+            else:
+                statuses[index] = fail_job(job, error)
+            continue
+        if not job.get('url', None):
+            jobs.update({'_id': job['_id']},
+                        {'$set': {'url': url, 'updated': time.time()}})
+        entity = HANDLERS[job['service']].entity
+        if not is_duplicate_syndication(links, entity):
+            new_links.append({'entity': entity, 'type': 'syndication', 'url': url})
+        published.append(index)
+
+    if published:
+        try:
+            if new_links:
+                patch_links(post_id, new_links)
+        except Exception as e:
+            for index in published:
+                statuses[index] = fail_job(claimed[index], e)
+        else:
+            for index in published:
+                statuses[index] = finish_job(claimed[index], 'done')
+    return statuses
+
+
+def patch_links(post_id, new_links):
+    '''
+    Add syndication links to a post. The post is read again right before the
+    patch, which only goes through if the post hasn't changed since, so that
+    edits (and links added by other workers) made while the services were
+    being called are kept. If it has changed, the patch is tried again with
+    the new version. Links to services the post already has a link to are
+    skipped.
+    '''
+    for attempt in range(PATCH_ATTEMPTS):
+        post = get_post_by_id(post_id)
+        if not post:
+            raise JobFailed('Post not found.')
+        links = post.get('links', None) or []
+        added = [link for link in new_links
+                 if not is_duplicate_syndication(links, link['entity'])]
+        if not added:
+            return
+        etag = post.get(config.ETAG, None) or document_etag(post)
+        try:
+            # Eve takes the version the patch applies to from `If-Match`
+            with current_app.test_request_context(headers={'If-Match': etag}):
+                _, _, _, status = patch_internal(
+                    'posts', {'links': links + added}, concurrency_check=True,
+                    **{'_id': post_id})
+        except HTTPException as e:
+            # `before_update_posts` responds to a no-op patch straight away
+            if e.response is not None and e.response.status_code == 200:
+                return
+            if e.code == 412:
+                # Changed since it was read
+                continue
+            raise
+        if status not in (200, 201):
+            raise JobFailed('Could not patch the post (%d).' % (status,),
+                            retry=True)
+        return
+    raise JobFailed('The post kept changing while it was being patched.',
+                    retry=True)
+
+
+def fail_job(job, error):
+    '''
+    Retry a job later, or fail it for good if retrying won't help.
+    '''
+    if isinstance(error, HTTPException):
+        return finish_job(job, 'failed',
+                          error=error.description or 'Could not patch the post.')
+    if isinstance(error, JobFailed) and not error.retry:
+        return finish_job(job, 'failed', error=str(error))
+    # The service failed, or couldn't be reached
+    return retry_job(job, '%s: %s' % (type(error).__name__, error))
+
+
+def retry_job(job, error):
+    max_attempts = current_app.config.get('SYNDICATION_MAX_ATTEMPTS', 5)
+    if job['attempts'] >= max_attempts:
+        return finish_job(job, 'failed', error=error)
+    delay = current_app.config.get('SYNDICATION_RETRY_DELAY', 30) \
+        * 2 ** (job['attempts'] - 1)
+    delay = min(delay, MAX_RETRY_DELAY) * random.uniform(1, 1.25)
+    now = time.time()
+    get_jobs().update({'_id': job['_id'], 'status': 'running'},
+                      {'$set': {'status': 'queued', 'next_run': now + delay,
+                                'lease': None, 'error': error,
+                                'updated': now}})
+    return 'queued'
+
+
+def defer_job(job, delay):
+    '''
+    Put a job back in the queue for `delay` seconds without counting the
+    attempt, because of a rate limit.
+    '''
+    now = time.time()
+    get_jobs().update({'_id': job['_id'], 'status': 'running'},
+                      {'$set': {'status': 'queued', 'next_run': now + delay,
+                                'lease': None, 'updated': now},
+                       '$inc': {'attempts': -1}})
+    return 'queued'
+
+
+def finish_job(job, status, error=None):
+    get_jobs().update({'_id': job['_id'], 'status': 'running'},
+                      {'$set': {'status': status, 'lease': None,
+                                'error': error, 'updated': time.time()}})
+    return status
+
+
+def run_worker(app, poll_interval=1.0, progress=None):
+    '''
+    Run jobs as they become due, forever. The jobs for each post get a
+    request context of their own.
+
+    :param app: the app to run jobs for.
+    :param poll_interval: seconds to wait when there's nothing to do.
+    :param progress: optional function called with each job and its status.
+    '''
+    while True:
+        with app.test_request_context():
+            claimed = claim_jobs()
+            if claimed:
+                statuses = run_jobs(claimed)
+        if not claimed:
+            time.sleep(poll_interval)
+        elif progress:
+            for job, status in zip(claimed, statuses):
+                progress(job, status)
+
+
+def job_status(job):
+    '''
+    Return the parts of a job that are of interest to clients.
+    '''
+    return dict((key, job.get(key, None)) for key in
+                ('_id', 'post', 'service', 'status', 'attempts', 'url',
+                 'error', 'created', 'updated'))
+
+
+class JobFailed(Exception):
+    def __init__(self, message, retry=False):
+        super(JobFailed, self).__init__(message)
+        self.retry = retry
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+'''
+Syndication Rate Limits
+
+Every service has a token bucket in the `syndication_limits` collection,
+shared by all of the syndication workers:
+
+    {
+        "_id": "twitter",
+        "tokens": 12.5,
+        "updated": 1427846400.0,
+        "blocked_until": 0
+    }
+
+Publishing a post takes a token. Tokens are added back at the rate set for
+the service in `SYNDICATION_RATE_LIMITS`, as a `(requests, seconds)` tuple,
+up to `requests` tokens. The defaults follow the services' published limits
+for posting statuses:
+
+    SYNDICATION_RATE_LIMITS = {
+        'twitter': (300, 3 * 60 * 60),
+        'facebook': (200, 60 * 60)
+    }
+
+When a service says that the limit has been reached anyway (e.g. because the
+account is also used by another app), the bucket is blocked until the time
+the service gives, or for `SYNDICATION_RATE_LIMIT_BACKOFF` seconds (15
+minutes by default) if it doesn't give one.
+'''
+
+import time
+from flask import current_app
+
+LIMITS_COLLECTION = 'syndication_limits'
+
+DEFAULT_RATE_LIMITS = {
+    'twitter': (300, 3 * 60 * 60),
+    'facebook': (200, 60 * 60)
+}
+
+
+def get_limits():
+    return current_app.data.driver.db[LIMITS_COLLECTION]
+
+
+def get_rate_limit(service):
+    limits = current_app.config.get('SYNDICATION_RATE_LIMITS', {})
+    return limits.get(service, None) or DEFAULT_RATE_LIMITS.get(service, None)
+
+
+def take_token(service):
+    '''
+    Take a token from a service's bucket. Returns `0` if one was taken, or
+    else the number of seconds until one will be available.
+
+    :param service: the service to publish to.
+    '''
+    rate_limit = get_rate_limit(service)
+    if rate_limit is None:
+        return 0
+    capacity, period = rate_limit
+    rate = float(capacity) / period
+    limits = get_limits()
+    while True:
+        now = time.time()
+        bucket = limits.find_one({'_id': service})
+        if bucket is None:
+            bucket = {'_id': service, 'tokens': float(capacity),
+                      'updated': now, 'blocked_until': 0}
+            limits.update({'_id': service}, {'$setOnInsert': bucket},
+                          upsert=True)
+            continue
+        if bucket.get('blocked_until', 0) > now:
+            return bucket['blocked_until'] - now
+        tokens = min(capacity,
+                     bucket['tokens'] + (now - bucket['updated']) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        # Only take the token if no other worker has touched the bucket since
+        # it was read, or else try again
+        result = limits.update(
+            {'_id': service, 'tokens': bucket['tokens'],
+             'updated': bucket['updated']},
+            {'$set': {'tokens': tokens - 1, 'updated': now}})
+        if result['n']:
+            return 0
+
+
+def block_service(service, delay=None):
+    '''
+    Stop publishing to a service for `delay` seconds, after it said that the
+    rate limit was reached. Returns the delay.
+    '''
+    if delay is None or delay <= 0:
+        delay = current_app.config.get('SYNDICATION_RATE_LIMIT_BACKOFF',
+                                       15 * 60)
+    get_limits().update(
+        {'_id': service},
+        {'$max': {'blocked_until': time.time() + delay},
+         '$set': {'tokens': 0, 'updated': time.time()}},
+        upsert=True)
+    return delay
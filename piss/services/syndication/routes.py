@@ -4,14 +4,15 @@
 Syndication Routes
 '''
 
-from flask import abort, Blueprint, current_app, request
-from eve.methods.patch import patch_internal
+from flask import abort, Blueprint, current_app, g, make_response, request, \
+    url_for
+from werkzeug.exceptions import HTTPException
 from piss.auth import requires_auth
+from piss.utils import get_post_by_id
 from piss.services.utils import render_response
-from .twitter import twitter_handler
-from .fb import facebook_handler
+from .handlers import HANDLERS
+from .jobs import enqueue_job, get_job, job_status
 
-VALID_SERVICES = ('twitter','facebook')
 syndication = Blueprint('syndication', __name__)
 
 
@@ -19,29 +20,113 @@ syndication = Blueprint('syndication', __name__)
 @requires_auth()
 def syndicate(service):
     '''
-    Syndicate a post to the given service. Checks if the original post exists
-    and if it hasn't been syndicated to the given service already.
+    Queue a post to be syndicated to the given service. Checks if the original
+    post exists and if it hasn't been syndicated to the given service already,
+    then responds with `202 Accepted` and the URL of the job, which can be
+    polled to find out how it went. See `piss.services.syndication.jobs`.
 
     :param service: the service to syndicate to.
     '''
     service = service.lower()
-    if service not in VALID_SERVICES:
+    if service not in HANDLERS:
         abort(400, 'Service not recognized.')
 
+    # Get the data and check it with the handler for the appropriate service
+    data = get_syndication_data()
+    post = get_syndicated_post(data)
+    meta_post = current_app.config.get('META_POST')
+    HANDLERS[service].check(data, post, meta_post['entity'])
+
+    job = enqueue_job(post['_id'], service, data)
+    return make_response(
+        render_response(job_status(job), 'item.html',
+                        title="Syndicate to %s"
+                        % (service.lower().capitalize(),)),
+        202, {'Location': job_url(job)})
+
+
+@syndication.route('/syndicate', methods=['POST'])
+@requires_auth()
+def syndicate_all():
+    '''
+    Queue a post to be syndicated to several services at once. The request
+    data is the same as for a single service, without the `entity`, plus a
+    `services` list. The response holds the job for each service that was
+    accepted (with its URL in `job`) and the error for each one that wasn't,
+    keyed by service. The jobs run together, so the post is only patched
+    once.
+    '''
+    data = get_syndication_data()
+    services = data.pop('services', None)
+    if not isinstance(services, list) or not services:
+        abort(400, 'List the services to syndicate to in `services`.')
+    services = [service.lower() for service in services]
+    unknown = [service for service in services if service not in HANDLERS]
+    if unknown:
+        abort(400, 'Service not recognized: %s.' % (', '.join(unknown),))
+
+    post = get_syndicated_post(data)
+    meta_post = current_app.config.get('META_POST')
+    results = {}
+    accepted = False
+    for service in services:
+        handler = HANDLERS[service]
+        service_data = dict(data, entity=handler.entity)
+        try:
+            handler.check(service_data, post, meta_post['entity'])
+        except HTTPException as e:
+            results[service] = {'status': 'rejected', 'code': e.code,
+                                'error': e.description}
+            continue
+        job = enqueue_job(post['_id'], service, service_data)
+        results[service] = job_status(job)
+        results[service]['job'] = job_url(job)
+        accepted = True
+    return make_response(
+        render_response(results, 'item.html', title="Syndicate"),
+        202 if accepted else 400)
+
+
+@syndication.route('/syndicate/jobs/<job_id>')
+@requires_auth()
+def syndication_job(job_id):
+    '''
+    Return the status of a syndication job.
+
+    :param job_id: the job ID.
+    '''
+    if getattr(g, 'non_authed_GET', False):
+        # Jobs hold the syndication requests, so they aren't public
+        return current_app.auth.authenticate()
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+    return render_response(job_status(job), 'item.html',
+                           title="Syndication Job")
+
+
+def get_syndication_data():
     if request.mimetype != 'application/json':
         abort(400, 'Syndication endpoint only accepts JSON data.')
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    return data
 
-    # Get the data and launch the handler for the appropriate service
-    data = request.json
-    meta_post = current_app.config.get('META_POST')
-    post_id, links = eval('%s_handler' % service)(data, meta_post['entity'])
-    
-    # Patch the original post with the new links object
-    response, _, _, status = patch_internal('posts', {'links': links},
-                                            concurrency_check=False,
-                                            **{'_id': post_id})
-    if status not in (200, 201):
-        abort(status)
-    return render_response(response, 'item.html',
-                           title="Syndicate to %s"
-                           % (service.lower().capitalize(),))
+
+def get_syndicated_post(data):
+    '''
+    Get the post that the request data wants syndicated, aborting if there
+    isn't one.
+    '''
+    links = data.get('links', None)
+    if not links or not isinstance(links[0], dict) or 'post' not in links[0]:
+        abort(422, 'Post ID not specified.')
+    post = get_post_by_id(links[0]['post'])
+    if not post:
+        abort(404)
+    return post
+
+
+def job_url(job):
+    return url_for('.syndication_job', job_id=job['_id'], _external=True)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+'''
+Syndication Sandbox
+
+A stand-in for the parts of the Twitter and Facebook Graph APIs that the
+syndication handlers use, so that syndication can be tried out and measured
+without live accounts. Start it with `python manage.py syndication-sandbox`
+and point the handlers at it with:
+
+    SYNDICATION_SANDBOX_URL = 'http://localhost:5050'
+
+Every response takes `latency` seconds, plus up to `jitter` more. A fraction
+`error_rate` of the requests fail the way the services do when they're
+overloaded. If `limit` is set, each service only accepts that many requests
+every `window` seconds and answers the rest as the services do when their
+rate limit is reached (a `429` with `X-Rate-Limit-Reset` from Twitter, error
+code `4` from Facebook).
+
+`GET /stats` returns the number of requests, errors and rate limited requests
+for each service.
+'''
+
+import time
+import random
+import itertools
+import threading
+from flask import Flask, jsonify, request
+
+SERVICES = ('twitter', 'facebook')
+SANDBOX_USER = 'sandbox'
+SANDBOX_USER_ID = '1000'
+
+
+def create_sandbox(latency=0.1, jitter=0.0, error_rate=0.0, limit=None,
+                   window=15 * 60):
+    '''
+    Create the sandbox app.
+
+    :param latency: the shortest time a response takes, in seconds.
+    :param jitter: the most time added at random to `latency`, in seconds.
+    :param error_rate: the fraction of requests that fail, from `0` to `1`.
+    :param limit: the number of requests each service accepts in a window,
+                  or `None` for no rate limit.
+    :param window: the length of a rate limit window, in seconds.
+    '''
+    app = Flask(__name__)
+    lock = threading.Lock()
+    ids = itertools.count(int(time.time() * 1000))
+    stats = dict((service, {'requests': 0, 'errors': 0, 'rate_limited': 0})
+                 for service in SERVICES)
+    windows = dict((service, [0, 0]) for service in SERVICES)
+
+    def respond(service, make_response):
+        '''
+        Wait, count the request against the service's limit, and return an
+        error or the response built by `make_response` from a new ID.
+        '''
+        time.sleep(latency + random.uniform(0, jitter))
+        now = time.time()
+        with lock:
+            service_stats = stats[service]
+            service_stats['requests'] += 1
+            reset, count = windows[service]
+            if now >= reset:
+                reset, count = now + window, 0
+            windows[service] = [reset, count + 1]
+            if limit is not None and count >= limit:
+                service_stats['rate_limited'] += 1
+                return rate_limited(service, reset)
+            if random.random() < error_rate:
+                service_stats['errors'] += 1
+                return failed(service)
+            new_id = next(ids)
+        return make_response(new_id)
+
+    @app.route('/twitter/1.1/statuses/update.json', methods=['POST'])
+    def twitter_update_status():
+        status = request.form.get('status', '')
+        return respond('twitter', lambda new_id: jsonify({
+            'id': new_id,
+            'id_str': str(new_id),
+            'text': status,
+            'user': {'screen_name': SANDBOX_USER}
+        }))
+
+    @app.route('/twitter/1.1/media/upload.json', methods=['POST'])
+    def twitter_upload_media():
+        return respond('twitter', lambda new_id: jsonify({
+            'media_id': new_id,
+            'media_id_string': str(new_id)
+        }))
+
+    @app.route('/facebook/<user>/<edge>', methods=['POST'])
+    def facebook_put_object(user, edge):
+        def make_response(new_id):
+            post_id = '%s_%d' % (SANDBOX_USER_ID, new_id)
+            if edge == 'photos':
+                return jsonify({'id': str(new_id), 'post_id': post_id})
+            return jsonify({'id': post_id})
+        return respond('facebook', make_response)
+
+    @app.route('/stats')
+    def sandbox_stats():
+        with lock:
+            return jsonify(stats)
+
+    return app
+
+
+def rate_limited(service, reset):
+    if service == 'twitter':
+        response = jsonify({'errors': [
+            {'code': 88, 'message': 'Rate limit exceeded'}]})
+        response.status_code = 429
+        response.headers['X-Rate-Limit-Reset'] = str(int(reset) + 1)
+        return response
+    response = jsonify({'error': {
+        'code': 4, 'type': 'OAuthException',
+        'message': '(#4) Application request limit reached'}})
+    response.status_code = 400
+    return response
+
+
+def failed(service):
+    if service == 'twitter':
+        response = jsonify({'errors': [
+            {'code': 130, 'message': 'Over capacity'}]})
+        response.status_code = 503
+        return response
+    response = jsonify({'error': {
+        'code': 2, 'type': 'OAuthException',
+        'message': 'An unexpected error has occurred. Please retry your '
+                   'request later.'}})
+    response.status_code = 500
+    return response
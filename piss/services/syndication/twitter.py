@@ -17,44 +17,60 @@ http://localhost:5000/syndicate/twitter -d '{"entity":"https://twitter.com/",
 '''
 
 import os
-from twython import Twython, TwythonError
+import time
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from twython import Twython, TwythonError, TwythonRateLimitError
 from flask import abort, current_app
-from piss.file_io import get_attachment_file
-from piss.utils import get_post_by_id
+from piss.file_io import open_attachment
 from .utils import is_duplicate_syndication, validate_service
 
 TWITTER_ENTITY = 'https://twitter.com'
+UPLOAD_URL = 'https://upload.twitter.com/1.1/media/upload.json'
 
+# Media uploads that may run at the same time in each process. Twitter takes
+# up to 4 images per status.
+UPLOAD_THREADS = 4
 
-def twitter_handler(data, server_entity):
+_clients = {}
+_upload_pool = None
+_lock = threading.Lock()
+
+
+def twitter_handler(data, post, server_entity):
     '''
-    Syndicates request data to Twitter.
+    Checks that request data and the post it refers to can be syndicated to
+    Twitter, aborting if they can't. The post is sent to Twitter later on by
+    `publish_to_twitter`, from the syndication queue.
 
     :param data: request data with syndication information.
+    :param post: the post to syndicate.
     :param server_entity: the entity we are syndicating for.
     '''
-    tw_conf = current_app.config.get('TWITTER', None)
-    if not tw_conf:
+    if not current_app.config.get('TWITTER', None):
         abort(400, 'Twitter not configured on the server.')
-    tw = Twython(tw_conf['app_key'], tw_conf['app_secret'],
-                 tw_conf['token'], tw_conf['token_secret'])
     post_type = os.path.join(server_entity, 'types', 'note')
     errors = validate_service(data, TWITTER_ENTITY, post_type)
     if errors:
         abort(422, ' '.join(errors))
     if 'content' not in data or 'text' not in data['content']:
         abort(422, 'Post content not found!')
-    # Get the post we want to syndicate
-    post_id = data['links'][0]['post']
-    post = get_post_by_id(post_id)
-    if not post:
-        abort(404)
-    # Grab the existing links from the post, if any
-    links = []
-    if 'links' in post:
-        links = post['links']
-    if is_duplicate_syndication(links, TWITTER_ENTITY):
-        abort(400, 'Post ID %s already syndicated to Twitter.' % (post_id,))
+    if is_duplicate_syndication(post.get('links', []), TWITTER_ENTITY):
+        abort(400, 'Post ID %s already syndicated to Twitter.' % (post['_id'],))
+
+
+def publish_to_twitter(post, data, server_entity):
+    '''
+    Posts a status to Twitter, with the post's images attached, and returns
+    its permalink. Twitter's errors are raised as `TwythonError`.
+
+    :param post: the post being syndicated.
+    :param data: request data with syndication information.
+    :param server_entity: the entity we are syndicating for.
+    '''
+    tw = get_twitter_client()
     # Grab information for attachments, if any. Make sure they're only the kind
     # that Twitter accepts and use only the first 4.
     attachments = []
@@ -63,26 +79,32 @@ def twitter_handler(data, server_entity):
     attachments = [x for x in attachments if x['content_type']\
                    in ('image/gif', 'image/jpeg', 'image/png')]
     if len(attachments) > 4:
-        attachments = attachments[0:3]
-    media_ids = []
-    try:
-        for attachment in attachments:
-            media_id = upload_media(tw,
-                                    get_attachment_file(attachment['digest']),
-                                    attachment['content_type'])
-            media_ids.append(media_id)
-    except TwythonError as e:
-        abort(400, str(e))
+        attachments = attachments[0:4]
+    media = []
+    for attachment in attachments:
+        blob = open_attachment(attachment['digest'])
+        if blob is None:
+            abort(404)
+        media.append((blob, attachment['content_type']))
+    media_ids = upload_all_media(tw, media)
     if not len(media_ids):
         media_ids = None
     # Create the twitter status and grab the permalink
+    return create_tweet(tw, data['content']['text'], media_ids=media_ids)
+
+
+def twitter_rate_limit_delay(error):
+    '''
+    Return how many seconds to wait if an error says that Twitter's rate limit
+    was reached (`0` if Twitter didn't say), or `None` for any other error.
+    '''
+    if not isinstance(error, TwythonRateLimitError):
+        return None
     try:
-        url = create_tweet(tw, data['content']['text'], media_ids=media_ids)
-    except TwythonError as e:
-        abort(400, str(e))
-    # Append the syndication link and `PATCH` the original post
-    links.append({'entity': TWITTER_ENTITY, 'type': 'syndication', 'url': url})
-    return (post_id, links)
+        # The `X-Rate-Limit-Reset` header, as a UNIX timestamp
+        return max(int(error.retry_after) - time.time(), 0)
+    except (TypeError, ValueError):
+        return 0
 
 
 def create_tweet(tw, status, media_ids=None):
@@ -100,14 +122,105 @@ def create_tweet(tw, status, media_ids=None):
     return url
 
 
-def upload_media(tw, media_path, media_type):
+def get_twitter_client():
+    '''
+    Return this process's Twitter client for the configured account. Clients
+    are kept for as long as the process lives, so that their connections to
+    Twitter are reused. If `SYNDICATION_SANDBOX_URL` is set, the client talks
+    to the sandbox instead (see `piss.services.syndication.sandbox`).
+    '''
+    tw_conf = current_app.config.get('TWITTER', None)
+    if not tw_conf:
+        abort(400, 'Twitter not configured on the server.')
+    sandbox_url = current_app.config.get('SYNDICATION_SANDBOX_URL', None)
+    # Connections can't be shared with forked processes
+    key = (os.getpid(), tw_conf['app_key'], tw_conf['token'], sandbox_url)
+    with _lock:
+        tw = _clients.get(key, None)
+        if tw is None:
+            tw = Twython(tw_conf['app_key'], tw_conf['app_secret'],
+                         tw_conf['token'], tw_conf['token_secret'],
+                         client_args={'timeout': current_app.config.get(
+                             'TWITTER_TIMEOUT', 30)})
+            adapter = HTTPAdapter(pool_maxsize=UPLOAD_THREADS + 1)
+            tw.client.mount('https://', adapter)
+            tw.upload_url = UPLOAD_URL
+            if sandbox_url:
+                tw.client.mount('http://', adapter)
+                tw.api_url = sandbox_url.rstrip('/') + '/twitter/%s'
+                tw.upload_url = tw.api_url % '1.1/media/upload.json'
+            _clients[key] = tw
+    return tw
+
+
+def get_upload_pool():
+    global _upload_pool
+    with _lock:
+        if _upload_pool is None or _upload_pool[0] != os.getpid():
+            _upload_pool = (os.getpid(), ThreadPool(UPLOAD_THREADS))
+        return _upload_pool[1]
+
+
+def upload_all_media(tw, media):
+    '''
+    Uploads media files to Twitter at the same time and returns their media
+    IDs, in order. If an upload fails, or they don't all finish within
+    `TWITTER_UPLOAD_DEADLINE` seconds (60 by default), the uploads that
+    haven't started yet are skipped and the error is raised.
+
+    :param tw: the Twitter object to use to send the requests.
+    :param media: a list of `(blob, media_type)` tuples.
+    '''
+    if len(media) < 2:
+        return [upload_media(tw, blob, media_type) for blob, media_type in media]
+    deadline = time.time() + current_app.config.get('TWITTER_UPLOAD_DEADLINE', 60)
+    cancelled = threading.Event()
+    results = Queue.Queue()
+
+    def upload(index, blob, media_type):
+        if cancelled.is_set():
+            return
+        try:
+            results.put((index, upload_media(tw, blob, media_type), None))
+        except Exception as e:
+            results.put((index, None, e))
+
+    pool = get_upload_pool()
+    for index, (blob, media_type) in enumerate(media):
+        pool.apply_async(upload, (index, blob, media_type))
+    media_ids = [None] * len(media)
+    try:
+        for _ in media:
+            try:
+                index, media_id, error = results.get(
+                    timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                raise UploadTimeout('Media uploads to Twitter timed out.')
+            if error is not None:
+                raise error
+            media_ids[index] = media_id
+    except:
+        cancelled.set()
+        raise
+    return media_ids
+
+
+def upload_media(tw, blob, media_type):
     '''
     Uploads a media file to Twitter in order to attach it to a status.
 
     :param tw: the Twitter object to use to send the request.
-    :param media: the media to be attached.
+    :param blob: the stored attachment, see `piss.storage.Blob`.
     :returns: media_id returned from Twitter.
     '''
-    with open(media_path, 'rb') as media:
-        post = tw.upload_media(media=media, image_type=media_type)
+    # `tw.post` refuses `http://` URLs, which the sandbox uses, so call what
+    # it would call for an `https://` one directly
+    with blob.open() as media:
+        post = tw._request(tw.upload_url, method='POST',
+                           params={'media': media, 'image_type': media_type},
+                           api_call=tw.upload_url)
     return post['media_id']
+
+
+class UploadTimeout(TwythonError):
+    pass
@@ -30,6 +30,6 @@ def is_duplicate_syndication(links, entity):
     :param entity: the entity we are checking for.
     '''
     for link in links:
-        if link['entity'] == entity and link['type'] == 'syndication':
+        if link.get('entity', None) == entity and link.get('type', None) == 'syndication':
             return True
     return False
\ No newline at end of file
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+'''
+Upload session routes
+
+Large attachments can be uploaded in pieces instead of in a single multipart
+`POST /posts` request, so that a dropped connection only costs the piece that
+was in flight:
+
+1. `POST /uploads` with a JSON body giving the `size` of the file in bytes,
+   and optionally its `name`, `content_type` and expected `digest`. The
+   response holds the session `id` and its `url`.
+2. `PUT /uploads/<id>` with a `Content-Range: bytes <first>-<last>/<size>`
+   header and the bytes of that range as the body, once for every range.
+   Ranges can be sent in any order, in parallel, and sent again. Whatever
+   part of a range arrived before a connection dropped is kept.
+3. `GET /uploads/<id>` returns the `received` and `missing` byte ranges
+   (`[start, stop)` pairs), so a client knows what's left to send after a
+   failure.
+4. `POST /uploads/<id>/commit`, optionally with `name`, `content_type` and
+   `derivatives` (see `piss.derivatives`), returns `202` straight away while
+   the file is hashed and handed to the attachment storage in the
+   background, so a large file doesn't tie up the request. `GET
+   /uploads/<id>` reports the session's `status` as `committing` until then,
+   and `committed` with an `attachments` object in `attachment` afterwards,
+   the same as the ones multipart uploads produce, which can then be listed
+   in a post's `attachments`. If the session was given a `digest` and the
+   file doesn't match, or the file couldn't be stored, the status goes back
+   to `open` with the reason in `error`; a digest mismatch also drops the
+   received ranges.
+
+`DELETE /uploads/<id>` aborts a session. Sessions only belong to the
+credentials that created them, and expire `UPLOAD_SESSION_TTL` seconds (a
+day by default) after they were last written to; `manage.py expire-uploads`
+removes expired sessions and their files.
+
+A committed file that no post lists yet is kept for the attachment
+collector's grace period (see `piss.attachment_index`).
+'''
+
+import os
+import time
+import errno
+import binascii
+import threading
+from flask import abort, Blueprint, current_app, g, jsonify, request, url_for
+from werkzeug import secure_filename
+from piss.auth import requires_auth
+from piss.file_io import HashingFile, get_storage, get_temp_path, ONE_MB
+from piss.derivatives import pregenerate_derivatives
+
+SESSION_COLLECTION = 'upload_sessions'
+DEFAULT_SESSION_TTL = 60 * 60 * 24
+# A commit that hasn't finished by then (its worker died) can be retried
+DEFAULT_COMMIT_TIMEOUT = 60 * 10
+
+uploads = Blueprint('uploads', __name__)
+
+
+@uploads.route('/uploads', methods=['POST'])
+@requires_auth()
+def create_session():
+    '''
+    Start an upload session and preallocate its file.
+    '''
+    data = get_json()
+    size = data.get('size', None)
+    if not isinstance(size, (int, long)) or isinstance(size, bool) or size < 0:
+        abort(400, 'An upload session needs the `size` of the file.')
+    max_size = current_app.config.get('UPLOAD_MAX_SIZE', None)
+    if max_size is not None and size > max_size:
+        abort(413)
+
+    session_id = binascii.hexlify(os.urandom(16))
+    path = get_session_path(session_id)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    session = {
+        '_id': session_id,
+        'owner': get_owner(),
+        'size': size,
+        'name': secure_filename(data.get('name', None) or 'upload'),
+        'content_type': data.get('content_type', None)
+                        or 'application/octet-stream',
+        'received': [],
+        'updated': time.time()
+    }
+    if data.get('digest', None):
+        session['digest'] = str(data['digest']).lower()
+    get_sessions().insert(session)
+
+    response = jsonify(session_status(session))
+    response.status_code = 201
+    response.headers['Location'] = session_url(session_id)
+    return response
+
+
+@uploads.route('/uploads/<session_id>', methods=['GET', 'HEAD'])
+@requires_auth()
+def session_info(session_id):
+    '''
+    Report which ranges of the file have been received so far.
+
+    :param session_id: the upload session ID.
+    '''
+    session = get_session(session_id)
+    return jsonify(session_status(session))
+
+
+@uploads.route('/uploads/<session_id>', methods=['PUT'])
+@requires_auth()
+def upload_range(session_id):
+    '''
+    Write a range of the file. The body is streamed straight to its place in
+    the session's file, so only `ONE_MB` is ever held in memory.
+
+    :param session_id: the upload session ID.
+    '''
+    session = get_session(session_id)
+    if 'committing' in session or 'attachment' in session:
+        abort(409, 'The upload is being committed.')
+    size = session['size']
+    content_range = request.headers.get('Content-Range', None)
+    if content_range is None:
+        # A body without a range is the whole file
+        start, stop = 0, size
+    else:
+        start, stop = parse_content_range(content_range, size)
+    length = request.content_length
+    if length is not None and length != stop - start:
+        abort(400, 'The body doesn\'t match the `Content-Range`.')
+
+    received = 0
+    stream = request.stream
+    try:
+        with open(get_session_path(session_id), 'r+b') as f:
+            f.seek(start)
+            while received < stop - start:
+                data = stream.read(min(ONE_MB, stop - start - received))
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            # Committed or aborted in the meantime
+            abort(404)
+        raise
+    finally:
+        # Keep whatever arrived, even if the connection dropped
+        if received:
+            get_sessions().update(
+                {'_id': session_id},
+                {'$push': {'received': [start, start + received]},
+                 '$set': {'updated': time.time()}})
+
+    if received < stop - start:
+        abort(400, 'The body is shorter than the `Content-Range`.')
+    session['received'] = merge_ranges(session['received'] +
+                                       [[start, stop]])
+    return jsonify(session_status(session))
+
+
+@uploads.route('/uploads/<session_id>/commit', methods=['POST'])
+@requires_auth()
+def commit_session(session_id):
+    '''
+    Check that the whole file has been received, then verify its digest and
+    store it as an attachment in the background.
+
+    :param session_id: the upload session ID.
+    '''
+    session = get_session(session_id)
+    if 'attachment' in session:
+        abort(409, 'The upload has already been committed.')
+    if missing_ranges(session):
+        abort(409, 'The upload is incomplete.')
+    data = get_json(required=False)
+    options = {
+        'name': secure_filename(data['name']) if data.get('name', None)
+                else session['name'],
+        'content_type': data.get('content_type', None)
+                        or session['content_type'],
+        'derivatives': bool(data.get('derivatives', False))
+    }
+
+    # Only one request gets to commit the file
+    timeout = current_app.config.get('UPLOAD_COMMIT_TIMEOUT',
+                                     DEFAULT_COMMIT_TIMEOUT)
+    session = get_sessions().find_and_modify(
+        {'_id': session_id,
+         '$or': [{'committing': {'$exists': False}},
+                 {'committing': {'$lt': time.time() - timeout}}]},
+        {'$set': {'committing': time.time(), 'commit': options},
+         '$unset': {'error': ''}}, new=True)
+    if session is None:
+        abort(409, 'The upload is already being committed.')
+    session['received'] = merge_ranges(session['received'])
+
+    thread = threading.Thread(target=store_session,
+                              args=(current_app._get_current_object(),
+                                    session))
+    thread.daemon = True
+    thread.start()
+
+    response = jsonify(session_status(session))
+    response.status_code = 202
+    response.headers['Location'] = session_url(session_id)
+    return response
+
+
+def store_session(app, session):
+    '''
+    Hash the file of a session that is being committed, hand it to the
+    attachment storage and record the attachment in the session. Whatever
+    goes wrong, the session is released so that the commit can be retried.
+
+    :param app: the app, as this runs outside of the request.
+    :param session: the session document.
+    '''
+    with app.app_context():
+        sessions = get_sessions()
+        session_id = session['_id']
+        options = session['commit']
+        try:
+            stream = HashingFile.from_path(get_session_path(session_id))
+        except IOError:
+            # Aborted in the meantime
+            sessions.update({'_id': session_id},
+                            {'$unset': {'committing': ''}})
+            return
+        try:
+            if 'digest' in session and stream.digest != session['digest']:
+                # Some range was corrupted, but there's no telling which one
+                stream.close()
+                with open(get_session_path(session_id), 'wb') as f:
+                    f.truncate(session['size'])
+                sessions.update(
+                    {'_id': session_id},
+                    {'$set': {'received': [], 'updated': time.time(),
+                              'error': 'The file doesn\'t match the digest '
+                                       'of the session.'},
+                     '$unset': {'committing': ''}})
+                return
+            digest = stream.digest
+            get_storage().store(stream)
+        except Exception:
+            # Keep what was received, so that the commit can be retried
+            stream.committed = True
+            sessions.update({'_id': session_id},
+                            {'$set': {'error': 'The file couldn\'t be stored.',
+                                      'updated': time.time()},
+                             '$unset': {'committing': ''}})
+            raise
+        finally:
+            stream.close()
+
+        attachment = {
+            'content_type': options['content_type'],
+            'name': options['name'],
+            'digest': digest,
+            'size': stream.size
+        }
+        try:
+            if options['derivatives']:
+                pregenerate_derivatives(attachment)
+        finally:
+            # Derivatives can still be made on demand if that failed
+            sessions.update({'_id': session_id},
+                            {'$set': {'attachment': attachment,
+                                      'updated': time.time()},
+                             '$unset': {'committing': ''}})
+
+
+@uploads.route('/uploads/<session_id>', methods=['DELETE'])
+@requires_auth()
+def abort_session(session_id):
+    '''
+    Abort an upload session and delete what was received.
+
+    :param session_id: the upload session ID.
+    '''
+    get_session(session_id)
+    remove_session(session_id)
+    return '', 204
+
+
+def get_sessions():
+    return current_app.data.driver.db[SESSION_COLLECTION]
+
+
+def get_session(session_id):
+    '''
+    Return the session with the given ID, or abort with a `404` if there is
+    none or it belongs to somebody else.
+    '''
+    session = get_sessions().find_one({'_id': session_id,
+                                       'owner': get_owner()})
+    if session is None:
+        abort(404)
+    session['received'] = merge_ranges(session['received'])
+    return session
+
+
+def get_session_path(session_id):
+    return os.path.join(get_temp_path(), 'sessions', session_id)
+
+
+def get_owner():
+    '''
+    Return the ID of the credentials that signed the request.
+    '''
+    credentials = g.get('hawk_credentials', None) or {}
+    return credentials.get('id', None)
+
+
+def get_json(required=True):
+    if request.mimetype != 'application/json':
+        if required:
+            abort(400, 'Upload sessions only accept JSON data.')
+        return {}
+    data = request.get_json(silent=True)
+    if data is None and not required:
+        return {}
+    if not isinstance(data, dict):
+        abort(400)
+    return data
+
+
+def session_url(session_id):
+    return url_for('uploads.session_info', session_id=session_id,
+                   _external=True)
+
+
+def session_status(session):
+    status = {
+        'id': session['_id'],
+        'url': session_url(session['_id']),
+        'size': session['size'],
+        'received': session['received'],
+        'missing': missing_ranges(session),
+        'status': 'open'
+    }
+    if 'attachment' in session:
+        status['status'] = 'committed'
+        status['attachment'] = session['attachment']
+    elif 'committing' in session:
+        status['status'] = 'committing'
+    if 'error' in session:
+        status['error'] = session['error']
+    return status
+
+
+def parse_content_range(header, size):
+    '''
+    Return the `(start, stop)` range of a `Content-Range: bytes a-b/size`
+    header, or abort with a `416` if it doesn't fit the file.
+    '''
+    try:
+        unit, rest = header.strip().split(' ', 1)
+        span, total = rest.split('/', 1)
+        first, last = span.split('-', 1)
+        start, stop = int(first), int(last) + 1
+    except ValueError:
+        abort(400, 'Invalid `Content-Range`.')
+    if unit != 'bytes' or (total != '*' and total != str(size)) \
+            or start < 0 or stop <= start or stop > size:
+        abort(416)
+    return start, stop
+
+
+def merge_ranges(ranges):
+    '''
+    Merge a list of `[start, stop)` ranges into a sorted list of disjoint
+    ranges.
+    '''
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def missing_ranges(session):
+    missing = []
+    position = 0
+    for start, stop in merge_ranges(session['received']):
+        if start > position:
+            missing.append([position, start])
+        position = max(position, stop)
+    if position < session['size']:
+        missing.append([position, session['size']])
+    return missing
+
+
+def remove_session(session_id):
+    get_sessions().remove({'_id': session_id})
+    try:
+        os.unlink(get_session_path(session_id))
+    except OSError:
+        pass
+
+
+def expire_sessions(ttl=None):
+    '''
+    Remove the upload sessions that haven't been written to for `ttl`
+    seconds (`UPLOAD_SESSION_TTL` by default), along with their files, and
+    return how many were removed.
+    '''
+    if ttl is None:
+        ttl = current_app.config.get('UPLOAD_SESSION_TTL', DEFAULT_SESSION_TTL)
+    cutoff = time.time() - ttl
+    removed = 0
+    for session in get_sessions().find({'updated': {'$lt': cutoff}}, {'_id': 1}):
+        remove_session(session['_id'])
+        removed += 1
+    return removed
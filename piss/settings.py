@@ -11,7 +11,7 @@ posts = {
     'item_title': 'post',
     
     # This resource item endpoint will match a NewBase60 regex
-    'item_url': 'regex("[0-9A-HJ-NP-Z_a-km-z]{5,9}")',
+    'item_url': 'regex("[0-9A-HJ-NP-Z_a-km-z]{5,9}(?:-[0-9A-HJ-NP-Z_a-km-z]{2})?")',
     
     # Sort in reverse chronological order
     'datasource': {
@@ -134,11 +134,14 @@ posts = {
         # The post type URI
         'type': {
             'type': 'string',
-            'required': True
+            'required': True,
+            'post_type_schema': True
         },
-        # The actual content of a post
+        # The actual content of a post, which must match the schema of its
+        # type if the type is one of the server's own
         'content': {
-            'type': 'dict'
+            'type': 'dict',
+            'post_type_schema': True
         },
         # Documents attached to the post. Generally used to reference binary
         # data
@@ -225,7 +228,9 @@ DOMAIN = {
     'posts': posts
 }
 
-# Enable document version control
+# Enable document version control. Older versions are stored as deltas by
+# `piss.data.PissMongo`, with a full copy every `VERSION_KEYFRAME_INTERVAL`
+# versions (set in `piss.cfg`)
 VERSIONING = True
 
 # API OPERATIONS
@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+
+'''
+Shared memory cache
+
+A cache kept in a memory-mapped file, so that every worker process on a host
+uses the same entries instead of keeping a copy each. No server is needed:
+the processes share the pages of the file through the kernel, and lock the
+parts of it they use with `fcntl` record locks, which the kernel releases if
+a process dies while holding one.
+
+The file holds a hash table of fixed-size slots. Since entries vary a lot in
+size (a set of credentials takes a hundred bytes, an HTML feed page can take
+a hundred kilobytes), there are several tables, one per slot size, and an
+entry goes in the table with the smallest slots it fits in. Entries bigger
+than the biggest slots aren't cached. Each table is split into sets of
+`WAYS` slots, and a key can only be stored in one set of each table (picked
+by its hash), so a lookup reads at most `WAYS` slot headers per table. When a
+set is full, an expired entry is replaced if there is one, otherwise the
+least recently used one.
+
+The tables are set with `SHARED_CACHE_SLOTS`, a list of `(slot size in
+bytes, number of slots)` pairs, and the file with `SHARED_CACHE_PATH` (by
+default `tmp/shared.cache` in the instance folder). A file on a `tmpfs`,
+like `/dev/shm/piss.cache`, keeps the kernel from writing the cache back to
+disk. The file is created, or replaced by an empty one if the tables
+changed, by the first process to use it. Processes set it up one at a time,
+holding a lock on `SHARED_CACHE_PATH` + `.lock`, so that processes starting
+together all map the same file.
+
+Values are pickled, so the file must only be writable by the server.
+'''
+
+import os
+import mmap
+import errno
+import time
+import zlib
+import fcntl
+import struct
+import hashlib
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+MAGIC = 'PISSSHM1'
+
+# Slots per set
+WAYS = 8
+
+# The first page of the file describes the tables
+HEADER_SIZE = 4096
+
+# Slot header: key digest, namespace, expiry time, last use time, length of
+# the value
+SLOT_HEADER = struct.Struct('<20sIddI')
+SLOT_HEADER_SIZE = 48
+
+EMPTY_DIGEST = '\0' * 20
+
+# Room for 16384 small entries (credentials, counters, attachment metadata),
+# 2048 medium ones and 128 big ones (responses), 80 MB in all
+DEFAULT_SLOTS = ((1024, 16384), (16384, 2048), (262144, 128))
+
+# Shared memory opened by this process, by path. Closing any descriptor of a
+# file releases all the locks the process holds on it, so there must be only
+# one per file.
+_memories = {}
+_memories_lock = threading.Lock()
+
+
+def open_shared_memory(app_config):
+    '''
+    Return the `SharedMemory` set up in the app's config.
+    '''
+    path = os.path.abspath(app_config['SHARED_CACHE_PATH'])
+    with _memories_lock:
+        memory = _memories.get(path, None)
+        if memory is None:
+            memory = _memories[path] = SharedMemory(
+                path, app_config.get('SHARED_CACHE_SLOTS', DEFAULT_SLOTS))
+        return memory
+
+
+class SharedMemory(object):
+    '''
+    The tables of a shared memory cache, holding byte strings under 20-byte
+    key digests. See `SharedCache` for a cache of Python objects built on it.
+
+    The file is mapped the first time it's used in a process, so that worker
+    processes forked from a master that created the app each map it for
+    themselves.
+
+    :param path: the path of the file.
+    :param slots: a list of `(slot size in bytes, number of slots)` pairs.
+    '''
+    def __init__(self, path, slots=DEFAULT_SLOTS):
+        self.path = path
+        self._tables = []
+        offset = HEADER_SIZE
+        for slot_size, count in sorted((int(size), int(count)) for size, count in slots):
+            if slot_size <= SLOT_HEADER_SIZE:
+                raise ValueError('Shared cache slots must be bigger than %d bytes.'
+                                 % (SLOT_HEADER_SIZE,))
+            sets = max(count // WAYS, 1)
+            self._tables.append((slot_size, sets, offset))
+            offset += slot_size * WAYS * sets
+        if not self._tables:
+            raise ValueError('The shared cache needs at least one table.')
+        self.size = offset
+        self.slots = sum(sets * WAYS for _, sets, _ in self._tables)
+        self._header = MAGIC + struct.pack('<II', WAYS, len(self._tables)) + \
+            ''.join(struct.pack('<II', slot_size, sets)
+                    for slot_size, sets, _ in self._tables)
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._open_lock = threading.Lock()
+        self._thread_locks = []
+
+    def get(self, digest):
+        '''
+        Return the value stored under a digest, or `None` if there is none or
+        it has expired.
+        '''
+        self._open()
+        now = time.time()
+        for index in range(len(self._tables)):
+            set_index = self._set_index(index, digest)
+            start = self._lock(index, set_index)
+            try:
+                offset = self._find(index, start, digest)
+                if offset is None:
+                    continue
+                _, _, expires, _, length = SLOT_HEADER.unpack_from(self._map, offset)
+                if expires < now:
+                    self._clear_slot(offset)
+                    return None
+                self._touch(offset, now)
+                data_start = offset + SLOT_HEADER_SIZE
+                return self._map[data_start:data_start + length]
+            finally:
+                self._unlock(index, set_index)
+        return None
+
+    def set(self, digest, namespace, data, expires):
+        '''
+        Store a value under a digest until the time `expires`. Returns
+        `False` if the value is too big to be stored.
+
+        :param namespace: a number identifying the cache the entry belongs
+                          to, see `clear`.
+        '''
+        self._open()
+        for index, (slot_size, _, _) in enumerate(self._tables):
+            if len(data) <= slot_size - SLOT_HEADER_SIZE:
+                break
+            # Lookups go through the tables in order, so drop any copy
+            # stored in a smaller one before the value grew
+            self._drop(index, digest)
+        else:
+            return False
+        set_index = self._set_index(index, digest)
+        start = self._lock(index, set_index)
+        try:
+            self._write(index, start, digest, namespace, data, expires)
+        finally:
+            self._unlock(index, set_index)
+        self._drop_larger(index, digest)
+        return True
+
+    def add(self, digest, namespace, data, expires):
+        '''
+        Store a value under a digest unless there already is one. Returns
+        whether the value was stored. Only meant for values that fit in the
+        smallest slots, like locks and counters.
+        '''
+        if len(data) > self._tables[0][0] - SLOT_HEADER_SIZE:
+            raise ValueError('Value too big to add to the shared cache.')
+        self._open()
+        now = time.time()
+        set_index = self._set_index(0, digest)
+        start = self._lock(0, set_index)
+        try:
+            offset = self._find(0, start, digest)
+            if offset is not None \
+                    and SLOT_HEADER.unpack_from(self._map, offset)[2] >= now:
+                return False
+            self._write(0, start, digest, namespace, data, expires)
+        finally:
+            self._unlock(0, set_index)
+        self._drop_larger(0, digest)
+        return True
+
+    def incr(self, digest, namespace):
+        '''
+        Add one to a counter, starting it at one if it doesn't exist, and
+        return the new value.
+        '''
+        self._open()
+        set_index = self._set_index(0, digest)
+        start = self._lock(0, set_index)
+        try:
+            offset = self._find(0, start, digest)
+            value = 1
+            if offset is not None:
+                length = SLOT_HEADER.unpack_from(self._map, offset)[4]
+                data_start = offset + SLOT_HEADER_SIZE
+                value = int(self._map[data_start:data_start + length]) + 1
+            self._write(0, start, digest, namespace, str(value), float('inf'))
+        finally:
+            self._unlock(0, set_index)
+        self._drop_larger(0, digest)
+        return value
+
+    def delete(self, digest):
+        '''
+        Drop the value stored under a digest, if any.
+        '''
+        self._open()
+        for index in range(len(self._tables)):
+            self._drop(index, digest)
+
+    def clear(self, namespace=None):
+        '''
+        Drop every entry, or only the entries of a namespace.
+        '''
+        self._each_slot(namespace, self._clear_slot)
+
+    def count(self, namespace=None):
+        '''
+        Return the number of entries that haven't expired, in every namespace
+        or only in one.
+        '''
+        offsets = []
+        self._each_slot(namespace, offsets.append, time.time())
+        return len(offsets)
+
+    def _each_slot(self, namespace, function, now=None):
+        # Call `function` with the offset of every entry of a namespace (or
+        # every entry, if it's `None`) that hasn't expired by `now`
+        self._open()
+        for index, (slot_size, sets, offset) in enumerate(self._tables):
+            for set_index in range(sets):
+                start = self._lock(index, set_index)
+                try:
+                    for way in range(WAYS):
+                        slot = start + way * slot_size
+                        digest, slot_namespace, expires, _, _ = \
+                            SLOT_HEADER.unpack_from(self._map, slot)
+                        if digest == EMPTY_DIGEST:
+                            continue
+                        if namespace is not None and slot_namespace != namespace:
+                            continue
+                        if now is not None and expires < now:
+                            continue
+                        function(slot)
+                finally:
+                    self._unlock(index, set_index)
+
+    def _drop(self, index, digest):
+        # Clear the slot holding a digest in a table, if any
+        set_index = self._set_index(index, digest)
+        start = self._lock(index, set_index)
+        try:
+            offset = self._find(index, start, digest)
+            if offset is not None:
+                self._clear_slot(offset)
+        finally:
+            self._unlock(index, set_index)
+
+    def _drop_larger(self, index, digest):
+        # Clear any copy in the tables after `index`, left from before the
+        # value shrank, which lookups would fall back to once the new one is
+        # evicted
+        for larger in range(index + 1, len(self._tables)):
+            self._drop(larger, digest)
+
+    def _find(self, index, start, digest):
+        # Return the offset of the slot holding a digest in the set starting
+        # at `start`, or `None`. Must be called with the set locked.
+        slot_size = self._tables[index][0]
+        for way in range(WAYS):
+            offset = start + way * slot_size
+            if self._map[offset:offset + 20] == digest:
+                return offset
+        return None
+
+    def _write(self, index, start, digest, namespace, data, expires):
+        # Store an entry in a set, in the slot that already holds the digest,
+        # or an empty one, or an expired one, or else the least recently used
+        # one. Must be called with the set locked.
+        slot_size = self._tables[index][0]
+        now = time.time()
+        victim = None
+        victim_rank = None
+        for way in range(WAYS):
+            offset = start + way * slot_size
+            slot_digest, _, slot_expires, used, _ = \
+                SLOT_HEADER.unpack_from(self._map, offset)
+            if slot_digest == digest:
+                victim = offset
+                break
+            if slot_digest == EMPTY_DIGEST:
+                rank = (0, 0)
+            elif slot_expires < now:
+                rank = (1, slot_expires)
+            else:
+                rank = (2, used)
+            if victim_rank is None or rank < victim_rank:
+                victim, victim_rank = offset, rank
+        # Empty the slot first, so that a process dying halfway through
+        # leaves an empty slot rather than a broken entry
+        self._clear_slot(victim)
+        data_start = victim + SLOT_HEADER_SIZE
+        self._map[data_start:data_start + len(data)] = data
+        SLOT_HEADER.pack_into(self._map, victim, digest, namespace, expires,
+                              now, len(data))
+
+    def _touch(self, offset, now):
+        # Record a use of the entry in a slot for the LRU eviction
+        self._map[offset + 32:offset + 40] = struct.pack('<d', now)
+
+    def _clear_slot(self, offset):
+        self._map[offset:offset + 20] = EMPTY_DIGEST
+
+    def _set_index(self, index, digest):
+        # The set of a table that a digest belongs in
+        return struct.unpack_from('<Q', digest)[0] % self._tables[index][1]
+
+    def _lock(self, index, set_index):
+        # Lock a set of a table, and return the offset of its first slot.
+        # Record locks belong to the process, so threads take a lock of their
+        # own first.
+        start = self._tables[index][2] + set_index * WAYS * self._tables[index][0]
+        self._thread_locks[(set_index * len(self._tables) + index)
+                           % len(self._thread_locks)].acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, start)
+        except:
+            self._thread_locks[(set_index * len(self._tables) + index)
+                               % len(self._thread_locks)].release()
+            raise
+        return start
+
+    def _unlock(self, index, set_index):
+        start = self._tables[index][2] + set_index * WAYS * self._tables[index][0]
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, start)
+        finally:
+            self._thread_locks[(set_index * len(self._tables) + index)
+                               % len(self._thread_locks)].release()
+
+    def _open(self):
+        # Map the file in this process, unless it's already been done
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._open_lock:
+            if self._pid == pid:
+                return
+            if self._map is not None:
+                # Mapped by the parent process before a fork
+                self._map.close()
+                os.close(self._fd)
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # Processes starting at the same time set the file up one at a
+            # time, so that they all end up mapping the same one
+            lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                fd = self._open_file(pid)
+                try:
+                    memory_map = mmap.mmap(fd, self.size)
+                except:
+                    os.close(fd)
+                    raise
+            finally:
+                os.close(lock_fd)
+            if memory_map[:len(self._header)] != self._header:
+                memory_map.close()
+                os.close(fd)
+                raise RuntimeError('The shared cache at %s was replaced while '
+                                   'it was being opened.' % (self.path,))
+            self._map = memory_map
+            self._fd = fd
+            self._thread_locks = [threading.Lock() for i in range(64)]
+            self._pid = pid
+
+    def _open_file(self, pid):
+        # Open the file, setting it up first if it's new or set up for other
+        # tables. Must be called with the lock file locked.
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if os.fstat(fd).st_size == self.size \
+                    and os.read(fd, len(self._header)) == self._header:
+                return fd
+            os.close(fd)
+        # Set up a new file and move it in place, rather than resizing a file
+        # that processes with other tables may have mapped
+        new_path = '%s.%d' % (self.path, pid)
+        new_fd = os.open(new_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(new_fd, self.size)
+            os.write(new_fd, self._header)
+        finally:
+            os.close(new_fd)
+        os.rename(new_path, self.path)
+        return os.open(self.path, os.O_RDWR)
+
+
+class SharedCache(object):
+    '''
+    A cache in shared memory, with the same interface as `LRUCache`, so that
+    every worker process on the host sees the same entries. Several caches
+    can use the same `SharedMemory`, each with its own `prefix`; they share
+    its slots, so `maxsize` in the stats is the number of slots in all.
+
+    Hits and misses are counted per process.
+
+    :param memory: the `SharedMemory` to keep the entries in.
+    :param prefix: prefixed to every key. Must be unique to the cache.
+    :param ttl: seconds before entries expire.
+    '''
+    shared = True
+
+    def __init__(self, memory, prefix, ttl=300):
+        self.memory = memory
+        self.prefix = prefix
+        self.ttl = ttl
+        self.namespace = zlib.crc32(prefix) & 0xffffffff
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return self.memory.get(self._digest(key)) is not None
+
+    def get(self, key, default=None):
+        data = self.memory.get(self._digest(key))
+        if data is not None:
+            try:
+                value = pickle.loads(data)
+            except Exception:
+                # Stored by another version of the code
+                value = data = None
+        if data is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.memory.set(self._digest(key), self.namespace,
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        time.time() + ttl)
+
+    def add(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        return self.memory.add(self._digest(key), self.namespace,
+                               pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                               time.time() + ttl)
+
+    def get_counter(self, key):
+        '''
+        Return the integer counter stored under `key`, or `None` if there is
+        none. Counters never expire, but are evicted like any other entry.
+        '''
+        data = self.memory.get(self._digest('counter:' + key))
+        return int(data) if data is not None else None
+
+    def add_counter(self, key, value):
+        '''
+        Start a counter at `value`, unless it already exists.
+        '''
+        self.memory.add(self._digest('counter:' + key), self.namespace,
+                        str(int(value)), float('inf'))
+
+    def incr(self, key):
+        '''
+        Add one to a counter, starting it at one if it doesn't exist, and
+        return the new value.
+        '''
+        return self.memory.incr(self._digest('counter:' + key), self.namespace)
+
+    def delete(self, key):
+        self.memory.delete(self._digest(key))
+
+    def clear(self):
+        self.memory.clear(self.namespace)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'size': self.memory.count(self.namespace),
+            'maxsize': self.memory.slots,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def _digest(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        elif not isinstance(key, str):
+            key = str(key)
+        return hashlib.sha1(self.prefix + key).digest()
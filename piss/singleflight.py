@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+'''
+Single-flight calls
+
+When many identical requests miss a cache at once (say, a post that was just
+linked from a busy site), each of them would run the same query and render
+the same page. Running them through `single_flight` lets one of them, the
+leader, do the work while the others wait for it and then take its result
+from the cache.
+
+Within a worker process, requests wait for the leader in the same process.
+With `SINGLE_FLIGHT_SHARED` (on by default when `CACHE_BACKEND` is
+`'shared'`), the leaders of every worker on the host also take a lock in the
+shared cache, and only the one holding it does the work. The others poll the
+cache for the result until the lock is released.
+
+Nobody waits for more than `SINGLE_FLIGHT_TIMEOUT` seconds (10 by default).
+If the leader failed, took too long, or its result couldn't be cached, the
+waiting requests do the work themselves. Setting `SINGLE_FLIGHT` to `False`
+turns coalescing off.
+'''
+
+import os
+import time
+import threading
+from flask import current_app
+from .cache import create_cache
+
+
+def create_single_flight(app_config):
+    '''
+    Return the `SingleFlight` set up in the app's config, or `None` if it's
+    turned off.
+    '''
+    if not app_config.get('SINGLE_FLIGHT', True):
+        return None
+    timeout = app_config.get('SINGLE_FLIGHT_TIMEOUT', 10)
+    locks = None
+    if app_config.get('SINGLE_FLIGHT_SHARED',
+                      app_config.get('CACHE_BACKEND', 'memory') == 'shared'):
+        locks = create_cache(app_config, 'locks', ttl=timeout)
+        if not locks.shared:
+            raise ValueError('SINGLE_FLIGHT_SHARED needs a shared CACHE_BACKEND.')
+    return SingleFlight(locks=locks, timeout=timeout,
+                        poll_interval=app_config.get('SINGLE_FLIGHT_POLL_INTERVAL', 0.01))
+
+
+def single_flight(key, function, lookup=None, shared=False):
+    '''
+    Run `function` through the app's `SingleFlight` (see `SingleFlight.do`).
+    If coalescing is turned off, return the result of `lookup` if there is
+    one, or else call `function`.
+    '''
+    flight = getattr(current_app, 'single_flight', None)
+    if flight is not None:
+        return flight.do(key, function, lookup=lookup, shared=shared)
+    if lookup is not None:
+        result = lookup()
+        if result is not None:
+            return result
+    return function()
+
+
+class _Call(object):
+    '''
+    A call in flight, and its result once it's done.
+    '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.result = None
+
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent calls with the same key.
+
+    Calls that miss the cache are counted as `leaders` (those that did the
+    work) and `followers` (those that waited for a leader).
+
+    :param locks: a shared cache to hold the locks of the leaders of every
+                  worker process, or `None` to only coalesce calls within
+                  the process.
+    :param timeout: the most seconds a call waits for a leader, and the TTL
+                    of the locks.
+    :param poll_interval: seconds between two checks for the result of a
+                          leader in another process.
+    '''
+    def __init__(self, locks=None, timeout=10, poll_interval=0.01):
+        self.locks = locks
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.leaders = 0
+        self.followers = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, lookup=None, shared=False):
+        '''
+        Return the result of `lookup` if there is one. Otherwise, call
+        `function` and return its result, unless a call with the same key is
+        already in flight, in which case wait for it to finish and return its
+        result instead.
+
+        :param key: identifies the call, e.g. the cache key of its result.
+        :param function: the function doing the work.
+        :param lookup: function returning the result from the cache the
+                       leader stores it in, or `None` if it isn't there.
+                       Waiting calls get their result from it, so that they
+                       don't share a mutable object like a response. Without
+                       it, they get the very object the leader returned.
+        :param shared: whether the cache `lookup` reads is shared by every
+                       worker process, so that calls in other processes can
+                       wait for the leader too.
+        '''
+        if lookup is not None:
+            result = lookup()
+            if result is not None:
+                return result
+
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            call.done.wait(self.timeout)
+            if lookup is not None:
+                result = lookup()
+                if result is not None:
+                    return result
+            elif call.ok:
+                return call.result
+            return function()
+
+        try:
+            call.result = self._lead(key, function, lookup, shared)
+            call.ok = True
+            return call.result
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        '''
+        Return a dict with the number of calls in flight and the leader and
+        follower counters.
+        '''
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'followers': self.followers
+        }
+
+    def _lead(self, key, function, lookup, shared):
+        # A leader that finished just before this call came in isn't waited
+        # for, so the work may be done twice, but only in that window
+        if not shared or lookup is None or self.locks is None:
+            return function()
+
+        if self.locks.add(key, os.getpid(), ttl=self.timeout):
+            try:
+                return function()
+            finally:
+                # If the lock outlived its TTL and another process took it,
+                # this releases theirs early, which only costs a duplicate
+                # call
+                self.locks.delete(key)
+
+        # A leader in another process is on it
+        deadline = time.time() + self.timeout
+        while key in self.locks and time.time() < deadline:
+            time.sleep(self.poll_interval)
+            result = lookup()
+            if result is not None:
+                return result
+        result = lookup()
+        if result is not None:
+            return result
+        return function()
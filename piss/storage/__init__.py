@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+'''
+Attachment storage
+
+Attachments are stored by digest through a storage backend, chosen with
+`ATTACHMENT_STORAGE` in `piss.cfg`:
+
+* `'loose'` (the default): one file per digest in a tree of directories under
+  the instance's `attachments` folder. See `piss.storage.loose`.
+* `'packs'`: files of up to `PACK_MAX_BLOB_SIZE` bytes (256 KB by default) are
+  appended to segment files of about `PACK_SEGMENT_SIZE` bytes (1 GB by
+  default) in the instance's `packs` folder, and larger files are stored
+  loose. See `piss.storage.packs`.
+
+Setting `ATTACHMENT_CHUNKING = True` also splits files of at least
+`CHUNKING_MIN_FILE_SIZE` bytes (8 MB by default) into content-defined chunks
+that are shared between files, so uploading a slightly edited copy of a large
+file only stores the chunks that changed. See `piss.storage.chunks`.
+
+Existing loose files can be moved into packs with
+`python manage.py pack-attachments`.
+'''
+
+import os
+from .base import Storage, Blob
+from .loose import LooseStorage, get_tree_path, remove_empty_dirs
+from .packs import PackStorage
+from .chunks import ChunkedStorage
+
+
+def create_storage(config, instance_path):
+    '''
+    Create the storage backend set in the given configuration.
+
+    :param config: the app's configuration.
+    :param instance_path: the app's instance folder.
+    '''
+    loose = LooseStorage(os.path.join(instance_path, 'attachments'))
+    backend = config.get('ATTACHMENT_STORAGE', 'loose')
+    if backend == 'loose':
+        storage = loose
+    elif backend == 'packs':
+        storage = PackStorage(os.path.join(instance_path, 'packs'), loose,
+                              max_blob_size=config.get('PACK_MAX_BLOB_SIZE', 256 * 1024),
+                              segment_size=config.get('PACK_SEGMENT_SIZE', 1024 * 1024 * 1024),
+                              refresh_interval=config.get('PACK_REFRESH_INTERVAL', 1.0))
+    else:
+        raise ValueError('Unknown attachment storage: %s' % (backend,))
+    if config.get('ATTACHMENT_CHUNKING', False):
+        storage = ChunkedStorage(os.path.join(instance_path, 'chunks'), storage,
+                                 min_file_size=config.get('CHUNKING_MIN_FILE_SIZE', 8 * 1024 * 1024))
+    return storage
+
+
+def get_pack_storage(storage):
+    '''
+    Return the `PackStorage` behind a storage backend, which may be wrapped in
+    a `ChunkedStorage`, or `None` if it doesn't use packs.
+    '''
+    if isinstance(storage, ChunkedStorage):
+        storage = storage.inner
+    if isinstance(storage, PackStorage):
+        return storage
+    return None
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from abc import ABCMeta, abstractmethod
+
+
+class Storage(object):
+    '''
+    Interface of the attachment storage backends. Files are always addressed by
+    their digest.
+    '''
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def store(self, stream):
+        '''
+        Store an uploaded file, unless a file with the same digest is already
+        stored, in which case it's marked as recently used instead.
+
+        :param stream: a `piss.file_io.HashingFile` that has been written and
+                       flushed. It's consumed by this call.
+        '''
+
+    @abstractmethod
+    def open(self, digest):
+        '''
+        Return a `Blob` for the file with the given digest, or `None` if there
+        is no such file.
+        '''
+
+    @abstractmethod
+    def stat(self, digest):
+        '''
+        Return a `(size, mtime)` tuple for the file with the given digest, or
+        `None` if there is no such file.
+        '''
+
+    @abstractmethod
+    def delete(self, digest):
+        '''
+        Delete the file with the given digest. Returns `False` if there was
+        no such file.
+        '''
+
+    @abstractmethod
+    def iter_digests(self):
+        '''
+        Yield the digest of every stored file.
+        '''
+
+    def cleanup(self):
+        '''
+        Tidy up after files have been deleted and return the number of things
+        (e.g. directories) that were removed.
+        '''
+        return 0
+
+
+class Blob(object):
+    '''
+    A stored file.
+
+    :param digest: the digest of the file.
+    :param size: the size of the file in bytes.
+    :param path: the path of the file on disk, if it's stored as a file of its
+                 own. Only such files can be handed off to the web server.
+    '''
+    __metaclass__ = ABCMeta
+
+    def __init__(self, digest, size, path=None):
+        self.digest = digest
+        self.size = size
+        self.path = path
+
+    @abstractmethod
+    def open(self):
+        '''
+        Return a readable file object for the file.
+        '''
+
+    @abstractmethod
+    def iter_range(self, start, stop, buffer_size):
+        '''
+        Yield the bytes between `start` and `stop` in chunks of up to
+        `buffer_size` bytes.
+        '''
+
+    @abstractmethod
+    def extents(self):
+        '''
+        Return where the contents of the file are on disk, as a list of
+        `(path, offset, size)` tuples in order, so that they can be read
+        without going through the storage backend (e.g. by another process).
+        '''
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+'''
+Chunked storage
+
+Large files are split into chunks at boundaries that depend on their content
+rather than on their position, so an edit only changes the chunks around it
+and every other chunk is shared with the previous upload. Each chunk is stored
+once, named after its own hash, and each file is described by a manifest
+listing its chunks:
+
+    chunks/objects/3/f/a/3fa2...      (chunk contents)
+    chunks/manifests/b/f/8/bf88...    {"size": 48213, "chunks": [["3fa2...", 1048576], ...]}
+
+A boundary is placed after an occurrence of `ANCHOR` when the hash of the
+`WINDOW` bytes before it matches `BOUNDARY_MASK`. Both only depend on nearby
+bytes, so inserting or removing data doesn't move the boundaries elsewhere in
+the file. Chunks are kept between `MIN_CHUNK_SIZE` and `MAX_CHUNK_SIZE` bytes
+(about 1.5 MB on average). The search uses `str.find` and `zlib.crc32`, so
+it runs at C speed instead of hashing every byte in Python.
+
+Files smaller than `CHUNKING_MIN_FILE_SIZE` are passed on to the wrapped
+storage backend. The digest of a chunked file is still the digest of the
+whole file, so posts don't change.
+'''
+
+import io
+import os
+import json
+import time
+import zlib
+import errno
+import hashlib
+import tempfile
+from .base import Storage, Blob
+from .loose import LooseStorage, get_tree_path, remove_empty_dirs
+
+ANCHOR = b'\x8e\x3d'
+WINDOW = 48
+BOUNDARY_MASK = 0xf
+MIN_CHUNK_SIZE = 512 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Chunks younger than this are never collected, since the manifest that
+# references them may not have been written yet
+CHUNK_GRACE_PERIOD = 60 * 60
+
+
+class ChunkedStorage(Storage):
+    '''
+    :param path: the folder holding the chunks and manifests.
+    :param inner: the storage used for files that are too small to chunk.
+    :param min_file_size: the smallest file that's chunked, in bytes.
+    '''
+    def __init__(self, path, inner, min_file_size=8 * 1024 * 1024):
+        self.path = path
+        self.inner = inner
+        self.min_file_size = min_file_size
+        self.objects = LooseStorage(os.path.join(path, 'objects'))
+        self.manifests_path = os.path.join(path, 'manifests')
+        self.tmp_path = os.path.join(path, 'tmp')
+
+    def get_manifest_path(self, digest):
+        return os.path.join(get_tree_path(self.manifests_path, digest), digest)
+
+    def store(self, stream):
+        if stream.size < self.min_file_size \
+                or self.inner.stat(stream.digest) is not None:
+            return self.inner.store(stream)
+        manifest_path = self.get_manifest_path(stream.digest)
+        if os.path.exists(manifest_path):
+            try:
+                # Keep it safe from the attachment collector
+                touch(manifest_path)
+                stream.close()
+                return
+            except OSError:
+                # Collected in the meantime, so store it again
+                pass
+        chunks = []
+        with open(stream.name, 'rb') as f:
+            for chunk in iter_chunks(f):
+                chunks.append([self._store_chunk(chunk), len(chunk)])
+        self._write_file(manifest_path, json.dumps(
+            {'size': stream.size, 'chunks': chunks}).encode('utf-8'))
+        stream.close()
+
+    def open(self, digest):
+        manifest = self._read_manifest(digest)
+        if manifest is None:
+            return self.inner.open(digest)
+        return ChunkedBlob(digest, manifest['size'],
+                           [(self.objects.get_path(chunk), size)
+                            for chunk, size in manifest['chunks']])
+
+    def stat(self, digest):
+        manifest = self._read_manifest(digest)
+        if manifest is None:
+            return self.inner.stat(digest)
+        return manifest['size'], os.path.getmtime(self.get_manifest_path(digest))
+
+    def delete(self, digest):
+        # Chunks that are no longer used are removed by `cleanup`
+        try:
+            os.unlink(self.get_manifest_path(digest))
+            deleted = True
+        except OSError:
+            deleted = False
+        return self.inner.delete(digest) or deleted
+
+    def iter_digests(self):
+        for digest in self.iter_manifest_digests():
+            yield digest
+        for digest in self.inner.iter_digests():
+            yield digest
+
+    def cleanup(self):
+        '''
+        Delete the chunks that no manifest lists any more, then the empty
+        directories.
+        '''
+        used = set()
+        for digest in self.iter_manifest_digests():
+            manifest = self._read_manifest(digest)
+            if manifest:
+                used.update(chunk for chunk, _ in manifest['chunks'])
+        cutoff = time.time() - CHUNK_GRACE_PERIOD
+        removed = 0
+        for chunk in list(self.objects.iter_digests()):
+            if chunk in used:
+                continue
+            stat = self.objects.stat(chunk)
+            if stat is not None and stat[1] < cutoff \
+                    and self.objects.delete(chunk):
+                removed += 1
+        return removed + remove_empty_dirs(self.manifests_path) + \
+            self.objects.cleanup() + self.inner.cleanup()
+
+    def iter_manifest_digests(self):
+        for dirpath, dirnames, filenames in os.walk(self.manifests_path):
+            dirnames.sort()
+            for digest in sorted(filenames):
+                yield digest
+
+    def _read_manifest(self, digest):
+        try:
+            with open(self.get_manifest_path(digest), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except IOError:
+            return None
+
+    def _store_chunk(self, data):
+        chunk = hashlib.sha256(data).hexdigest()
+        path = self.objects.get_path(chunk)
+        if os.path.exists(path):
+            try:
+                # Keep it safe from `cleanup` until the manifest is written
+                touch(path)
+                return chunk
+            except OSError:
+                pass
+        self._write_file(path, data)
+        return chunk
+
+    def _write_file(self, path, data):
+        '''
+        Write a file atomically, creating its directory if needed.
+        '''
+        if not os.path.isdir(self.tmp_path):
+            os.makedirs(self.tmp_path)
+        with tempfile.NamedTemporaryFile(dir=self.tmp_path, delete=False) as f:
+            f.write(data)
+        try:
+            os.rename(f.name, path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                os.unlink(f.name)
+                raise
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.rename(f.name, path)
+
+
+class ChunkedBlob(Blob):
+    '''
+    :param chunks: list of `(path, size)` tuples of the chunks, in order.
+    '''
+    def __init__(self, digest, size, chunks):
+        super(ChunkedBlob, self).__init__(digest, size)
+        self.chunks = chunks
+
+    def open(self):
+        return io.BufferedReader(ChunkedFile(self), io.DEFAULT_BUFFER_SIZE)
+
+    def iter_range(self, start, stop, buffer_size):
+        chunk_start = 0
+        for path, size in self.chunks:
+            chunk_stop = chunk_start + size
+            if chunk_stop > start and chunk_start < stop:
+                with open(path, 'rb') as f:
+                    position = max(start - chunk_start, 0)
+                    end = min(stop, chunk_stop) - chunk_start
+                    f.seek(position)
+                    while position < end:
+                        data = f.read(min(buffer_size, end - position))
+                        if not data:
+                            break
+                        position += len(data)
+                        yield data
+            if chunk_stop >= stop:
+                break
+            chunk_start = chunk_stop
+
+    def extents(self):
+        return [(path, 0, size) for path, size in self.chunks]
+
+
+class ChunkedFile(io.RawIOBase):
+    '''
+    A readable file object that reads the chunks of a file one after the other.
+    '''
+    def __init__(self, blob):
+        self._chunks = iter(blob.iter_range(0, blob.size, io.DEFAULT_BUFFER_SIZE))
+        self._data = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._data:
+            self._data = next(self._chunks, None)
+            if self._data is None:
+                self._data = b''
+                return 0
+        count = min(len(b), len(self._data))
+        b[:count] = self._data[:count]
+        self._data = self._data[count:]
+        return count
+
+
+def iter_chunks(f):
+    '''
+    Split the contents of a file into content-defined chunks.
+
+    :param f: a file object open for reading.
+    '''
+    data = b''
+    eof = False
+    while True:
+        while not eof and len(data) < MAX_CHUNK_SIZE:
+            read = f.read(MAX_CHUNK_SIZE)
+            if read:
+                data += read
+            else:
+                eof = True
+        if not data:
+            return
+        limit = min(len(data), MAX_CHUNK_SIZE)
+        boundary = find_boundary(data, limit)
+        if boundary is None:
+            boundary = limit
+        yield data[:boundary]
+        data = data[boundary:]
+
+
+def find_boundary(data, limit):
+    '''
+    Return the first chunk boundary in `data` at least `MIN_CHUNK_SIZE` bytes
+    in and before `limit`, or `None` if there is none.
+    '''
+    position = MIN_CHUNK_SIZE
+    while True:
+        found = data.find(ANCHOR, position, limit)
+        if found < 0:
+            return None
+        boundary = found + len(ANCHOR)
+        if boundary < limit and \
+                not zlib.crc32(data[boundary - WINDOW:boundary]) & BOUNDARY_MASK:
+            return boundary
+        position = found + 1
+
+
+def touch(path):
+    os.utime(path, None)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+'''
+Loose file storage
+
+Every file is stored on its own, named after its digest, in a tree of
+directories named after the first characters of the digest, e.g.
+`attachments/b/f/8/bf8854...`.
+'''
+
+import os
+from .base import Storage, Blob
+
+
+class LooseStorage(Storage):
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self, digest):
+        return os.path.join(get_tree_path(self.path, digest), digest)
+
+    def store(self, stream):
+        stream.commit(self.get_path(stream.digest))
+
+    def open(self, digest):
+        path = self.get_path(digest)
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return None
+        return LooseBlob(digest, size, path)
+
+    def stat(self, digest):
+        try:
+            stat = os.stat(self.get_path(digest))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def delete(self, digest):
+        try:
+            os.unlink(self.get_path(digest))
+        except OSError:
+            return False
+        return True
+
+    def iter_digests(self):
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            dirnames.sort()
+            for digest in sorted(filenames):
+                yield digest
+
+    def cleanup(self):
+        return remove_empty_dirs(self.path)
+
+
+class LooseBlob(Blob):
+    def open(self):
+        return open(self.path, 'rb')
+
+    def iter_range(self, start, stop, buffer_size):
+        with self.open() as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(buffer_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def extents(self):
+        return [(self.path, 0, self.size)]
+
+
+def get_tree_path(base_dir, word, subdirs=3):
+    '''
+    Get the full path of a directory where the names of the subdirectories are
+    determined based on the characters of a given word. The directory isn't
+    created; `HashingFile.commit` does that when a file is first stored in it.
+    '''
+    return os.path.join(base_dir, *word[:subdirs])
+
+
+def remove_empty_dirs(base_dir):
+    '''
+    Remove the empty directories below `base_dir`, deepest first, and return
+    how many were removed. `base_dir` itself is kept.
+    '''
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(base_dir, topdown=False):
+        if dirpath == base_dir or filenames:
+            continue
+        try:
+            os.rmdir(dirpath)
+            removed += 1
+        except OSError:
+            # Not empty after all, e.g. a directory we didn't remove, or an
+            # upload that just arrived
+            pass
+    return removed
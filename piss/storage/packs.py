@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+
+'''
+Pack file storage
+
+Small files are appended to large segment files in the instance's `packs`
+folder instead of each getting a file (and an inode) of their own. Files
+larger than `PACK_MAX_BLOB_SIZE` are passed on to loose storage.
+
+Each segment has three files:
+
+* `pack-000001.dat`: the contents of the files, one after the other.
+* `pack-000001.log`: an append-only journal of fixed-size index records,
+  while the segment is still being written to.
+* `pack-000001.idx`: the same records sorted by digest, written once the
+  segment is full (it's then "sealed" and its journal is removed).
+
+A record holds the digest (as 32 raw bytes), the segment and offset where the
+file's contents start, its size and the time it was last stored. Records in
+newer segments take precedence over older ones, so a file is deleted by
+writing a record with a size of `TOMBSTONE`.
+
+Sealed indexes and segments never change, so they are memory mapped once.
+Digests are found with a binary search on the mapped index and contents are
+sliced straight out of the mapped segment, without opening or reading any
+files. Contents of the segment that is still being written to are read from
+its file instead. Writes from all processes are serialized with a lock file.
+
+A digest that isn't found makes a process look for segments and records
+written by other processes, but at most once every `PACK_REFRESH_INTERVAL`
+seconds (1 by default), so a file stored by another process may take that
+long to show up.
+'''
+
+import os
+import re
+import mmap
+import time
+import fcntl
+import struct
+import shutil
+import binascii
+import threading
+from io import RawIOBase
+from contextlib import contextmanager
+from .base import Storage, Blob
+
+# digest, segment, offset, size, time
+RECORD = struct.Struct('>32sIQII')
+TOMBSTONE = 0xffffffff
+
+SEGMENT_NAME = re.compile(r'^pack-(\d+)\.(dat|log|idx)$')
+
+ONE_MB = 1024 * 1024
+
+
+class PackStorage(Storage):
+    '''
+    :param path: the folder holding the segments.
+    :param loose: the storage used for files that are too large for packs.
+    :param max_blob_size: the largest file stored in a pack, in bytes.
+    :param segment_size: the size at which a segment is sealed, in bytes.
+    :param refresh_interval: the least number of seconds between two looks
+                             for changes made by other processes when a
+                             digest isn't found.
+    '''
+    def __init__(self, path, loose, max_blob_size=256 * 1024,
+                 segment_size=1024 * ONE_MB, refresh_interval=1.0):
+        self.path = path
+        self.loose = loose
+        self.max_blob_size = max_blob_size
+        self.segment_size = segment_size
+        self.refresh_interval = refresh_interval
+        self._segments = {}
+        self._path_mtime = None
+        self._refreshed = 0
+        self._lock = threading.RLock()
+
+    def store(self, stream):
+        if stream.size > self.max_blob_size \
+                or self.loose.stat(stream.digest) is not None:
+            return self.loose.store(stream)
+        self.store_packed(stream)
+
+    def store_packed(self, stream):
+        '''
+        Append a file to the current segment, or just record that it was used
+        if it's already in a pack.
+        '''
+        key = digest_key(stream.digest)
+        with self._write_lock():
+            self._refresh()
+            record = self._find(key)
+            if record is None:
+                segment = self._get_writable_segment(stream.size)
+                with open(stream.name, 'rb') as src:
+                    offset = segment.append_data(src)
+                record = (segment.number, offset, stream.size)
+            else:
+                # Touch the file so that the collector leaves it alone
+                segment = self._get_writable_segment(0)
+                record = record[:3]
+            segment.append_record(key, *record)
+        stream.close()
+
+    def open(self, digest):
+        record = self._find(digest_key(digest))
+        if record is None:
+            return self.loose.open(digest)
+        number, offset, size, _ = record
+        return PackedBlob(digest, size, self._segments[number], offset)
+
+    def stat(self, digest):
+        record = self._find(digest_key(digest))
+        if record is None:
+            return self.loose.stat(digest)
+        return record[2], record[3]
+
+    def delete(self, digest):
+        key = digest_key(digest)
+        deleted = False
+        if self._find(key) is not None:
+            with self._write_lock():
+                self._refresh()
+                if self._find(key) is not None:
+                    self._get_writable_segment(0) \
+                        .append_record(key, 0, 0, TOMBSTONE)
+                    deleted = True
+        return self.loose.delete(digest) or deleted
+
+    def iter_digests(self):
+        self._refresh()
+        segments = self._segments
+        seen = set()
+        for number in sorted(segments, reverse=True):
+            for key, record in segments[number].iter_records():
+                if key in seen:
+                    continue
+                seen.add(key)
+                if record[2] != TOMBSTONE:
+                    yield key_digest(key)
+        for digest in self.loose.iter_digests():
+            yield digest
+
+    def cleanup(self):
+        return self.loose.cleanup()
+
+    def _find(self, key):
+        '''
+        Return the `(segment, offset, size, time)` record for a key, or `None`
+        if it isn't in a pack. The segments are reloaded once before giving up
+        in case another process has written to them, unless that was done
+        less than `refresh_interval` seconds ago.
+        '''
+        record = self._find_loaded(key)
+        if record is None \
+                and time.time() - self._refreshed >= self.refresh_interval \
+                and self._refresh():
+            record = self._find_loaded(key)
+        if record is None or record[2] == TOMBSTONE:
+            return None
+        return record
+
+    def _find_loaded(self, key):
+        segments = self._segments
+        for number in sorted(segments, reverse=True):
+            record = segments[number].find(key)
+            if record is not None:
+                return record
+        return None
+
+    def _refresh(self):
+        '''
+        Pick up segments created or sealed and records written by other
+        processes. Returns `True` if anything changed.
+        '''
+        with self._lock:
+            self._refreshed = time.time()
+            changed = False
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return False
+            if mtime != self._path_mtime:
+                self._path_mtime = mtime
+                # Readers don't take the lock, so never change the dict they
+                # may be iterating over
+                segments = dict(self._segments)
+                numbers = {}
+                for name in os.listdir(self.path):
+                    match = SEGMENT_NAME.match(name)
+                    if match:
+                        numbers.setdefault(int(match.group(1)), set()) \
+                            .add(match.group(2))
+                for number, kinds in numbers.items():
+                    segment = segments.get(number, None)
+                    sealed = 'idx' in kinds
+                    if segment is None or segment.sealed != sealed:
+                        segments[number] = Segment(self.path, number, sealed)
+                        changed = True
+                self._segments = segments
+            for segment in self._segments.values():
+                if not segment.sealed and segment.read_log():
+                    changed = True
+            return changed
+
+    def _get_writable_segment(self, size):
+        '''
+        Return the segment to append to, sealing the current one and starting
+        a new one if it's full. Only call with the write lock held.
+        '''
+        self._refresh()
+        numbers = sorted(self._segments)
+        segment = self._segments[numbers[-1]] if numbers else None
+        if segment is not None and not segment.sealed \
+                and (segment.data_size() == 0
+                     or segment.data_size() + size <= self.segment_size):
+            return segment
+        if segment is not None and not segment.sealed:
+            segment.seal()
+        number = numbers[-1] + 1 if numbers else 1
+        segment = Segment(self.path, number, False)
+        segment.create()
+        segments = dict(self._segments)
+        segments[number] = segment
+        self._segments = segments
+        return segment
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(os.path.join(self.path, 'lock'), 'a') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+class Segment(object):
+    def __init__(self, path, number, sealed):
+        name = os.path.join(path, 'pack-%06d' % (number,))
+        self.number = number
+        self.sealed = sealed
+        self.data_path = name + '.dat'
+        self.log_path = name + '.log'
+        self.index_path = name + '.idx'
+        self._data = None
+        self._index = None
+        self._records = {}
+        self._log_position = 0
+        if sealed:
+            self._map()
+
+    def create(self):
+        for path in (self.data_path, self.log_path):
+            open(path, 'ab').close()
+
+    def find(self, key):
+        if not self.sealed:
+            return self._records.get(key, None)
+        index = self._index
+        if index is None:
+            return None
+        low, high = 0, len(index) // RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            position = middle * RECORD.size
+            found = index[position:position + 32]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return RECORD.unpack_from(index, position)[1:]
+        return None
+
+    def iter_records(self):
+        if not self.sealed:
+            for key, record in list(self._records.items()):
+                yield key, record
+        elif self._index is not None:
+            for position in range(0, len(self._index), RECORD.size):
+                record = RECORD.unpack_from(self._index, position)
+                yield record[0], record[1:]
+
+    def data(self):
+        '''
+        Return the memory map of a sealed segment, or `None` while it's still
+        being written to.
+        '''
+        return self._data
+
+    def read_log(self):
+        '''
+        Read journal records written since the last call. Returns `True` if
+        there were any.
+        '''
+        try:
+            with open(self.log_path, 'rb') as log:
+                log.seek(self._log_position)
+                data = log.read()
+        except IOError:
+            return False
+        count = len(data) // RECORD.size
+        for i in range(count):
+            record = RECORD.unpack_from(data, i * RECORD.size)
+            self._records[record[0]] = record[1:]
+        self._log_position += count * RECORD.size
+        return count > 0
+
+    def data_size(self):
+        return os.path.getsize(self.data_path)
+
+    def append_data(self, src):
+        '''
+        Copy a file to the end of the segment and return its offset.
+        '''
+        with open(self.data_path, 'ab') as data:
+            offset = os.fstat(data.fileno()).st_size
+            shutil.copyfileobj(src, data, ONE_MB)
+            data.flush()
+            os.fsync(data.fileno())
+        return offset
+
+    def append_record(self, key, number, offset, size):
+        with open(self.log_path, 'ab') as log:
+            log.write(RECORD.pack(key, number, offset, size, int(time.time())))
+            log.flush()
+            os.fsync(log.fileno())
+        self.read_log()
+
+    def seal(self):
+        '''
+        Write the sorted index of the segment and remove its journal.
+        '''
+        self.read_log()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as index:
+            for key in sorted(self._records):
+                index.write(RECORD.pack(key, *self._records[key]))
+            index.flush()
+            os.fsync(index.fileno())
+        os.rename(tmp_path, self.index_path)
+        os.unlink(self.log_path)
+        self._map()
+        self.sealed = True
+        self._records = {}
+
+    def _map(self):
+        # Sealed segments never change, so they are only ever mapped once
+        self._index = map_file(self.index_path)
+        self._data = map_file(self.data_path)
+
+
+class PackedBlob(Blob):
+    def __init__(self, digest, size, segment, offset):
+        super(PackedBlob, self).__init__(digest, size)
+        self.segment = segment
+        self.offset = offset
+
+    def open(self):
+        return PackedFile(self)
+
+    def iter_range(self, start, stop, buffer_size):
+        f = PackedFile(self)
+        try:
+            f.seek(start)
+            position = start
+            while position < stop:
+                data = f.read(min(buffer_size, stop - position))
+                if not data:
+                    break
+                position += len(data)
+                yield data
+        finally:
+            f.close()
+
+    def extents(self):
+        return [(self.segment.data_path, self.offset, self.size)]
+
+
+class PackedFile(RawIOBase):
+    '''
+    A readable, seekable file object for a file in a pack. Its contents are
+    sliced out of the mapped segment, or read from the segment's file if it
+    hasn't been sealed yet, without ever going past the end of the file.
+    '''
+    def __init__(self, blob):
+        self._data = blob.segment.data()
+        self._file = None
+        if self._data is None:
+            self._file = open(blob.segment.data_path, 'rb')
+        self._start = blob.offset
+        self._size = blob.size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise IOError('Negative seek position %d' % (offset,))
+        self._position = offset
+        return offset
+
+    def read(self, size=-1):
+        remaining = max(self._size - self._position, 0)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        start = self._start + self._position
+        if self._file is None:
+            data = self._data[start:start + size]
+        else:
+            self._file.seek(start)
+            data = self._file.read(size)
+        self._position += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        super(PackedFile, self).close()
+
+
+def map_file(path):
+    '''
+    Memory map a whole file for reading. Returns `None` for empty files, which
+    can't be mapped.
+    '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def digest_key(digest):
+    # Digests are hex numbers without leading zeros
+    return binascii.unhexlify(digest.zfill(64))
+
+
+def key_digest(key):
+    return format(int(binascii.hexlify(key), 16), 'x')
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+'''
+Post type registry
+
+Loads the post type schemas in `types/*.json` once, instead of reading them
+from disk for every request, and picks up changes to them without a restart:
+at most every `TYPES_POLL_INTERVAL` seconds (2 by default), a request that
+uses the registry checks the modification times and sizes of the files and
+reloads the ones that changed. Every worker process checks for itself, so
+nothing has to be told about the change.
+
+Responses built from the schemas can be cached in the registry with
+`serialized`, which keeps them until the schemas change. Each change bumps
+`generation`, so anything else derived from the schemas can tell when it's
+out of date.
+
+`validator` returns a Cerberus validator for the `content` of a post type.
+Validators are built once per schema (and thread, since they keep the
+errors of the last document they validated) rather than for every post.
+'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+from cerberus import Validator
+
+
+class TypeRegistry(object):
+    '''
+    The post type schemas in a directory, keyed by name (the file name
+    without `.json`).
+
+    :param types_dir: the directory holding the schema files.
+    :param poll_interval: the least number of seconds between two checks for
+                          changes, or `None` to never check.
+    '''
+    def __init__(self, types_dir, poll_interval=2.0):
+        self.types_dir = types_dir
+        self.poll_interval = poll_interval
+        self.generation = 0
+        self._schemas = {}
+        self._signatures = {}
+        self._serialized = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reload()
+
+    def get(self, name, default=None):
+        '''
+        Return the schema of a post type, or `default` if there is none.
+
+        :param name: the name of the post type.
+        '''
+        self.check()
+        return self._schemas.get(name, default)
+
+    def names(self):
+        '''
+        Return the names of the post types, in alphabetical order.
+        '''
+        self.check()
+        return sorted(self._schemas)
+
+    def validator(self, name):
+        '''
+        Return a validator for the `content` of a post type, or `None` if
+        there is no such type.
+
+        :param name: the name of the post type.
+        '''
+        self.check()
+        validators = getattr(self._local, 'validators', None)
+        if validators is None or validators[0] != self.generation:
+            validators = self._local.validators = (self.generation, {})
+        validator = validators[1].get(name, None)
+        if validator is None:
+            schema = self._schemas.get(name, None)
+            if schema is None:
+                return None
+            validator = validators[1][name] = Validator(schema)
+        return validator
+
+    def check(self):
+        '''
+        Reload the schemas if `poll_interval` has passed since they were last
+        checked and any of the files changed.
+        '''
+        if self.poll_interval is None:
+            return
+        now = time.time()
+        if now - self._checked < self.poll_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.poll_interval:
+                return
+            self._checked = now
+            if self._scan() != self._signatures:
+                self._load()
+
+    def reload(self):
+        '''
+        Load every schema file again.
+        '''
+        with self._lock:
+            self._checked = time.time()
+            self._load()
+
+    def serialized(self, key, fmt, serialize):
+        '''
+        Return a `(body, etag)` tuple for a response, building it with
+        `serialize` only the first time it's asked for since the schemas last
+        changed. The ETag is the SHA-1 digest of the body.
+
+        :param key: identifies what the response is for, e.g. the path.
+        :param fmt: identifies the format of the response, e.g. `json`.
+        :param serialize: function returning the body as a byte string.
+        '''
+        self.check()
+        cache_key = (self.generation, key, fmt)
+        cached = self._serialized.get(cache_key, None)
+        if cached is None:
+            body = serialize()
+            cached = (body, hashlib.sha1(body).hexdigest())
+            self._serialized[cache_key] = cached
+        return cached
+
+    def _scan(self):
+        # Must be called with the lock held
+        signatures = {}
+        try:
+            filenames = os.listdir(self.types_dir)
+        except OSError:
+            return signatures
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.types_dir, filename))
+            except OSError:
+                # Deleted in the meantime
+                continue
+            signatures[filename] = (stat.st_mtime, stat.st_size)
+        return signatures
+
+    def _load(self):
+        # Must be called with the lock held. Files that can't be read or
+        # parsed keep their last good schema until they're fixed.
+        signatures = self._scan()
+        schemas = {}
+        for filename, signature in signatures.items():
+            name = filename[:-len('.json')]
+            if signature == self._signatures.get(filename, None) \
+                    and name in self._schemas:
+                schemas[name] = self._schemas[name]
+                continue
+            try:
+                with open(os.path.join(self.types_dir, filename), 'r') as f:
+                    schemas[name] = json.load(f)
+            except (IOError, ValueError):
+                if name in self._schemas:
+                    schemas[name] = self._schemas[name]
+        if schemas != self._schemas or not self._signatures:
+            self._schemas = schemas
+            self._serialized = {}
+            self.generation += 1
+        self._signatures = signatures
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import copy
 from flask import current_app, request
 from eve.io.mongo import MongoJSONEncoder
 from eve.io.mongo import Validator
+from eve.methods.patch import resolve_nested_documents
 
 class NewBase60(object):
     '''
@@ -83,6 +85,54 @@ class NewBase60Validator(Validator):
             self._error(field, "value '%s' cannot be converted to NewBase60" %
                         value)
 
+    def _validate_post_type_schema(self, enabled, field, value):
+        """
+        Validates a post's `content` against the schema of its type, if the
+        type is one of the server's own (see `piss.type_registry`). The type
+        is taken from the original post when a `PATCH` doesn't change it.
+
+        A `PATCH` only sends the fields it changes, so it's the original
+        content with the changes merged in, the way Eve stores them, that is
+        validated. The rule is set on `type` as well, so that a `PATCH`
+        changing the type alone checks the original content against the new
+        type.
+        """
+        if not enabled:
+            return
+        original = self._original_document or {}
+        if field == 'type':
+            if not self.update or 'content' in self.document:
+                # Checked along with `content`
+                return
+            post_type = value
+            content = original.get('content', None) or {}
+            field = 'content'
+        else:
+            post_type = self.document.get('type', None) or original.get('type', None)
+            content = value
+            if self.update and original.get('content', None):
+                content = resolve_nested_documents(
+                    {'content': copy.deepcopy(value)},
+                    {'content': copy.deepcopy(original['content'])})['content']
+        name = get_type_name(post_type)
+        if name is None:
+            return
+        validator = current_app.type_registry.validator(name)
+        if validator is not None and not validator.validate(content):
+            self._error(field, dict(validator.errors))
+
+def get_type_name(post_type):
+    '''
+    Return the name of a post type hosted by this server, given its URL, or
+    `None` if it's somebody else's.
+    '''
+    if not isinstance(post_type, basestring):
+        return None
+    types_url = current_app.config['META_POST']['entity'].rstrip('/') + '/types/'
+    if not post_type.startswith(types_url):
+        return None
+    return post_type[len(types_url):].split('#', 1)[0] or None
+
 def get_post_by_id(post_id):
     '''
     Retrieve a post for the given ID.
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Microbenchmark for post content validation.
+
+Validates sample `content` against the post type schemas in `types/` the way
+the posts schema's `post_type_schema` rule does, with the validators cached
+by the type registry, and again building a new validator for every post, to
+show the cost per post of each.
+
+    python scripts/bench_content_validation.py --posts 20000
+'''
+
+import os
+import sys
+import time
+import click
+from cerberus import Validator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+from piss.type_registry import TypeRegistry
+
+SAMPLES = {
+    'note': {
+        'text': 'Just setting up my PISS server.',
+        'location': {
+            'type': 'Point',
+            'coordinates': [45, -122],
+            'name': 'Portland'
+        }
+    },
+    'article': {
+        'title': 'On caching',
+        'excerpt': 'There are two hard things in computer science.',
+        'body': 'Lorem ipsum dolor sit amet. ' * 200
+    },
+    'app': {
+        'name': 'Benchmark',
+        'url': 'https://example.com',
+        'redirect_url': 'https://example.com/callback',
+        'types': {
+            'read': ['https://example.com/types/note'],
+            'write': ['https://example.com/types/note']
+        }
+    }
+}
+
+
+def run(count, validate):
+    start = time.time()
+    for i in range(count):
+        if not validate():
+            raise click.ClickException('Sample content did not validate.')
+    return time.time() - start
+
+
+@click.command()
+@click.option('--types-dir', default=os.path.join(ROOT, 'types'), show_default=True)
+@click.option('--posts', default=20000, show_default=True, help='Posts to validate per type.')
+def bench(types_dir, posts):
+    '''
+    Time content validation with cached and rebuilt validators.
+    '''
+    registry = TypeRegistry(types_dir)
+    click.echo('%-10s %14s %14s %14s' % ('Type', 'Cached', 'Rebuilt', 'Speedup'))
+    for name, content in sorted(SAMPLES.items()):
+        schema = registry.get(name)
+        if schema is None:
+            click.echo('%-10s %14s' % (name, 'no schema'))
+            continue
+        cached = run(posts, lambda: registry.validator(name).validate(content))
+        rebuilt = run(posts, lambda: Validator(schema).validate(content))
+        click.echo('%-10s %11.1fus %11.1fus %13.1fx'
+                   % (name, cached / posts * 1e6, rebuilt / posts * 1e6,
+                      rebuilt / cached))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Stress test for the post ID allocator.
+
+Runs several processes, each with several threads, that allocate post IDs and
+insert documents with them into a scratch database, the same way
+`before_insert_posts` does. Reports the insert rate and the number of
+duplicate key errors, which should always be zero.
+
+    python scripts/bench_post_ids.py --processes 4 --threads 8 --rate 10000
+'''
+
+import os
+import sys
+import time
+import threading
+import multiprocessing
+import click
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from piss.post_ids import next_ids, RESOLUTIONS, COUNTERS_COLLECTION
+
+
+def worker(options, results):
+    client = pymongo.MongoClient(options['mongo_uri'])
+    db = client[options['database']]
+    counters = db[COUNTERS_COLLECTION]
+    posts = db['posts']
+    stats = {'inserted': 0, 'duplicates': 0}
+    lock = threading.Lock()
+    # Each thread paces itself to its share of the target rate
+    threads = options['processes'] * options['threads']
+    interval = float(options['batch']) * threads / options['rate']
+    deadline = time.time() + options['duration']
+
+    def run():
+        inserted = duplicates = 0
+        next_batch = time.time()
+        while time.time() < deadline:
+            ids = next_ids(counters, options['resolution'], options['batch'])
+            try:
+                posts.insert([{'_id': post_id} for post_id in ids])
+                inserted += len(ids)
+            except DuplicateKeyError:
+                duplicates += 1
+            next_batch += interval
+            delay = next_batch - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        with lock:
+            stats['inserted'] += inserted
+            stats['duplicates'] += duplicates
+
+    pool = [threading.Thread(target=run) for i in range(options['threads'])]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    results.put(stats)
+
+
+@click.command()
+@click.option('--mongo-uri', default='mongodb://localhost:27017', show_default=True)
+@click.option('--database', default='piss_bench_post_ids', show_default=True,
+              help='Scratch database. It is dropped before and after the run.')
+@click.option('--resolution', default='3600hz', show_default=True,
+              type=click.Choice([r for r in RESOLUTIONS]))
+@click.option('--processes', default=4, show_default=True)
+@click.option('--threads', default=8, show_default=True, help='Threads per process.')
+@click.option('--batch', default=1, show_default=True, help='IDs allocated per insert.')
+@click.option('--rate', default=10000, show_default=True, help='Target inserts per second.')
+@click.option('--duration', default=10, show_default=True, help='Seconds to run for.')
+def bench(**options):
+    '''
+    Hammer the post ID allocator and count duplicate key errors.
+    '''
+    client = pymongo.MongoClient(options['mongo_uri'])
+    client.drop_database(options['database'])
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(options, results))
+                 for i in range(options['processes'])]
+    start = time.time()
+    for p in processes:
+        p.start()
+    totals = {'inserted': 0, 'duplicates': 0}
+    for p in processes:
+        stats = results.get()
+        totals['inserted'] += stats['inserted']
+        totals['duplicates'] += stats['duplicates']
+    for p in processes:
+        p.join()
+    elapsed = time.time() - start
+
+    count = client[options['database']]['posts'].count()
+    client.drop_database(options['database'])
+
+    click.echo('Resolution:        %s' % (options['resolution'],))
+    click.echo('Inserted:          %d posts in %.2fs' % (totals['inserted'], elapsed))
+    click.echo('Throughput:        %.0f inserts/sec' % (totals['inserted'] / elapsed,))
+    click.echo('Duplicate keys:    %d' % (totals['duplicates'],))
+    click.echo('Posts in database: %d' % (count,))
+    if totals['duplicates'] or count != totals['inserted']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    bench()
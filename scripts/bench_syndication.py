@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Throughput benchmark for the syndication queue.
+
+Runs the syndication sandbox (see `piss.services.syndication.sandbox`) in a
+thread, creates notes in a scratch database and queues a syndication request
+for each of them from several client threads, the same way
+`POST /syndicate` does. Worker threads run the jobs against the sandbox, and
+the benchmark reports the time taken to accept the requests, the time from
+request to syndication link, and the number of jobs done per second. With
+`--images`, every note gets that many image attachments, so that Twitter jobs
+upload media (concurrently, from two images on) before tweeting.
+
+The app is built from the configuration of `--instance`, with the database
+swapped for the scratch one and the services pointed at the sandbox.
+
+    python scripts/bench_syndication.py --requests 500 --workers 8 --latency 0.2
+'''
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import click
+import requests
+from werkzeug.serving import make_server
+from werkzeug.datastructures import FileStorage
+from flask.config import Config
+from eve.methods.post import post_internal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+from piss import PISS
+from piss.file_io import save_attachment
+from piss.services.syndication import jobs, sandbox
+from piss.services.syndication.handlers import HANDLERS
+
+
+def make_instance(options, sandbox_url):
+    '''
+    Create a scratch instance folder with the configuration of the real one,
+    pointed at the scratch database and the sandbox. Returns its parent
+    folder, which also links to the real `types`.
+    '''
+    config = Config(options['instance'])
+    config.from_pyfile('piss.cfg')
+    settings_file = config.get('EVE_SETTINGS', None)
+    if not settings_file or not os.path.isfile(settings_file):
+        settings_file = os.path.join(ROOT, 'piss', 'settings.py')
+
+    scratch = tempfile.mkdtemp(prefix='piss-bench-')
+    os.symlink(os.path.join(os.path.dirname(options['instance']), 'types'),
+               os.path.join(scratch, 'types'))
+    os.makedirs(os.path.join(scratch, 'instance'))
+    with open(settings_file) as f:
+        settings = f.read()
+    with open(os.path.join(scratch, 'settings.py'), 'w') as f:
+        f.write(settings)
+        f.write('\nMONGO_DBNAME = %r\n' % (options['database'],))
+
+    # Nothing limits the rate but the sandbox, unless asked otherwise
+    rate_limits = {} if options['token_buckets'] else \
+        dict((service, (10 ** 9, 1)) for service in HANDLERS)
+    with open(os.path.join(options['instance'], 'piss.cfg')) as f:
+        cfg = f.read()
+    with open(os.path.join(scratch, 'instance', 'piss.cfg'), 'w') as f:
+        f.write(cfg)
+        f.write('\n'.join([
+            '',
+            'EVE_SETTINGS = %r' % (os.path.join(scratch, 'settings.py'),),
+            'SYNDICATION_SANDBOX_URL = %r' % (sandbox_url,),
+            'TWITTER = %r' % ({'app_key': 'sandbox', 'app_secret': 'sandbox',
+                               'token': 'sandbox',
+                               'token_secret': 'sandbox'},),
+            'FACEBOOK = %r' % ({'access_token': 'sandbox'},),
+            'SYNDICATION_RATE_LIMITS = %r' % (rate_limits,),
+            'SYNDICATION_RETRY_DELAY = %r' % (options['retry_delay'],),
+            # Facebook doesn't say when its limit resets
+            'SYNDICATION_RATE_LIMIT_BACKOFF = %r' % (options['window'],),
+            ''
+        ]))
+    return scratch
+
+
+def create_notes(app, count, images=0, image_size=64 * 1024):
+    '''
+    Create public notes to syndicate and return their IDs. Every note gets
+    the same `images` attachments of `image_size` bytes each.
+    '''
+    server_entity = app.config['META_POST']['entity']
+    note_type = os.path.join(server_entity, 'types', 'note')
+    post_ids = []
+    with app.test_request_context():
+        # The sandbox doesn't look at the contents
+        attachments = [save_attachment(FileStorage(
+            BytesIO(os.urandom(image_size)), filename='bench-%d.jpg' % (i,),
+            content_type='image/jpeg')) for i in range(images)]
+        for start in range(0, count, 100):
+            documents = [{
+                'entity': server_entity,
+                'type': note_type,
+                'content': {'text': 'Benchmark note %d' % (i,)},
+                'permissions': {'public': True}
+            } for i in range(start, min(start + 100, count))]
+            if attachments:
+                for document in documents:
+                    document['attachments'] = attachments
+            response, _, _, status = post_internal('posts', documents)
+            if status != 201:
+                raise click.ClickException('Could not create notes: %r'
+                                           % (response,))
+            items = response.get('_items', [response])
+            post_ids.extend(item['_id'] for item in items)
+    return post_ids
+
+
+def syndicate(app, post_id, services):
+    '''
+    Check and queue a post for every service, like `POST /syndicate`, and
+    return the time it took.
+    '''
+    start = time.time()
+    with app.test_request_context():
+        server_entity = app.config['META_POST']['entity']
+        post = app.data.driver.db['posts'].find_one({'_id': post_id})
+        for service in services:
+            handler = HANDLERS[service]
+            data = {
+                'entity': handler.entity,
+                'type': post['type'],
+                'content': {'text': post['content']['text']},
+                'links': [{'post': post_id}]
+            }
+            handler.check(data, post, server_entity)
+            jobs.enqueue_job(post_id, service, data)
+    return time.time() - start
+
+
+def work(app, stop, poll_interval):
+    while not stop.is_set():
+        with app.test_request_context():
+            claimed = jobs.claim_jobs()
+            if claimed:
+                jobs.run_jobs(claimed)
+        if not claimed:
+            time.sleep(poll_interval)
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return 'n/a'
+    def rank(p):
+        return values[min(int(len(values) * p), len(values) - 1)] * 1000
+    return 'p50 %.0fms, p90 %.0fms, p99 %.0fms, max %.0fms' % (
+        rank(0.5), rank(0.9), rank(0.99), values[-1] * 1000)
+
+
+@click.command()
+@click.option('--instance', default=os.path.join(ROOT, 'instance'), show_default=True,
+              help='Instance folder to take the configuration from.')
+@click.option('--database', default='piss_bench_syndication', show_default=True,
+              help='Scratch database. It is dropped before and after the run.')
+@click.option('--services', default='twitter,facebook', show_default=True,
+              help='Services to syndicate each note to, separated by commas.')
+@click.option('--requests', 'request_count', default=200, show_default=True,
+              help='Number of notes to syndicate.')
+@click.option('--images', default=0, show_default=True,
+              help='Image attachments per note (Twitter takes up to 4).')
+@click.option('--image-size', default=64 * 1024, show_default=True,
+              help='Size of each image in bytes.')
+@click.option('--clients', default=8, show_default=True, help='Threads sending requests.')
+@click.option('--workers', default=8, show_default=True, help='Threads running jobs.')
+@click.option('--port', default=5055, show_default=True, help='Port for the sandbox.')
+@click.option('--latency', default=0.1, show_default=True, help='Sandbox response time in seconds.')
+@click.option('--jitter', default=0.05, show_default=True, help='Most seconds added to the latency.')
+@click.option('--error-rate', default=0.0, show_default=True, help='Fraction of sandbox requests that fail.')
+@click.option('--limit', default=None, type=int, help='Sandbox requests accepted per service per window.')
+@click.option('--window', default=60, show_default=True, help='Sandbox rate limit window in seconds.')
+@click.option('--token-buckets', default=False, is_flag=True,
+              help='Keep the configured syndication rate limits.')
+@click.option('--retry-delay', default=1, show_default=True, help='SYNDICATION_RETRY_DELAY for the run.')
+@click.option('--poll-interval', default=0.05, show_default=True, help='Seconds idle workers wait.')
+@click.option('--timeout', default=300, show_default=True, help='Seconds to wait for the jobs.')
+def bench(**options):
+    '''
+    Syndicate notes to the sandbox and measure the syndication queue.
+    '''
+    services = [s.strip().lower() for s in options['services'].split(',') if s.strip()]
+    for service in services:
+        if service not in HANDLERS:
+            raise click.UsageError('Unknown syndication service: %s' % (service,))
+
+    # Keep the sandbox's request log out of the report
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    sandbox_url = 'http://127.0.0.1:%d' % (options['port'],)
+    server = make_server('127.0.0.1', options['port'], sandbox.create_sandbox(
+        latency=options['latency'], jitter=options['jitter'],
+        error_rate=options['error_rate'], limit=options['limit'],
+        window=options['window']), threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    scratch = make_instance(options, sandbox_url)
+    stop = threading.Event()
+    try:
+        app = PISS(os.path.join(scratch, 'instance'))
+        with app.app_context():
+            db = app.data.driver.db
+            db.connection.drop_database(options['database'])
+        post_ids = create_notes(app, options['request_count'],
+                                options['images'], options['image_size'])
+
+        workers = [threading.Thread(target=work, args=(app, stop, options['poll_interval']))
+                   for i in range(options['workers'])]
+        for t in workers:
+            t.start()
+        start = time.time()
+        pool = ThreadPool(options['clients'])
+        accept_times = pool.map(lambda post_id: syndicate(app, post_id, services), post_ids)
+        pool.close()
+        accepted = time.time() - start
+
+        job_count = len(post_ids) * len(services)
+        deadline = start + options['timeout']
+        with app.app_context():
+            job_collection = jobs.get_jobs()
+            while time.time() < deadline:
+                if not job_collection.find(
+                        {'status': {'$in': ['queued', 'running']}}).count():
+                    break
+                time.sleep(0.1)
+            finished = list(job_collection.find({'status': {'$in': ['done', 'failed']}}))
+            done = [job for job in finished if job['status'] == 'done']
+        stop.set()
+        for t in workers:
+            t.join()
+        last = max([job['updated'] for job in finished] or [start])
+        elapsed = last - start
+        sandbox_stats = requests.get(sandbox_url + '/stats').json()
+
+        with app.app_context():
+            db.connection.drop_database(options['database'])
+    finally:
+        stop.set()
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    click.echo('Services:          %s' % (', '.join(services),))
+    click.echo('Requests:          %d accepted in %.2fs (%s)'
+               % (len(post_ids), accepted, percentiles(accept_times)))
+    click.echo('Jobs:              %d done, %d failed, %d unfinished'
+               % (len(done), len(finished) - len(done), job_count - len(finished)))
+    click.echo('Request to link:   %s'
+               % (percentiles([job['updated'] - job['created'] for job in done]),))
+    click.echo('Throughput:        %.1f jobs/sec'
+               % (len(finished) / elapsed if elapsed > 0 else 0,))
+    for service in services:
+        stats = sandbox_stats[service]
+        click.echo('Sandbox %-10s %d requests, %d errors, %d rate limited'
+                   % (service + ':', stats['requests'], stats['errors'],
+                      stats['rate_limited']))
+    if job_count != len(finished):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    bench()